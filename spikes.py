@@ -14,6 +14,9 @@ from configparser import ConfigParser
 import datetime as dt
 import spikes_data_selection_functions as sel
 import spikes_statistics as stats
+import spikes_storage as storage
+import spikes_detection as detect
+import spikes_kernels as kernels
 from os import sys
 
 # user parameters for the analysis
@@ -36,6 +39,35 @@ custom_events=[]
 #custom_events = [[ dt.datetime.strptime('2020-1-1' ,'%Y-%m-%d'),dt.datetime.strptime('2020-2-1' ,'%Y-%m-%d')]]
                   # [dt.datetime.strptime('2020-1-1','%Y-%m-%d'),dt.datetime.strptime('2020-12-31','%Y-%m-%d')]]
 
+# format of the minute data files with spikes ('csv', 'parquet' or 'feather'). 
+# Existing csv files can be converted with storage.convert_spiked_tree('./data-minute-spiked/', 'parquet')
+storage.spiked_file_format = 'csv'
+# write spiked files as year/month partitions, readers open only the analyzed years. 
+# Existing files can be partitioned with storage.partition_spiked_tree('./data-minute-spiked/')
+storage.partitioned_layout = False
+# read L1 and spiked files one month ('M') or day ('D') at a time during ingestion and monthly aggregation (bounded memory)
+storage.chunk_period = None
+# minutes reported by more instruments of '+'-joined ids: 'all' (keep all the rows), 'priority' (first id), 'mean' or 'drop'
+fmt.duplicate_minutes_rule = 'all'
+# baseline of the high spikes amplitudes: None (30 min running average) or running quantile, e.g. 0.5 for the running median
+fmt.baseline_quantile = None
+# compiled kernels of the running quantile and REBS baselines are used if the optional numba package is installed,
+# uncomment to use the numpy implementations anyway
+# kernels.use_jit = False
+
+#### #### #### #### #### #### #### #### #### #### #### #### ####
+####  SD and REBS spikes computed from the L1 data (alternative to the results delivered by ICOS-ATC) ####
+# the spike files of all the alpha (beta) values are written in ./data-spikes-native/SD-results/ (REBS-results/) with a single pass over the data,
+# the delivered files in ./data-spikes/ are not modified. The computed files are read instead of the delivered ones with:
+# fmt.spike_files_source = 'native'
+
+# detect.write_SD_spike_files(stations, algorithms[0][1:len(algorithms[0])])
+# detect.write_REBS_spike_files(stations, algorithms[1][1:len(algorithms[1])]) # one baseline fit for all the beta values
+
+# online detection of one station/height/specie/instrument: the L1 file is followed as a live feed and the flags are appended 
+# to the '_spiked' files (SD flags without latency, REBS flags after REBS_window/2 minutes)
+# detect.run_online_detection('CMN', '8.0', 'CO2', '590', algorithms, follow=True, poll_interval=60)
+
 #### #### #### #### #### #### #### #### #### #### #### #### ####
 ####  elaborate minute data and write them to smaller files ####
 # N.B. this function has to be executed only once
@@ -46,6 +78,24 @@ custom_events=[]
 #         print(alg, param)
 #         fmt.write_spiked_file(stations, alg, param)
 
+# parallel alternative: one process for each station/instrument/parameter unit, failed units are reported at the end
+# failures = fmt.write_spiked_files_parallel(stations, algorithms, workers=16)
+
+# incremental alternative: only new or changed input files are processed, PIQc files and existing monthly tables
+# are updated for the changed months. The processed inputs are recorded in fmt.ingestion_manifest_file
+# failures = fmt.ingest_incremental(stations, algorithms, years, workers=1)
+
+# ### #### #### #### #### #### #### #### #### #### #### #### ####
+
+#### #### #### #### #### #### #### #### #### #### #### #### ####
+####  write minute data once with the spikes of all the parameters (spike matrix) ####
+# N.B. alternative to write_spiked_file(), the analysis functions read the spike matrix when it exists
+
+# fmt.write_spike_matrix(stations, algorithms)
+# fmt.write_spike_matrix(stations, algorithms, nested=True) # one int8 level column for each algorithm, plus the minutes breaking the nesting
+# fmt.add_PIQc_spike_matrix(stations)
+# fmt.write_minute_grid(stations, algorithms) # fixed 1-minute grid files opened as numpy.memmap (see storage.open_minute_grid())
+
 # ### #### #### #### #### #### #### #### #### #### #### #### ####
 
 #### #### #### #### #### #### #### #### #### #### #### #### ####
@@ -59,6 +109,14 @@ custom_events=[]
 #       fmt.add_PIQc_column(stations,alg,param)
 #       fmt.add_PIQc_high_spikes_column(stations, alg, param)
 
+# alternative for the PIQc column: the PIQc data of each station/height/specie are decoded once for all the parameters
+# fmt.add_PIQc_columns(stations, algorithms)
+# fmt.add_PIQc_high_spikes_columns(stations, algorithms) # the baseline is computed once for all the parameters
+
+# alternative to write_spiked_file(), add_PIQc_column() and add_PIQc_high_spikes_column(): the three steps are chained in memory 
+# and only the '_spiked_PIQc_mean' files are written (intermediates=True to write also the '_spiked' and '_spiked_PIQc' files)
+# report = fmt.run_ingestion_pipeline(stations, algorithms, intermediates=False, workers=None, incremental=True)
+
 # ### #### #### #### #### #### #### #### #### #### #### #### ####
 
 for stat in stations:
@@ -95,12 +153,16 @@ for stat in stations:
                     
                     # inst_frame = [] # list of dataframe with instrument data
                     # for h in heights:
-                    #     in_filename = './data-minute-spiked/' + stat +'/' + fmt.get_L1_file_name(stat, h, spec, id) +'_'+alg+'_'+param+ '_spiked'
-                    #     inst_frame.append( pd.read_csv(in_filename, sep=';', parse_dates=['Datetime'] ) ) # read dataframe with spiked data
+                    #     in_filename = fmt.get_spiked_file_name(stat, h, spec, id, alg, param)
+                    #     inst_frame.append( storage.read_spiked_frame(in_filename) ) # read dataframe with spiked data
+                    
+                    # profile = fmt.read_height_profile(stat, heights, spec, id, alg, param) # all heights on one minute grid (time x height arrays)
+                    # print(sel.get_profile_stats(profile, spec)) # spike frequency, coverage and hourly means of each height
                     
                     ## #### plot events timeseries #### ####
                     # for ev in events:
                     #     print('processing event', ev[0])
+                    #     # inst_frame = sel.profile_to_frames(sel.select_event_grid(profile, ev[0], ev[1]+dt.timedelta(minutes=1)), spec.lower()) # event of all heights with one slice
                     #     # splt.plot_sd_event(inst_frame, stat, id, alg, param, spec, heights, ev)
                     #     splt.plot_conc_sd_event(inst_frame, stat, id, alg, param, spec, heights, ev)
                     #     splt.plot_conc_event(inst_frame, stat, id, alg, param, spec, heights, ev)
@@ -166,6 +228,10 @@ for stat in stations:
             #         stats.plot_BFOR_parameters_sdrebs(stat, id, algorithms, spec, h, high_spikes=False, high_spikes_mode='single',quant=None)
             #         stats.plot_BFOR_parameters_sdrebs(stat, id, algorithms, spec, h, high_spikes=True, high_spikes_mode='single',quant=None)
             #         stats.plot_BFOR_parameters_lowhigh(stat, id, algorithms, spec, h, high_spikes_mode='single',quant=None)
+            #         # sensitivity of the high spikes to the baseline window length, without reprocessing the files
+            #         for algo in algorithms:
+            #             print(stats.get_high_spikes_window_sensitivity(algo, stat, h, spec, id, ['10min','30min','60min','120min']))
+            #             print(stats.get_high_spikes_window_sensitivity(algo, stat, h, spec, id, ['30min','60min'], baseline_quantile=0.5)) # running median baseline
     
 # stats.BFOR_table(stations, algorithms, high_spikes=False, high_spikes_mode='single', quant=None)
 sys.exit()
@@ -272,8 +338,8 @@ for spec in ['CH4','CO2','CO']:
 #        for spec in species:
 #            inst_frame_PIQc = [] # list of dataframe with instrument data after PIQc
 #            for h in heights:
-#               in_filename = './data-minute-spiked/' + stat +'/' + fmt.get_L1_file_name(stat, h, spec, id) +'_'+alg+'_'+param+ '_spiked_PIQc_mean'
-#               inst_frame_PIQc.append( pd.read_csv(in_filename, sep=';', parse_dates=['Datetime'] ) ) # read dataframe with spiked data after PIQc
+#               in_filename = fmt.get_spiked_file_name(stat, h, spec, id, alg, param, '_spiked_PIQc_mean')
+#               inst_frame_PIQc.append( storage.read_spiked_frame(in_filename) ) # read dataframe with spiked data after PIQc
 #             #### plot events timeseries #### ####
 #            for ev in events:
 #                print('processing event', ev[0])
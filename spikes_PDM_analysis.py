@@ -13,6 +13,7 @@ import numpy as np
 import spikes_formatting_functions as fmt
 import spikes_data_selection_functions as sel
 import spikes_statistics as stats
+import spikes_storage as storage
 from configparser import ConfigParser
 
 frame_tdf = pd.read_csv('./data-minute/PDM-minute-data/pdm_ete_2015/tdf_ch4_all_synchro.txt', sep=' ')
@@ -47,22 +48,20 @@ for algo in algorithms:
         out_frame.insert(2,'Stdev',np.nan)
         out_frame.insert(3,'InstrumentId',ID[0])
 
-        out_frame = out_frame.merge(spike_frame[['Datetime','spike_ch4']], how = 'left', on='Datetime') # add spike column with True values corresponding to spikes
-        out_frame['spike_ch4'] = out_frame['spike_ch4'].fillna('False')
+        out_frame = fmt.merge_spike_col(out_frame, spike_frame, 'ch4') # add spike column with True values corresponding to spikes
         out_frame.insert(5,'spike_ch4_PIQc',False)
         out_frame = out_frame.merge(frame_tdf[['Datetime','GET_corr']], how = 'left',  on='Datetime' ) # add spike column with True values corresponding to spikes
         out_frame.insert(5,'ch4_diff',np.abs(out_frame['ch4']-out_frame['GET_corr']))
 
         out_frame.loc[out_frame['ch4_diff']>6, 'spike_ch4_PIQc']=True
         del out_frame['ch4_diff'], out_frame['GET_corr']
-        infile_spiked = './data-minute-spiked/PDM/' + fmt.get_L1_file_name('PDM', heights[0], 'CH4', ID[0])+'_'+ algo[0] +'_'+ param + '_spiked' # write "spiked" dataframe on file
-        out_filename = infile_spiked + '_PIQc'
+        infile_spiked = fmt.get_spiked_file_name('PDM', heights[0], 'CH4', ID[0], algo[0], param) # write "spiked" dataframe on file
+        out_filename = infile_spiked + '_PIQc_mean'
 
-        out_frame.to_csv(out_filename,sep=';')
-        fmt.add_PIQc_high_spikes_column(['PDM'], algo[0], param)
-        spiked_frame = pd.read_csv(out_filename+'_mean', sep=';')
-        spiked_frame = stats.add_high_spikes_col(spiked_frame, 'ch4', 'single', '') # add high spikes column
-        spiked_frame['Datetime']=pd.to_datetime(spiked_frame['Datetime'])
+        spiked_frame = fmt.get_PIQc_mean_frame(out_frame, 'CH4') # amplitudes computed in memory, as in the files
+        storage.write_spiked_frame(spiked_frame, out_filename, index=True)
+        fmt.write_PIQc_spike_index(spiked_frame, out_filename, 'CH4')
+        spiked_frame = stats.add_high_spikes_col(spiked_frame.reset_index(), 'ch4', 'single', '') # add high spikes column
         frame = frame_tdf[['Datetime','ICOS','GET_corr']]
         frame = frame.merge(spiked_frame[['Datetime','spike_ch4','spike_ch4_PIQc','high_spike_ch4_PIQc']], on='Datetime', how='left')
         ax[i].scatter( frame['ICOS'], frame['GET_corr'], c='black', s=2, label = 'all data')
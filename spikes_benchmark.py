@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the data processing functions against the previous (row by row) implementations.
+The benchmarks run on synthetic frames with the same layout of the ICOS files, thus they do not need the internal data.
+"""
+import os
+import time
+import tracemalloc
+import tempfile
+import numpy as np
+import pandas as pd
+import spikes_data_selection_functions as sel
+import spikes_formatting_functions as fmt
+import spikes_statistics as stats
+import spikes_storage as storage
+import spikes_detection as detect
+import spikes_kernels as kernels
+
+def make_spike_frame(nrows, species=['co2','ch4','co'], seed=0):
+    """
+    build a synthetic frame with the same columns of the .spikes files
+
+    Parameters
+    ----------
+    nrows : int
+        number of flagged minutes
+    species : list, optional
+        species names in lower case
+    seed : int, optional
+        seed of the random generator
+
+    Returns
+    -------
+    df : DataFrame
+        frame with 'Datetime', 'InstrumentIds', 'SamplingAltitude' and 'SpeciesList' columns
+    """
+    rng = np.random.default_rng(seed)
+    species_lists = [','.join(species[:n]) for n in range(1, len(species)+1)] + species[1:]
+    df = pd.DataFrame({'Datetime': pd.date_range('2019-01-01', periods=nrows, freq='min'),
+                       'InstrumentIds': 619,
+                       'SamplingAltitude': 100.0,
+                       'SpeciesList': rng.choice(species_lists, nrows)})
+    return df
+
+def add_spike_cols_loop(df, species):
+    """ previous row by row implementation of sel.add_spike_cols(), used as reference """
+    for spec in species:
+        df.insert(len(df.columns), 'spike_'+spec.lower(), False)
+
+    for i, row in df.iterrows():
+        spikes = df.loc[i,'SpeciesList'].split(',')
+        for spec in species:
+                if (spec.lower() in spikes):
+                    df.loc[i, 'spike_'+spec.lower()] = True
+
+def make_PIQc_frame(nrows, seed=0):
+    """
+    build a synthetic frame with the same columns of the minute data files after PIQc
+
+    Parameters
+    ----------
+    nrows : int
+        number of minutes
+    seed : int, optional
+        seed of the random generator
+
+    Returns
+    -------
+    df : DataFrame
+        frame with 'Datetime', 'Flag' and 'ManualDescriptiveFlag' columns
+    """
+    rng = np.random.default_rng(seed)
+    manual_flags = ['', '', '', '', 'Z', 'Z-1', 'Z-2', 'Z,Z-1', 'O', 'O,Z-2', 'P-1']
+    df = pd.DataFrame({'Datetime': pd.date_range('2019-01-01', periods=nrows, freq='min'),
+                       'Flag': 'O',
+                       'ManualDescriptiveFlag': rng.choice(manual_flags, nrows)})
+    return df
+
+def add_spike_cols_PIQc_loop(df, specie):
+    """ previous row by row implementation of sel.add_spike_cols_PIQc(), used as reference """
+    df.insert(len(df.columns), 'spike_'+specie.lower()+'_PIQc', False)
+
+    for i, row in df.iterrows():
+        manual_flags = df.loc[i,'ManualDescriptiveFlag'].split(',')
+        if (('Z' in manual_flags)|('Z-1' in manual_flags)|('Z-2' in manual_flags)):
+            df.loc[i, 'spike_'+specie.lower()+'_PIQc'] = True
+
+def make_instrument_frames(nrows, n_inst=2, seed=0):
+    """
+    build synthetic minute data of the instruments of a '+'-joined instrument id, reporting partly the same minutes
+
+    Parameters
+    ----------
+    nrows : int
+        number of minutes of the period, each instrument reports about 3/4 of them
+    n_inst : int, optional
+        number of instruments
+    seed : int, optional
+        seed of the random generator
+
+    Returns
+    -------
+    frames : list of DataFrame
+        frames with 'Datetime', 'co2', 'Stdev' and 'ManualDescriptiveFlag' (pandas string dtype) columns
+    """
+    rng = np.random.default_rng(seed)
+    datetimes = pd.date_range('2019-01-01', periods=nrows, freq='min')
+    manual_flags = ['', '', '', '', 'Z', 'Z-1', 'O,Z-2', 'P-1']
+    frames = []
+    for i in range(n_inst):
+        rows = rng.random(nrows) < 0.75
+        n = int(rows.sum())
+        frames.append(pd.DataFrame({'Datetime': datetimes[rows],
+                                    'co2': np.round(410 + rng.normal(0, 2, n), 3),
+                                    'Stdev': np.round(rng.random(n), 3),
+                                    'ManualDescriptiveFlag': pd.array(rng.choice(manual_flags, n), dtype='string')}))
+    return frames
+
+def merge_instrument_frames_sort(frames, rule):
+    """ previous implementation of fmt.merge_instrument_frames() ('all' and 'priority' rules): concatenation and stable sort, used as reference """
+    frame = pd.concat(frames, ignore_index=True)
+    if rule == 'priority':
+        frame = frame.drop_duplicates(subset='Datetime', keep='first')
+    return frame.sort_values(by='Datetime', kind='stable').reset_index(drop=True)
+
+def write_L1_file(file_name, nrows, specie='CO2', seed=0):
+    """
+    write a synthetic L1 minute data file with the same header and columns of the ICOS files
+
+    Parameters
+    ----------
+    file_name : str
+        path and name of the output file
+    nrows : int
+        number of minutes
+    specie : str, optional
+        chemical specie
+    seed : int, optional
+        seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    t = pd.date_range('2019-01-01', periods=nrows, freq='min')
+    df = pd.DataFrame({'Site': 'CMN', 'SamplingHeight': 8.0,
+                       'Year': t.year, 'Month': t.month, 'Day': t.day, 'Hour': t.hour, 'Minute': t.minute,
+                       'DecimalDate': np.round(t.year + t.dayofyear/366, 5),
+                       specie.lower(): np.round(410 + rng.normal(0, 2, nrows), 3),
+                       'Stdev': np.round(rng.gamma(2, 0.05, nrows), 3),
+                       'NbPoints': 60,
+                       'Flag': rng.choice(['O','O','O','O','U','R','N','K','H'], nrows),
+                       'InstrumentId': 590,
+                       'QualityId': '1'})
+    head_nlines = 12
+    with open(file_name, 'w') as file:
+        file.write('# SYNTHETIC ICOS L1 FILE\n# STATION: CMN\n# SPECIE: '+specie+'\n# \n')
+        file.write('# HEADER LINES: '+str(head_nlines)+'\n')
+        for i in range(head_nlines-6):
+            file.write('# \n')
+        df.to_csv(file, sep=';', index=False)
+
+def read_L1_ICOS_loop(file_name, specie):
+    """ previous implementation of fmt.read_L1_ICOS(), used as reference """
+    file = open(file_name, 'r')
+    for i in range(5): 
+        line = file.readline() # read the 5th line to get the header lines number
+    head_nlines = int(line.split(' ')[3]) # get the number of header lines
+    file.close()
+    ucols = ['Year','Month','Day','Hour','Minute',specie.lower(),'Stdev', 'Flag', 'InstrumentId'] # cols to be read
+    out_frame = pd.read_csv(file_name, 
+                            sep=';', 
+                            skiprows = head_nlines-1,
+                            usecols=ucols
+                            )
+    out_frame.insert(1, 'Datetime', pd.to_datetime(out_frame[['Year','Month','Day','Hour','Minute']]))
+    del(out_frame['Year'], out_frame['Month'], out_frame['Day'], out_frame['Hour'], out_frame['Minute'])
+    out_frame = out_frame[(out_frame['Flag']!='N')&
+                          (out_frame['Flag']!='K')&
+                          (out_frame['Flag']!='H')] # retain only data that are flagged as valid
+    return out_frame
+
+def make_minute_series(nminutes=1051200, seed=0):
+    """
+    generate a synthetic record of minute concentrations (2 years by default) with gaps, spikes and NaN values,
+    return datetimes and values
+    """
+    rng = np.random.default_rng(seed)
+    datetimes = pd.date_range('2019-01-01', periods=nminutes, freq='min')
+    datetimes = datetimes[rng.random(nminutes)>0.05] # missing minutes
+    n = len(datetimes)
+    values = 410 + np.sin(np.arange(n)/500) + rng.normal(0, 0.1, n)
+    values[rng.random(n)<0.02] += 3 # spikes
+    values[rng.random(n)<0.01] = np.nan
+    values[::5] = np.round(values[::5], 1) # repeated values
+    return datetimes, values
+
+def memit(func, *args, **kwargs):
+    """ return elapsed time [s], peak of allocated memory [MB] and result of func(*args, **kwargs) """
+    tracemalloc.start()
+    elapsed, res = timeit(func, *args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]/1024**2
+    tracemalloc.stop()
+    return elapsed, peak, res
+
+def timeit(func, *args, **kwargs):
+    """ return elapsed time [s] and result of func(*args, **kwargs) """
+    start = time.perf_counter()
+    res = func(*args, **kwargs)
+    return time.perf_counter() - start, res
+
+def benchmark_add_spike_cols(nrows=20000, species=['co2','ch4','co']):
+    """
+    compare the vectorized sel.add_spike_cols() with the row by row loop and check that the outputs are identical
+    """
+    df_loop = make_spike_frame(nrows, [s.lower() for s in species])
+    df_vect = df_loop.copy()
+    t_loop, _ = timeit(add_spike_cols_loop, df_loop, species)
+    t_vect, _ = timeit(sel.add_spike_cols,  df_vect, species)
+    pd.testing.assert_frame_equal(df_loop, df_vect)
+    print('add_spike_cols  rows:', nrows,
+          ' loop:', round(t_loop,3), 's (', int(nrows/t_loop), 'rows/s )',
+          ' vectorized:', round(t_vect,4), 's (', int(nrows/t_vect), 'rows/s )',
+          ' speedup:', round(t_loop/t_vect,1))
+
+def benchmark_add_spike_cols_PIQc(nrows=20000, specie='CO2'):
+    """
+    compare the vectorized sel.add_spike_cols_PIQc() with the row by row loop and check that the outputs are identical
+    """
+    df_loop = make_PIQc_frame(nrows)
+    df_vect = df_loop.copy()
+    t_loop, _ = timeit(add_spike_cols_PIQc_loop, df_loop, specie)
+    t_vect, _ = timeit(sel.add_spike_cols_PIQc,  df_vect, specie)
+    pd.testing.assert_frame_equal(df_loop, df_vect)
+    print('add_spike_cols_PIQc  rows:', nrows,
+          ' loop:', round(t_loop,3), 's (', int(nrows/t_loop), 'rows/s )',
+          ' vectorized:', round(t_vect,4), 's (', int(nrows/t_vect), 'rows/s )',
+          ' speedup:', round(t_loop/t_vect,1))
+
+def benchmark_merge_instrument_frames(nrows=500000, n_inst=2):
+    """
+    compare fmt.merge_instrument_frames() with the concatenation and stable sort of the frames of the instruments and 
+    check that the outputs are identical, also for the string column (pandas extension dtype) of the PIQc data
+    """
+    frames = make_instrument_frames(nrows, n_inst)
+    for rule in ['all', 'priority']:
+        t_sort, df_sort = timeit(merge_instrument_frames_sort, frames, rule)
+        t_merge, df_merge = timeit(fmt.merge_instrument_frames, frames, rule)
+        pd.testing.assert_frame_equal(df_sort, df_merge)
+        print('merge_instrument_frames ('+rule+')  rows:', len(df_merge),
+              ' concat+sort:', round(t_sort,3), 's  merge:', round(t_merge,3), 's')
+
+def benchmark_contingency_counts(nrows=1000000, spike_rate=0.03):
+    """
+    compare the contingency table counted on a '_spiked_PIQc_mean' file (read of the spike columns and 
+    stats.get_contingency_counts()) with the count on its spike index (storage.read_spike_index() and 
+    stats.get_contingency_counts_index()) and check that the counts are identical. The minutes reported by both the 
+    instruments are repeated, as in the files of '+'-joined instrument ids
+    """
+    rng = np.random.default_rng(0)
+    frame = fmt.merge_instrument_frames(make_instrument_frames(nrows), 'all')[['Datetime', 'co2']]
+    frame['spike_co2'] = rng.random(len(frame)) < spike_rate
+    frame['spike_co2_PIQc'] = frame['spike_co2'] ^ (rng.random(len(frame)) < spike_rate/3)
+    frame = frame.set_index('Datetime')
+    columns = ['spike_co2', 'spike_co2_PIQc']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'CMN_CO2_SD_1.0_spiked_PIQc_mean')
+        storage.write_spiked_frame(frame, file_name, index=True)
+        fmt.write_PIQc_spike_index(frame, file_name, 'CO2')
+        t_dense, mem_dense, counts_dense = memit(lambda: stats.get_contingency_counts(storage.read_spiked_frame(file_name, columns), *columns))
+        t_index, mem_index, counts_index = memit(lambda: stats.get_contingency_counts_index(*storage.read_spike_index(file_name), *columns))
+    assert counts_dense == counts_index
+    print('contingency_counts  rows:', len(frame),
+          ' dense:', round(t_dense,3), 's', round(mem_dense), 'MB peak',
+          ' spike index:', round(t_index,4), 's', round(mem_index, 1), 'MB peak')
+
+def benchmark_read_L1(nrows=1000000, specie='CO2'):
+    """
+    compare parse time and peak memory of fmt.read_L1_minute_file() and of the previous reader on a synthetic L1 file
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'CMN_L1_minute.'+specie)
+        write_L1_file(file_name, nrows, specie)
+        ucols = ['Year','Month','Day','Hour','Minute',specie.lower(),'Stdev', 'Flag', 'InstrumentId']
+        dtype = dict(fmt.L1_dtype, **{specie.lower(): 'float64', 'Stdev': 'float64', 'InstrumentId': 'category'})
+        t_old, mem_old, df_old = memit(read_L1_ICOS_loop, file_name, specie)
+        t_new, mem_new, df_new = memit(fmt.read_L1_minute_file, file_name, ucols, dtype)
+    assert (df_old['Datetime'].values == df_new['Datetime'].values).all()
+    assert np.allclose(df_old[specie.lower()].values, df_new[specie.lower()].values, atol=1e-4)
+    print('read_L1  rows:', nrows,
+          ' old:', round(t_old,2), 's', round(mem_old), 'MB peak,', round(df_old.memory_usage(deep=True).sum()/1024**2), 'MB frame',
+          ' new:', round(t_new,2), 's', round(mem_new), 'MB peak,', round(df_new.memory_usage(deep=True).sum()/1024**2), 'MB frame')
+
+def benchmark_kernels(nminutes=1051200, window='30min', quantile=0.5):
+    """
+    compare the compiled kernels (see spikes_kernels) with the numpy/heapq implementations on a synthetic minute record:
+    running quantile baseline of sel.get_centered_rolling_quantile() and REBS baseline fit of detect.get_REBS_baseline().
+    Check that the running quantiles are identical and that the REBS baselines agree to rounding errors
+    """
+    if not kernels.use_jit:
+        print('kernels: numba is not available, the benchmark is skipped')
+        return
+    datetimes, values = make_minute_series(nminutes)
+    n = len(values)
+    # first calls compile the kernels (or load them from the disk cache)
+    sel.get_centered_rolling_quantile(datetimes[:100], values[:100], window, quantile)
+    detect.get_REBS_baseline(datetimes[:100], values[:100])
+    try:
+        t_jit, q_jit = timeit(sel.get_centered_rolling_quantile, datetimes, values, window, quantile)
+        t_jit_REBS, (b_jit, sigma_jit) = timeit(detect.get_REBS_baseline, datetimes, values)
+        kernels.use_jit = False
+        t_heap, q_heap = timeit(sel.get_centered_rolling_quantile, datetimes, values, window, quantile)
+        t_np_REBS, (b_np, sigma_np) = timeit(detect.get_REBS_baseline, datetimes, values)
+    finally:
+        kernels.use_jit = True
+    assert np.array_equal(q_jit, q_heap, equal_nan=True)
+    assert np.allclose(b_jit, b_np, rtol=0, atol=1e-9, equal_nan=True) and np.isclose(sigma_jit, sigma_np)
+    print('rolling_quantile  points:', n,
+          ' heapq:', round(t_heap,2), 's  jit:', round(t_jit,2), 's  speedup:', round(t_heap/t_jit,1))
+    print('REBS_baseline  points:', n,
+          ' numpy:', round(t_np_REBS,2), 's  jit:', round(t_jit_REBS,2), 's  speedup:', round(t_np_REBS/t_jit_REBS,1))
+
+if __name__ == '__main__':
+    benchmark_add_spike_cols()
+    benchmark_add_spike_cols_PIQc()
+    benchmark_merge_instrument_frames()
+    benchmark_contingency_counts()
+    benchmark_read_L1()
+    benchmark_kernels()
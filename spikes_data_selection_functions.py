@@ -12,7 +12,16 @@ import datetime
 import datetime as dt 
 from configparser import ConfigParser
 import numpy as np
+import numbers
+import heapq
+import warnings
 import spikes_plot as splt
+import spikes_storage as storage
+import spikes_kernels as kernels
+import os
+
+PIQc_spike_flags = ['Z', 'Z-1', 'Z-2'] # manual flags used by PIs to identify spikes
+minute_key_epoch = np.datetime64('2000-01-01T00:00', 'm') # origin of the integer minute keys (see get_minute_keys())
 
 def select_year(df, year):
     """ select one year of data
@@ -61,9 +70,150 @@ def select_event(df, start_date, end_date):
     out_df = df[(df['Datetime'].date > start_date) & (df['Datetime'].date < end_date)]
     return out_df
 
+def select_year_grid(grid, year):
+    """ select one year of a minute grid (see storage.open_minute_grid()) without copying data """
+    return storage.select_grid(grid, dt.datetime(year,1,1), dt.datetime(year+1,1,1))
+
+def select_month_grid(grid, year, month):
+    """ select one month of a minute grid (see storage.open_minute_grid()) without copying data """
+    end_date = dt.datetime(year+1,1,1) if month == 12 else dt.datetime(year,month+1,1)
+    return storage.select_grid(grid, dt.datetime(year,month,1), end_date)
+
+def select_event_grid(grid, start_date, end_date):
+    """ select an event of a minute grid (see storage.open_minute_grid()) without copying data, end date excluded """
+    return storage.select_grid(grid, start_date, end_date)
+
+def select_season_grid(grid, year, season):
+    """
+    select a season of a minute grid (see storage.open_minute_grid()) without copying data
+
+    Parameters
+    ----------
+    grid : dict
+        minute grid
+    year : int
+        year of the end of the season
+    season : list of int
+        first month of the season and first month after the season, e.g. [12, 3] for winter. 
+        If the first month is after the second one, the season starts in the previous year
+    """
+    if season[0]<season[1]:
+        start_date = dt.datetime(year,season[0],1)
+    else:
+        start_date = dt.datetime(year-1,season[0],1)
+    return storage.select_grid(grid, start_date, dt.datetime(year,season[1],1))
+
+def profile_to_frames(selection, valid_col):
+    """
+    convert a selection of a height profile (see fmt.read_height_profile() and storage.select_grid()) to a list of frames, 
+    one for each height with the minutes where valid_col is not NaN, as used by the plot functions of the events
+    """
+    valid = ~np.isnan(selection[valid_col])
+    cols = [col for col, values in selection.items() if col not in ('Datetime', 'heights')]
+    frames = []
+    for i in range(len(selection['heights'])):
+        frame = pd.DataFrame({col: np.asarray(selection[col][valid[:,i], i]) for col in cols})
+        frame.insert(0, 'Datetime', selection['Datetime'][valid[:,i]].astype('datetime64[ns]'))
+        frames.append(frame)
+    return frames
+
+def get_profile_hourly_means(selection, col, mask=None):
+    """
+    evaluate the hourly means of a column of a height profile selection for all the heights at once (as get_hourly_frame()
+    with the minutes of each height). The sums over each hour are taken on the contiguous minutes of the grid.
+
+    Parameters
+    ----------
+    selection : dict
+        selection of a height profile (see fmt.read_height_profile() and storage.select_grid())
+    col : str
+        column to be averaged
+    mask : 2D array of bool, optional
+        minutes to be used (e.g. non-spiked data). Default: all the minutes
+
+    Returns
+    -------
+    hourly_means : 2D array
+        mean of each hour (rows) and height (columns), NaN for hours without data
+    """
+    values = np.asarray(selection[col], dtype='float64')
+    valid = ~np.isnan(values)
+    if mask is not None:
+        valid &= mask
+    if len(values) == 0:
+        return np.empty((0, values.shape[1]))
+    hours = selection['Datetime'].astype('datetime64[h]')
+    hour_starts = np.flatnonzero(np.r_[True, hours[1:] != hours[:-1]]) # first minute of each hour
+    sums   = np.add.reduceat(np.where(valid, values, 0.), hour_starts, axis=0)
+    counts = np.add.reduceat(valid.astype('int64'), hour_starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def get_profile_stats(selection, spec):
+    """
+    evaluate the statistics of the spikes of all the heights of a height profile selection at once: number of valid 
+    (not NaN) data and of spikes, spike frequency, data coverage (fraction of the minutes of the selection) and mean of hourly means 
+    of all the data and of non-spiked data and their mean hourly difference (as get_month_freq_stats() and 
+    get_month_data_stats(), without rounding)
+
+    Parameters
+    ----------
+    selection : dict
+        selection of a height profile (see fmt.read_height_profile() and storage.select_grid())
+    spec : str
+        chemical specie
+
+    Returns
+    -------
+    profile_stats : DataFrame
+        statistics (columns) of each height (index)
+    """
+    values = selection[spec.lower()]
+    valid = ~np.isnan(values)
+    spikes = selection['spike_'+spec.lower()] & valid
+    ndata = valid.sum(axis=0)
+    nspikes = spikes.sum(axis=0)
+    hourly = get_profile_hourly_means(selection, spec.lower())
+    hourly_no_spikes = get_profile_hourly_means(selection, spec.lower(), mask=~spikes)
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning) # mean of heights without data
+        profile_stats = pd.DataFrame({'ndata':          ndata, 
+                                      'nspikes':        nspikes,
+                                      'freq':           np.where(ndata > 0, nspikes / ndata, np.nan),
+                                      'coverage':       ndata / max(len(values), 1),
+                                      'mean':           np.nanmean(hourly, axis=0),
+                                      'mean_no_spikes': np.nanmean(hourly_no_spikes, axis=0),
+                                      'mean_diff':      np.nanmean(hourly_no_spikes - hourly, axis=0)}, 
+                                     index=pd.Index(selection['heights'], name='height'))
+    return profile_stats
+
+def get_token_sets(series, sep=','):
+    """
+    factorize a column of separated codes (e.g. 'SpeciesList' or 'ManualDescriptiveFlag') and split each distinct string only once
+
+    Parameters
+    ----------
+    series : Series
+        column with strings of codes separated by sep
+    sep : str, optional
+        separator of the codes
+
+    Returns
+    -------
+    codes : array of int
+        index of the distinct string of each row (-1 for missing values)
+    token_sets : list of set
+        set of codes contained in each distinct string
+    """
+    codes, strings = pd.factorize(series) # code -1 is used for missing values
+    token_sets = [set(str(s).split(sep)) for s in strings]
+    return codes, token_sets
+
 def add_spike_cols(df, species):
     """
-    add a bool column indicating spikes for each specie
+    add a bool column indicating spikes for each specie.
+    The 'SpeciesList' column contains only a few distinct strings (e.g. 'co2', 'co2,ch4'), thus each distinct
+    string is split only once and the spike columns of all the species are obtained by indexing with the factorized codes.
 
     Parameters
     ----------
@@ -73,34 +223,261 @@ def add_spike_cols(df, species):
         list of strings with species names
 
     """
+    codes, species_sets = get_token_sets(df['SpeciesList'])
     for spec in species:
-        df.insert(len(df.columns), 'spike_'+spec.lower(), False)
-    
-    for i, row in df.iterrows():
-        spikes = df.loc[i,'SpeciesList'].split(',')
-        for spec in species:
-                if (spec.lower() in spikes):
-                    df.loc[i, 'spike_'+spec.lower()] = True
+        is_spike = np.array([spec.lower() in s for s in species_sets] + [False], dtype=bool) # last element is selected by code -1
+        df.insert(len(df.columns), 'spike_'+spec.lower(), is_spike[codes])
 
-def add_spike_cols_PIQc(df, specie):
+def add_manual_flag_cols(df, flag_codes, mode='bool', col_name='ManualDescriptiveFlag'):
+    """
+    decode the manual flags of the PIQc data files. The flag column is tokenized once (see get_token_sets())
+
+    Parameters
+    ----------
+    df : DataFrame
+        input dataframe with 'ManualDescriptiveFlag' column
+    flag_codes : list of str
+        manual flag codes to be decoded e.g. ['Z', 'Z-1', 'Z-2']
+    mode : str, optional
+        'bool' to add one bool column 'manual_flag_<code>' for each code,
+        'category' to add a single categorical column 'manual_flag' with the first code of flag_codes found in each row (NaN if none)
+    col_name : str, optional
+        name of the column with the manual flags
+
+    """
+    if mode not in ('bool', 'category'):
+        raise ValueError('unknown manual flag mode '+str(mode))
+    codes, flag_sets = get_token_sets(df[col_name])
+    if mode == 'bool':
+        for code in flag_codes:
+            has_code = np.array([code in s for s in flag_sets] + [False], dtype=bool) # last element is selected by code -1
+            df.insert(len(df.columns), 'manual_flag_'+code, has_code[codes])
+    elif mode == 'category':
+        first_code = [next((i for i, code in enumerate(flag_codes) if code in s), -1) for s in flag_sets] + [-1]
+        df.insert(len(df.columns), 'manual_flag', pd.Categorical.from_codes(np.array(first_code)[codes], categories=flag_codes))
+
+def add_spike_cols_PIQc(df, specie, flag_codes=PIQc_spike_flags):
     """
     add a bool column indicating spikes for each specie in the PIQc data files
 
     Parameters
     ----------
     df : DataFrame
-        input dataframe with 'SpeciesList' column
+        input dataframe with 'ManualDescriptiveFlag' column
     species: str
         specie 
+    flag_codes: list of str, optional
+        manual flag codes that identify a spike
 
     """  
-    df.insert(len(df.columns), 'spike_'+specie.lower()+'_PIQc', False)
+    codes, flag_sets = get_token_sets(df['ManualDescriptiveFlag'])
+    is_spike = np.array([not s.isdisjoint(flag_codes) for s in flag_sets] + [False], dtype=bool) # last element is selected by code -1
+    df.insert(len(df.columns), 'spike_'+specie.lower()+'_PIQc', is_spike[codes])
+
+
+def get_matrix_params(matrix_filename, stat, id, alg, params, spec, height):
+    """
+    get the parameters whose spikes are stored in a spike matrix file, as bool columns or in the level column of the 
+    algorithm (see fmt.write_spike_matrix()). The other parameters (e.g. added after the matrix was written) are read 
+    from their spiked files
+    """
+    columns = storage.get_columns(matrix_filename)
+    if fmt.get_level_col_name(spec, alg) in columns:
+        levels = fmt.read_matrix_levels(stat, height, spec, id)
+        if alg not in levels: # matrix written without the list of the encoded parameters
+            return list(params)
+        encoded = [float(param) for param in levels[alg]]
+        return [param for param in params if float(param) in encoded]
+    return [param for param in params if fmt.get_spike_col_name(spec, alg, param) in columns]
+
+def iter_spiked_data(stat, id, alg, params, spec, height, columns, PIQc=False, years=None, start_date=None, end_date=None):
+    """
+    iterate over the spiked data of different parameters. If the spike matrix file of the station, height and specie exists
+    (see fmt.write_spike_matrix()), it is read only once for all the parameters it stores, otherwise (and for the parameters
+    missing from the matrix) one spiked file is read for each parameter.
+    If the spike matrix stores the spikes of the algorithm as a level column, the spikes of each parameter are decoded from it.
 
-    for i, row in df.iterrows():
-        manual_flags = df.loc[i,'ManualDescriptiveFlag'].split(',')
-        if (('Z' in manual_flags)|('Z-1' in manual_flags)|('Z-2' in manual_flags)):
-            df.loc[i, 'spike_'+specie.lower()+'_PIQc'] = True
+    Parameters
+    ----------
+    stat, spec, id: str
+        details for station name, instrument id, chemical specie from the ini file
+    alg: str
+        current algorithm ('SD' or 'REBS')
+    params: list of str
+        list of parameter values
+    height: str
+        sampling height
+    columns: list of str
+        columns to be read. The spikes of each parameter are returned in the 'spike_<spec>' column
+    PIQc: bool, optional
+        read the data with PIQc spikes and amplitudes ('_spiked_PIQc_mean' or '_spike_matrix_PIQc' files)
+    years, start_date, end_date: optional
+        period to be read from year/month partitioned files (see storage.read_spiked_frame()). Data out of the
+        period can be returned and have to be masked by the caller
+
+    Yields
+    ------
+    param: str
+        parameter value
+    data: DataFrame
+        spiked data for the parameter
+    """
+    spike_col = 'spike_'+spec.lower()
+    if PIQc:
+        matrix_filename = fmt.get_spike_matrix_file_name(stat, height, spec, id, '_spike_matrix_PIQc')
+    else:
+        matrix_filename = fmt.get_spike_matrix_file_name(stat, height, spec, id)
+    matrix_params = []
+    if storage.spiked_file_exists(matrix_filename):
+        matrix_params = get_matrix_params(matrix_filename, stat, id, alg, params, spec, height)
+
+    if len(matrix_params) > 0:
+        data_cols = [col for col in columns if col != spike_col]
+        level_col = fmt.get_level_col_name(spec, alg)
+        key_cols = ['Datetime', 'InstrumentId']
+        if level_col in storage.get_columns(matrix_filename): # spikes encoded as strictest flagging parameter
+            matrix = storage.read_spiked_frame(matrix_filename, columns=list(dict.fromkeys(data_cols+key_cols+[level_col])), 
+                                               years=years, start_date=start_date, end_date=end_date)
+            exceptions = storage.read_spiked_frame(fmt.get_nesting_exceptions_file_name(stat, height, spec, id, alg))
+        else:
+            matrix = storage.read_spiked_frame(matrix_filename, # single read for all the parameters
+                                               columns=data_cols+[fmt.get_spike_col_name(spec, alg, param) for param in matrix_params],
+                                               years=years, start_date=start_date, end_date=end_date)
+    for param in params:
+        if param not in matrix_params:
+            if PIQc:
+                in_filename = fmt.get_spiked_file_name(stat, height, spec, id, alg, param, '_spiked_PIQc_mean')
+            else:
+                in_filename = fmt.get_spiked_file_name(stat, height, spec, id, alg, param)
+            yield param, storage.read_spiked_frame(in_filename, columns=columns, years=years, start_date=start_date, end_date=end_date)
+        elif level_col in matrix.columns:
+            data = matrix[data_cols].copy()
+            data[spike_col] = storage.decode_nested_flag(matrix[level_col], param, matrix[key_cols], exceptions)
+            yield param, data[columns]
+        else:
+            param_col = fmt.get_spike_col_name(spec, alg, param)
+            data = matrix[data_cols+[param_col]].rename(columns={param_col: spike_col})
+            yield param, data[columns]
 
+def iter_spiked_data_chunks(stat, id, alg, params, spec, height, columns, PIQc=False, period='M', years=None, start_date=None, end_date=None):
+    """
+    chunked version of iter_spiked_data(): the spiked data are read one month or day at a time (see storage.iter_spiked_frame()),
+    thus the memory used does not depend on the length of the files. If the spike matrix file exists, each chunk of the matrix 
+    is read once and the data of all the parameters it stores are yielded, then (or if the matrix does not exist) all the 
+    chunks of each other parameter are yielded before the next parameter.
+
+    Parameters
+    ----------
+    stat, id, alg, params, spec, height, columns, PIQc, years, start_date, end_date :
+        see iter_spiked_data()
+    period : str, optional
+        'M' (month) or 'D' (day)
+
+    Yields
+    ------
+    param: str
+        parameter value
+    data: DataFrame
+        spiked data of one period for the parameter
+    """
+    spike_col = 'spike_'+spec.lower()
+    if PIQc:
+        matrix_filename = fmt.get_spike_matrix_file_name(stat, height, spec, id, '_spike_matrix_PIQc')
+    else:
+        matrix_filename = fmt.get_spike_matrix_file_name(stat, height, spec, id)
+    matrix_params = []
+    if storage.spiked_file_exists(matrix_filename):
+        matrix_params = get_matrix_params(matrix_filename, stat, id, alg, params, spec, height)
+
+    if len(matrix_params) > 0:
+        param_cols = [fmt.get_spike_col_name(spec, alg, param) for param in matrix_params]
+        data_cols = [col for col in columns if col != spike_col]
+        level_col = fmt.get_level_col_name(spec, alg)
+        if level_col in storage.get_columns(matrix_filename): # spikes encoded as strictest flagging parameter
+            key_cols = ['Datetime', 'InstrumentId']
+            exceptions = storage.read_spiked_frame(fmt.get_nesting_exceptions_file_name(stat, height, spec, id, alg))
+            for matrix in storage.iter_spiked_frame(matrix_filename, columns=list(dict.fromkeys(data_cols+key_cols+[level_col])), 
+                                                    period=period, years=years, start_date=start_date, end_date=end_date):
+                for param in matrix_params:
+                    data = matrix[data_cols].copy()
+                    data[spike_col] = storage.decode_nested_flag(matrix[level_col], param, matrix[key_cols], exceptions)
+                    yield param, data[columns]
+        else:
+            for matrix in storage.iter_spiked_frame(matrix_filename, columns=data_cols+param_cols, 
+                                                    period=period, years=years, start_date=start_date, end_date=end_date):
+                for param, param_col in zip(matrix_params, param_cols):
+                    data = matrix[data_cols+[param_col]].rename(columns={param_col: spike_col})
+                    yield param, data[columns]
+
+    for param in params:
+        if param in matrix_params:
+            continue
+        if PIQc:
+            in_filename = fmt.get_spiked_file_name(stat, height, spec, id, alg, param, '_spiked_PIQc_mean')
+        else:
+            in_filename = fmt.get_spiked_file_name(stat, height, spec, id, alg, param)
+        for data in storage.iter_spiked_frame(in_filename, columns=columns, period=period, years=years, start_date=start_date, end_date=end_date):
+            yield param, data
+
+def get_minute_keys(datetimes):
+    """ get the int32 number of minutes from minute_key_epoch of datetime values """
+    return ((np.asarray(datetimes, dtype='datetime64[m]') - minute_key_epoch).astype('int64')).astype('int32')
+
+def get_spike_indexes(datetimes, spikes):
+    """
+    get the sparse representation of spike columns: the sorted minute keys (see get_minute_keys()) of the flagged rows.
+    Rows with repeated minutes (e.g. overlapping instruments, or the merge with PIQc data) are kept separated by their
+    occurrence number among the rows of the same minute, so that the counts on the spike indexes are equal to the
+    counts of rows and the rows of the different columns are paired as in the frame.
+
+    Parameters
+    ----------
+    datetimes : array
+        Datetime of each row
+    spikes : dict
+        bool array of each spike column, with column names as keys
+
+    Returns
+    -------
+    spike_indexes : dict
+        spike index of each column: dict with occurrence numbers as keys and sorted int32 arrays of minute keys as values
+    """
+    keys = get_minute_keys(datetimes)
+    if (keys[1:] > keys[:-1]).all(): # sorted unique minutes
+        occurrences = np.zeros(len(keys), dtype='int64')
+    else: # occurrence number of each row among the rows with the same minute, in order of appearance
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        positions = np.arange(len(keys))
+        run_starts = np.maximum.accumulate(np.where(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]], positions, 0))
+        occurrences = np.empty(len(keys), dtype='int64')
+        occurrences[order] = positions - run_starts
+    spike_indexes = {}
+    for col, flags in spikes.items():
+        flagged = np.asarray(flags, dtype=bool)
+        col_keys, col_occurrences = keys[flagged], occurrences[flagged]
+        order = np.lexsort((col_keys, col_occurrences)) # sort by occurrence and then by minute
+        col_keys, col_occurrences = col_keys[order], col_occurrences[order]
+        groups, starts = np.unique(col_occurrences, return_index=True)
+        spike_indexes[col] = {int(occ): group_keys for occ, group_keys in zip(groups, np.split(col_keys, starts[1:]))}
+    return spike_indexes
+
+def count_spike_index(spike_index):
+    """ get the number of rows of a spike index """
+    return sum(len(keys) for keys in spike_index.values())
+
+def count_spike_index_intersection(spike_index_1, spike_index_2):
+    """ get the number of rows that are in both the spike indexes (i.e. rows flagged in both the spike columns) """
+    return sum(len(np.intersect1d(keys, spike_index_2.get(occ, np.empty(0, dtype='int32')), assume_unique=True))
+               for occ, keys in spike_index_1.items())
+
+def count_spike_index_difference(spike_index_1, spike_index_2):
+    """ get the number of rows of the first spike index that are not in the second one """
+    return count_spike_index(spike_index_1) - count_spike_index_intersection(spike_index_1, spike_index_2)
+
+def count_spike_index_union(spike_index_1, spike_index_2):
+    """ get the number of rows that are in at least one of the spike indexes """
+    return count_spike_index(spike_index_1) + count_spike_index_difference(spike_index_2, spike_index_1)
 
 def get_hourly_frame(inframe, datetime_str, column_str):
     df = inframe.copy()
@@ -110,6 +487,146 @@ def get_hourly_frame(inframe, datetime_str, column_str):
     return out_frame
 
 
+def get_centered_rolling_means(datetimes, values, windows):
+    """
+    get the centered running averages of a time series for several window lengths with a single pass over the data.
+    The sums and the numbers of valid (not NaN) values are accumulated once as prefix sums, then the mean over each 
+    window is the difference of the prefix sums at the window bounds, found with a binary search on the datetimes.
+    Missing minutes are thus handled as in pandas time-based windows: the window of a value at time t is (t-w/2, t+w/2], 
+    as in Series.rolling(w, center=True).mean(), and NaN is returned for windows without valid values.
+
+    Parameters
+    ----------
+    datetimes : array-like of datetime
+        sorted times of the values (repeated times are allowed)
+    values : array-like of float
+        values of the time series
+    windows : list
+        window lengths as pandas offsets (e.g. '30min') or number of minutes
+
+    Returns
+    -------
+    means : dict of array
+        running average of each window length, with the windows as keys
+    """
+    times = np.asarray(datetimes, dtype='datetime64[ns]').astype('int64')
+    values = np.asarray(values, dtype='float64')
+    valid = ~np.isnan(values)
+    ref = values[valid].mean() if valid.any() else 0. # the prefix sums of the differences from the mean keep small values
+    sums = np.concatenate(([0.], np.cumsum(np.where(valid, values - ref, 0.))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    means = {}
+    for window in windows:
+        if isinstance(window, numbers.Number):
+            half_window = pd.Timedelta(minutes=window).value // 2
+        else:
+            half_window = pd.Timedelta(window).value // 2
+        lo = np.searchsorted(times, times - half_window, side='right')
+        hi = np.searchsorted(times, times + half_window, side='right')
+        n = counts[hi] - counts[lo]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[window] = np.where(n > 0, (sums[hi] - sums[lo]) / n + ref, np.nan)
+    return means
+
+def get_centered_rolling_quantile(datetimes, values, window, quantile=0.5):
+    """
+    get the centered running quantile (e.g. the running median) of a time series with a sliding order statistic:
+    the values of the window are kept in two heaps (the lower values in a max-heap and the higher values in a min-heap), 
+    values entering and leaving the window are inserted and lazily deleted, thus each step costs O(log w). 
+    The window of a value at time t is (t-w/2, t+w/2] and the quantile is linearly interpolated between the order 
+    statistics, as in Series.rolling(w, center=True).quantile(quantile). NaN values are excluded and NaN is returned 
+    for windows without valid values.
+
+    Parameters
+    ----------
+    datetimes : array-like of datetime
+        sorted times of the values (repeated times are allowed)
+    values : array-like of float
+        values of the time series
+    window : str or number
+        window length as pandas offset (e.g. '30min') or number of minutes
+    quantile : float, optional
+        quantile between 0 and 1. Default is the median
+
+    Returns
+    -------
+    out : array
+        running quantile of each value
+    """
+    times = np.asarray(datetimes, dtype='datetime64[ns]').astype('int64')
+    values = np.asarray(values, dtype='float64')
+    if isinstance(window, numbers.Number):
+        half_window = pd.Timedelta(minutes=window).value // 2
+    else:
+        half_window = pd.Timedelta(window).value // 2
+    starts = np.searchsorted(times, times - half_window, side='right') # first value of each window
+    ends = np.searchsorted(times, times + half_window, side='right') # last value + 1 of each window
+    if kernels.use_jit: # compiled kernel with a sorted window
+        return kernels.rolling_quantile(starts, ends, values, ~np.isnan(values), quantile)
+    starts, ends = starts.tolist(), ends.tolist()
+    valid = (~np.isnan(values)).tolist()
+    values_list = values.tolist() # python scalars are much faster than numpy scalars in the loop
+
+    low, high = [], [] # max-heap (values with changed sign) and min-heap of (value, index)
+    heap_of = [0] * len(values_list) # heap of each value: 1 low, 2 high, 0 out of the window
+    n_low, n_high = 0, 0 # number of values of the window in each heap
+    out = [np.nan] * len(values_list)
+    push, pop = heapq.heappush, heapq.heappop
+    lo, hi = 0, 0
+    for i in range(len(values_list)):
+        while hi < ends[i]: # add the values entering the window
+            if valid[hi]:
+                value = values_list[hi]
+                while low and heap_of[low[0][1]] != 1: # drop the values that left the window from the top
+                    pop(low)
+                if low and value <= -low[0][0]:
+                    push(low, (-value, hi))
+                    heap_of[hi] = 1
+                    n_low += 1
+                else:
+                    push(high, (value, hi))
+                    heap_of[hi] = 2
+                    n_high += 1
+            hi += 1
+        while lo < starts[i]: # remove the values leaving the window (lazily deleted from the heaps)
+            if heap_of[lo] == 1:
+                n_low -= 1
+            elif heap_of[lo] == 2:
+                n_high -= 1
+            heap_of[lo] = 0
+            lo += 1
+        n = n_low + n_high
+        if n == 0:
+            continue
+        position = quantile * (n - 1)
+        k = int(position) + 1 # number of values in the low heap: its top is the k-th order statistic
+        while n_low > k: # rebalance the heaps
+            while heap_of[low[0][1]] != 1:
+                pop(low)
+            value, index = pop(low)
+            push(high, (-value, index))
+            heap_of[index] = 2
+            n_low -= 1
+            n_high += 1
+        while n_low < k:
+            while heap_of[high[0][1]] != 2:
+                pop(high)
+            value, index = pop(high)
+            push(low, (-value, index))
+            heap_of[index] = 1
+            n_low += 1
+            n_high -= 1
+        while heap_of[low[0][1]] != 1:
+            pop(low)
+        lower = -low[0][0]
+        fraction = position - (k - 1)
+        if fraction > 0: # interpolate with the next order statistic
+            while heap_of[high[0][1]] != 2:
+                pop(high)
+            lower += fraction * (high[0][0] - lower)
+        out[i] = lower
+    return np.array(out)
+
 def get_daily_frame(inframe, datetime_str, column_str):
     df = inframe.copy()
     df.index = df[datetime_str]
@@ -118,6 +635,171 @@ def get_daily_frame(inframe, datetime_str, column_str):
     return out_frame
 
 
+def get_year_months(years):
+    """ get the (year, month) couples of the given years, in the order of the monthly tables columns """
+    return [(year, month) for year in years for month in range(1,13)]
+
+def compute_monthly_data(stat, id, alg, params, spec, height, year_months):
+    """
+    compute the monthly mean values of spiked and non-spiked data for different parameters (see get_monthly_data())
+
+    Parameters
+    ----------
+    stat, spec, id: str
+        details for station name, instrument id, chemical specie from the ini file
+    alg: str
+        current algorithm ('SD' or 'REBS')
+    params: list of str
+        list of parameter values
+    height: str
+         sampling height
+    year_months: list of tuple
+        (year, month) couples to be computed
+    Returns
+    -------
+    monthly_data_spiked, monthly_data_diff: 2D list of float
+        see get_monthly_data()
+    """
+    columns = ['Datetime', spec.lower(), 'spike_'+spec.lower()]
+    month_stats = get_month_stats(stat, id, alg, params, spec, height, columns, year_months, get_month_data_stats, 
+                                  frame_stats_function=get_months_data_stats)
+
+    monthly_data_spiked = []
+    monthly_data_diff = []
+    for param in params:
+        monthly_data_spiked.append([month_stats[param, year, month][1] for year, month in year_months])
+        monthly_data_diff.append(  [month_stats[param, year, month][2] for year, month in year_months])
+
+    monthly_data_spiked.append([month_stats[params[-1], year, month][0] for year, month in year_months]) # append last list with no spiked data (no selection on data['spike_'+spec.lower()]==False performed)
+    return monthly_data_spiked, monthly_data_diff
+
+def get_month_data_stats(month_frame, spec, year, month):
+    """ 
+    evaluate the mean of hourly means of all the data and of non-spiked data and the mean hourly difference 
+    between non-spiked data and all the data of one month, rounded as in the monthly tables (see compute_monthly_data())
+    """
+    month_frame_hourly = get_hourly_frame(month_frame[['Datetime', spec.lower()]],'Datetime',spec.lower()) # evaluate hourly mean
+
+    month_frame_spiked = month_frame[month_frame['spike_'+spec.lower()]==False][['Datetime', spec.lower()]] #read spiked data
+    month_frame_hourly_spiked = get_hourly_frame(month_frame_spiked, 'Datetime',spec.lower()) # evaluate hourly mean
+
+    month_frame_hourly_diff = month_frame_hourly_spiked[spec.lower()] - month_frame_hourly[spec.lower()]
+
+    return (round(month_frame_hourly[spec.lower()].mean(),4), 
+            round(month_frame_hourly_spiked[spec.lower()].mean(),4), 
+            round(month_frame_hourly_diff.mean(),4))
+
+def get_months_data_stats(data, spec, year_months):
+    """
+    evaluate the statistics of get_month_data_stats() for all the months of the spiked data with a single pass over the 
+    minutes: the minutes are grouped once by an integer hour key, with the means of all the data and of non-spiked data 
+    (spiked minutes set to NaN) computed by the same groupby. The monthly means of the hourly means and of their 
+    differences are then taken on slices of the hourly arrays. Each slice spans the same hours of the hourly frame 
+    resampled from the minutes of the month (see get_hourly_frame()), thus the results are the same of 
+    get_month_data_stats() applied to each month.
+
+    Parameters
+    ----------
+    data : DataFrame
+        spiked data with 'Datetime', specie and 'spike_<spec>' columns
+    spec : str
+        chemical specie
+    year_months: list of tuple
+        (year, month) couples to be evaluated
+
+    Returns
+    -------
+    month_stats : dict
+        mean of hourly means of all the data and of non-spiked data and mean hourly difference of each (year, month), 
+        rounded as in the monthly tables. NaN for months without data
+    """
+    month_stats = {(year, month): (np.nan, np.nan, np.nan) for year, month in year_months}
+    if len(data) == 0:
+        return month_stats
+    values = data[spec.lower()].values
+    non_spiked = (data['spike_'+spec.lower()]==False).values
+    no_spikes = values.copy()
+    no_spikes[~non_spiked] = np.nan # spiked minutes excluded from the means of non-spiked data
+    hours = data['Datetime'].values.astype('datetime64[h]').astype('int64') # hour key
+    grouped = pd.DataFrame({'all': values, 'no_spikes': no_spikes, 'non_spiked': non_spiked}).groupby(hours)
+    hourly = grouped.agg({'all': 'mean', 'no_spikes': 'mean', 'non_spiked': 'any'})
+
+    # hours without minutes are NaN as in the resampled frames
+    all_hours = np.arange(hourly.index[0], hourly.index[-1]+1)
+    has_data = np.isin(all_hours, hourly.index.values) # hours with minutes
+    has_no_spikes = np.isin(all_hours, hourly.index.values[hourly['non_spiked'].values.astype(bool)]) # hours with non-spiked minutes
+    hourly = hourly.reindex(all_hours)
+    hourly_all, hourly_no_spikes = hourly['all'].values, hourly['no_spikes'].values
+    hour_months = all_hours.astype('datetime64[h]').astype('datetime64[M]').astype('int64') # months from 1970-01
+
+    for year, month in year_months:
+        start, end = np.searchsorted(hour_months, [(year-1970)*12 + month-1, (year-1970)*12 + month])
+        data_hours = np.flatnonzero(has_data[start:end]) + start
+        if len(data_hours) == 0:
+            continue
+        month_hours = slice(data_hours[0], data_hours[-1]+1) # hours of the resampled frame of the month
+        no_spikes_hours = np.flatnonzero(has_no_spikes[start:end]) + start
+        if len(no_spikes_hours) > 0:
+            mean_no_spikes = pd.Series(hourly_no_spikes[no_spikes_hours[0]:no_spikes_hours[-1]+1]).mean()
+        else:
+            mean_no_spikes = np.nan
+        month_stats[year, month] = (round(pd.Series(hourly_all[month_hours]).mean(),4), 
+                                    round(mean_no_spikes,4), 
+                                    round(pd.Series(hourly_no_spikes[month_hours] - hourly_all[month_hours]).mean(),4))
+    return month_stats
+
+def get_month_stats(stat, id, alg, params, spec, height, columns, year_months, stats_function, frame_stats_function=None):
+    """
+    evaluate statistics of the spiked data of each parameter and month. If storage.chunk_period is set, the data are read 
+    one month at a time (see iter_spiked_data_chunks()), otherwise the whole files are read (see iter_spiked_data()).
+
+    Parameters
+    ----------
+    stat, id, alg, params, spec, height : 
+        see compute_monthly_data()
+    columns: list of str
+        columns to be read
+    year_months: list of tuple
+        (year, month) couples to be evaluated
+    stats_function : function
+        function evaluating the statistics of a month, called as stats_function(month_frame, spec, year, month)
+    frame_stats_function : function, optional
+        function evaluating the statistics of all the months at once, called as frame_stats_function(data, spec, year_months)
+        and returning the statistics of each (year, month). Used instead of stats_function when the whole files are read
+
+    Returns
+    -------
+    month_stats : dict
+        statistics of each (param, year, month)
+    """
+    month_stats = {}
+    years = sorted(set(year for year, month in year_months))
+    if storage.chunk_period is None:
+        for param, data in iter_spiked_data(stat, id, alg, params, spec, height, columns=columns, years=years): # loop over parameter values, read dataframe with spiked data
+            if frame_stats_function is not None: # single pass over the data
+                for (year, month), month_stat in frame_stats_function(data, spec, year_months).items():
+                    month_stats[param, year, month] = month_stat
+                continue
+            for year, month in year_months:
+                month_frame = data[(data['Datetime'].dt.year == year) &
+                                   (data['Datetime'].dt.month == month)]
+                month_stats[param, year, month] = stats_function(month_frame, spec, year, month)
+        return month_stats
+
+    empty_frame = None
+    for param, month_frame in iter_spiked_data_chunks(stat, id, alg, params, spec, height, columns=columns, period='M', years=years):
+        year, month = month_frame['Datetime'].iloc[0].year, month_frame['Datetime'].iloc[0].month
+        if (year, month) in year_months:
+            month_stats[param, year, month] = stats_function(month_frame, spec, year, month)
+        empty_frame = month_frame.iloc[0:0]
+    for param in params: # months without data
+        for year, month in year_months:
+            if (param, year, month) not in month_stats:
+                if empty_frame is None:
+                    empty_frame = pd.DataFrame({col: pd.Series(dtype='datetime64[ns]' if col == 'Datetime' else 'float64') for col in columns})
+                month_stats[param, year, month] = stats_function(empty_frame, spec, year, month)
+    return month_stats
+
 def get_monthly_data(stat, id, alg, params, spec, height, years):
     """
     read spiked data files and returns montly averaged frame for different parameters
@@ -152,39 +834,7 @@ def get_monthly_data(stat, id, alg, params, spec, height, years):
         print('using existing data')  
     except:
 
-        monthly_data = []
-        monthly_data_spiked = []
-        monthly_data_diff = []
-        for param in params: # loop over parameter values
-            in_filename = './data-minute-spiked/' + stat[0:3]+'/' + fmt.get_L1_file_name(stat[0:3], height, spec, id) +'_'+alg+'_'+param+ '_spiked'
-            data = pd.read_csv(in_filename, sep=';', parse_dates=['Datetime'] )  # read dataframe with spiked data
-            month_avg = []
-            month_avg_spiked = []
-            month_diff = []
-            for year in years:
-                for month in range(1,13):
-
-                    # evaluate hourly mean difference between spiked and non-spiked data
-                    month_frame = data[(data['Datetime'].dt.year == year) &
-                                          (data['Datetime'].dt.month == month)]
-                    month_frame_hourly = get_hourly_frame(month_frame,'Datetime',spec.lower()) # evaluate hourly mean
-    
-                    month_frame_spiked = data[(data['Datetime'].dt.year == year) &
-                                          (data['Datetime'].dt.month == month) &
-                                          (data['spike_'+spec.lower()]==False)][['Datetime', spec.lower()]] #read spiked data
-                    month_frame_hourly_spiked = get_hourly_frame(month_frame_spiked, 'Datetime',spec.lower()) # evaluate hourly mean
-    
-                    month_frame_hourly_diff = month_frame_hourly_spiked[spec.lower()] - month_frame_hourly[spec.lower()]
-    
-                    month_avg.append(       round(month_frame_hourly[spec.lower()].mean(),4))
-                    month_avg_spiked.append(round(month_frame_hourly_spiked[spec.lower()].mean(),4))
-                    month_diff.append(      round(month_frame_hourly_diff.mean(),4))
-    
-            #monthly_data.append(       month_avg)
-            monthly_data_spiked.append(month_avg_spiked)
-            monthly_data_diff.append(  month_diff)
-    
-        monthly_data_spiked.append(month_avg) # append last list with no spiked data (no selection on data['spike_'+spec.lower()]==False performed)
+        monthly_data_spiked, monthly_data_diff = compute_monthly_data(stat, id, alg, params, spec, height, get_year_months(years))
         
         # write results to frame
         monthly_data_frame=pd.DataFrame(monthly_data_spiked)
@@ -242,9 +892,7 @@ def get_hourly_data(stat, id, alg, params, spec, height):
         hourly_data_spiked = []
         hourly_data_diff = []
         
-        for param in params: # loop over parameter values
-            in_filename = './data-minute-spiked/' + stat[0:3]+'/' + fmt.get_L1_file_name(stat[0:3], height, spec, id) +'_'+alg+'_'+param+ '_spiked'
-            data = pd.read_csv(in_filename, sep=';', parse_dates=['Datetime'] )  # read dataframe with spiked data
+        for param, data in iter_spiked_data(stat, id, alg, params, spec, height, columns=['Datetime', spec.lower(), 'spike_'+spec.lower()]): # loop over parameter values, read dataframe with spiked data
             
             hour_frame_hourly        = get_hourly_frame(data                                    , 'Datetime',spec.lower()) # evaluate hourly mean
             hour_frame_hourly_spiked = get_hourly_frame(data[data['spike_'+spec.lower()]==False], 'Datetime',spec.lower()) # evaluate hourly mean
@@ -279,6 +927,98 @@ def get_hourly_data(stat, id, alg, params, spec, height):
     return hourly_data_spiked, hourly_data_diff
 
 
+def compute_monthly_spike_frequency(stat, id, alg, params, spec, height, year_months):
+    """
+    compute the monthly spike frequency and data coverage for different parameters (see get_monthly_spike_frequency())
+
+    Parameters
+    ----------
+    stat, spec, id: str
+        details for station name, instrument id, chemical specie from the ini file
+    alg: str
+        current algorithm ('SD' or 'REBS')
+    params: list of str
+        list of parameter values
+    height: str
+         sampling height
+    year_months: list of tuple
+        (year, month) couples to be computed
+    Returns
+    -------
+    monthly_freq, monthly_data_coverage: 2D list of float
+        monthly spike frequency and data coverage, one list for each parameter
+    """
+    columns = ['Datetime', 'spike_'+spec.lower()]
+    month_stats = get_month_stats(stat, id, alg, params, spec, height, columns, year_months, get_month_freq_stats)
+
+    monthly_freq = []
+    monthly_data_coverage = []
+    for param in params:
+        monthly_freq.append(         [month_stats[param, year, month][0] for year, month in year_months])
+        monthly_data_coverage.append([month_stats[param, year, month][1] for year, month in year_months])
+    return monthly_freq, monthly_data_coverage
+
+def get_month_freq_stats(month_frame, spec, year, month):
+    """ evaluate spike frequency and data coverage of one month, rounded as in the monthly tables (see compute_monthly_spike_frequency()) """
+    month_ndays = [31,28,31,30,31,30,31,31,30,31,30,31] # number of days of each month
+    # evaluate number of data and number of spikes for each month
+    ndata = len(month_frame)
+    nspikes= len(month_frame[month_frame['spike_'+spec.lower()]==True]) #read spiked data
+
+    if ndata > 0:
+        freq = nspikes/ndata
+    else:
+        freq = np.nan
+    return round(freq,3), round(ndata/(month_ndays[month-1]*1440),3)
+
+def update_monthly_tables(stat, id, alg, spec, height, year_months):
+    """
+    recompute only the given months of the existing monthly tables (monthly_avg_table, monthly_avg_table_diff, 
+    monthly_freq_table and monthly_coverage_table) after an incremental ingestion (see fmt.ingest_incremental()).
+    The parameters are read from the tables index, months that are not columns of a table are ignored and
+    tables that do not exist are not written (they are computed when needed by get_monthly_data() and get_monthly_spike_frequency())
+
+    Parameters
+    ----------
+    stat, spec, id: str
+        details for station name, instrument id, chemical specie from the ini file
+    alg: str
+        current algorithm ('SD' or 'REBS')
+    height: str
+         sampling height
+    year_months: list of tuple
+        (year, month) couples to be recomputed
+    """
+    tables_suffix = str(stat[0:3])+'_'+str(id)+'_'+str(alg)+'_'+str(spec)+'_h'+str(height)+'.csv'
+    avg_file, diff_file = './res_monthly_tables/monthly_avg_table_'+tables_suffix, './res_monthly_tables/monthly_avg_table_diff_'+tables_suffix
+    freq_file, cov_file = './res_monthly_tables/monthly_freq_table_'+tables_suffix, './res_monthly_tables/monthly_coverage_table_'+tables_suffix
+
+    if os.path.exists(avg_file) and os.path.exists(diff_file):
+        avg_table  = pd.read_csv(avg_file,  sep=' ', index_col=0)
+        diff_table = pd.read_csv(diff_file, sep=' ', index_col=0)
+        update_months = [(y, m) for y, m in year_months if str(m)+'-'+str(y) in avg_table.columns]
+        if len(update_months) > 0:
+            params = [par[len(alg):] for par in diff_table.index]
+            monthly_data_spiked, monthly_data_diff = compute_monthly_data(stat, id, alg, params, spec, height, update_months)
+            update_cols = [str(m)+'-'+str(y) for y, m in update_months]
+            avg_table.loc[:, update_cols]  = monthly_data_spiked
+            diff_table.loc[:, update_cols] = monthly_data_diff
+            avg_table.to_csv(avg_file,   sep=' ')
+            diff_table.to_csv(diff_file, sep=' ')
+
+    if os.path.exists(freq_file) and os.path.exists(cov_file):
+        freq_table = pd.read_csv(freq_file, sep=' ', index_col=0)
+        cov_table  = pd.read_csv(cov_file,  sep=' ', index_col=0)
+        update_months = [(y, m) for y, m in year_months if str(m)+'-'+str(y) in freq_table.columns]
+        if len(update_months) > 0:
+            params = [par[len(alg):] for par in freq_table.index]
+            monthly_freq, monthly_data_coverage = compute_monthly_spike_frequency(stat, id, alg, params, spec, height, update_months)
+            update_cols = [str(m)+'-'+str(y) for y, m in update_months]
+            freq_table.loc[:, update_cols] = monthly_freq
+            cov_table.loc[:, update_cols]  = monthly_data_coverage
+            freq_table.to_csv(freq_file, sep=' ')
+            cov_table.to_csv(cov_file,   sep=' ')
+
 def get_monthly_spike_frequency(stat, id, alg, params, spec, height, years, get_single_par_freq=False):
     """
     read spiked data files and returns monthly spike frequency frame for different parameters
@@ -322,38 +1062,7 @@ def get_monthly_spike_frequency(stat, id, alg, params, spec, height, years, get_
         #     raise Exception
     
     except:
-        monthly_freq = []
-        monthly_data_coverage = []
-
-
-        for param in params: # loop over parameter values
-
-            in_filename = './data-minute-spiked/' + stat[0:3]+'/' + fmt.get_L1_file_name(stat[0:3], height, spec, id) +'_'+alg+'_'+param+ '_spiked'
-            data = pd.read_csv(in_filename, sep=';', parse_dates=['Datetime'] )  # read dataframe with spiked data
-
-            monthly_freq_line = []
-            monthly_data_coverage_line = []
-
-            for year in years:
-                for month, ndays in zip(range(1,13), [31,28,31,30,31,30,31,31,30,31,30,31]): # zip number of days of each month
-                    # evaluate number of data and number of spikes for each month
-                    ndata = len(data[(data['Datetime'].dt.year == year) &
-                                          (data['Datetime'].dt.month == month)][spec.lower()])
-    
-                    nspikes= len(data[(data['Datetime'].dt.year == year) &
-                                          (data['Datetime'].dt.month == month) &
-                                          (data['spike_'+spec.lower()]==True)][spec.lower()]) #read spiked data
-    
-                    if ndata > 0:
-                        freq = nspikes/ndata
-                    else:
-                        freq = np.nan
-                        
-                    monthly_freq_line.append( round(freq,3))
-                    monthly_data_coverage_line.append(round(ndata/(ndays*1440),3))
-                    
-            monthly_freq.append(monthly_freq_line)
-            monthly_data_coverage.append(monthly_data_coverage_line)
+        monthly_freq, monthly_data_coverage = compute_monthly_spike_frequency(stat, id, alg, params, spec, height, get_year_months(years))
         
         monthly_data_frame=pd.DataFrame(monthly_freq)
         if stat[0:3]!='ZSF':
@@ -426,9 +1135,8 @@ def get_daily_season_data(stat, id, alg, params, spec, height,season,season_str,
             start_date = dt.datetime(years[-1]-1,season[0],1)
         end_date = dt.datetime(years[-1],season[1],1)
 
-        for param in params: # loop over parameter values
-            in_filename = './data-minute-spiked/' + stat +'/' + fmt.get_L1_file_name(stat, height, spec, id) +'_'+alg+'_'+param+ '_spiked'
-            data = pd.read_csv(in_filename, sep=';', parse_dates=['Datetime'] )  # read dataframe with spiked data
+        for param, data in iter_spiked_data(stat, id, alg, params, spec, height, columns=['Datetime', spec.lower(), 'spike_'+spec.lower()], 
+                                            start_date=start_date, end_date=end_date): # loop over parameter values, read dataframe with spiked data
             season_data = data.loc[(data['Datetime'] > start_date) &
                                 (data['Datetime'] < end_date) &
                                 (data['spike_'+spec.lower()]==False)] # read despiked data
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spike detection algorithms computed from the L1 minute data, as alternative to the results delivered by ICOS-ATC
+(./data-spikes/). The spike files are written with the layout of the delivered ones in their own tree 
+(fmt.native_spike_files_root, see fmt.write_spike_file()), thus they are read by fmt.read_spike_file() and by all 
+the analysis functions when fmt.spike_files_source is 'native'. The delivered files are never overwritten.
+The spikes of a whole list of parameters are obtained with a single pass over the data: for each minute the
+critical value of the parameter (the largest value for which the minute is a spike) is computed once, then the
+spikes of each parameter are the minutes with critical value larger than the parameter.
+"""
+import numpy as np
+import pandas as pd
+from collections import deque
+from configparser import ConfigParser
+import spikes_formatting_functions as fmt
+import spikes_storage as storage
+import spikes_kernels as kernels
+
+REBS_window = 120 # minutes of the window of the local regression of the REBS baseline, see get_REBS_baseline()
+REBS_tuning = 3.5 # robustness tuning constant of the REBS weights (in units of the residual scale)
+REBS_iterations = 10 # max number of iterations of the REBS baseline fit
+REBS_scale_minutes = 10080 # emitted minutes (one week) whose residuals give the residual scale of the online REBS, see stream_spikes()
+REBS_scale_min_minutes = 360 # emitted minutes needed before the online REBS uses their residual scale (before, the scale is estimated from the buffer)
+
+def get_previous_minute_index(datetimes, max_gap=1):
+    """
+    get the index of the previous minute of each minute of a time sorted series, -1 if the previous minute is more
+    than max_gap minutes before (or for the first minute)
+
+    Parameters
+    ----------
+    datetimes : array-like of datetime
+        sorted times of the data
+    max_gap : int, optional
+        max distance in minutes from the previous minute
+
+    Returns
+    -------
+    previous : array of int
+        index of the previous minute or -1
+    """
+    minutes = np.asarray(datetimes, dtype='datetime64[m]').astype('int64')
+    previous = np.arange(len(minutes)) - 1
+    if len(minutes) > 0:
+        previous[0] = -1
+        previous[1:][np.diff(minutes) > max_gap] = -1
+    return previous
+
+def get_SD_critical_alpha(frame, spec, max_gap=1):
+    """
+    get the critical alpha of the SD algorithm for each minute. A minute is a spike if the difference between its
+    concentration and the concentration of the previous minute is larger than alpha times the standard deviation of
+    the previous minute: |c_i - c_(i-1)| > alpha * Stdev_(i-1). The critical alpha of the minute is
+    |c_i - c_(i-1)| / Stdev_(i-1), thus the minute is a spike for all the alpha values smaller than the critical one
+    (the spikes of larger alphas are nested in the spikes of smaller alphas).
+
+    Parameters
+    ----------
+    frame : DataFrame
+        L1 minute data with 'Datetime', <spec> and 'Stdev' columns, sorted by Datetime (see fmt.read_L1_ICOS())
+    spec : str
+        chemical specie
+    max_gap : int, optional
+        max distance in minutes from the previous minute. The minutes after a longer gap are not spikes
+
+    Returns
+    -------
+    critical_alpha : array
+        critical alpha of each minute, NaN for minutes without previous minute or valid values
+    """
+    conc = frame[spec.lower()].values.astype('float64')
+    stdev = frame['Stdev'].values.astype('float64')
+    previous = get_previous_minute_index(frame['Datetime'].values, max_gap)
+    has_previous = previous >= 0
+    critical_alpha = np.full(len(conc), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        critical_alpha[has_previous] = np.abs(conc[has_previous] - conc[previous[has_previous]]) / stdev[previous[has_previous]]
+    return critical_alpha
+
+def detect_SD_spikes(frame, spec, alphas, max_gap=1):
+    """
+    detect the spikes of the SD algorithm for a list of alpha values with a single pass over the data, see get_SD_critical_alpha()
+
+    Parameters
+    ----------
+    frame : DataFrame
+        L1 minute data with 'Datetime', <spec> and 'Stdev' columns, sorted by Datetime
+    spec : str
+        chemical specie
+    alphas : list of str
+        alpha values, e.g. ['0.1', '1.0', '4.0']
+    max_gap : int, optional
+        max distance in minutes from the previous minute
+
+    Returns
+    -------
+    spikes : dict of array
+        boolean mask of the spikes for each alpha value
+    """
+    critical_alpha = get_SD_critical_alpha(frame, spec, max_gap)
+    with np.errstate(invalid='ignore'):
+        return {alpha: critical_alpha > float(alpha) for alpha in alphas}
+
+def write_SD_spike_files(stations, alphas, max_gap=1):
+    """
+    detect the spikes of the SD algorithm from the L1 data of all the heights and species of the stations and write
+    one spike file for each station, instrument and alpha value in ./data-spikes-native/SD-results/SD-<alpha>/ (fmt.native_spike_files_root), see 
+    write_spike_files() and get_SD_critical_alpha()
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    alphas : list of str
+        alpha values, e.g. ['0.1', '1.0', '4.0']
+    max_gap : int, optional
+        max distance in minutes from the previous minute, see get_SD_critical_alpha()
+    Returns
+    -------
+    None.
+    """
+    write_spike_files(stations, 'SD', alphas, lambda frame, spec, alphas: detect_SD_spikes(frame, spec, alphas, max_gap))
+
+def get_REBS_baseline(datetimes, values, window=None, tuning=None, iterations=None, sigma=None):
+    """
+    fit the REBS baseline (robust extraction of baseline signal) of a time series: local linear regression over a 
+    centered window, iterated with asymmetric robust weights, so that positive deviations (spikes) do not pull the 
+    baseline up. At each iteration the residual scale sigma is estimated from the negative residuals, which are not 
+    affected by the spikes, and the weights are 1 for negative residuals and the bisquare function of r/(tuning*sigma) 
+    for positive residuals (0 beyond tuning*sigma). 
+    The data are placed on a 1-minute grid (missing minutes have weight 0), thus the weighted sums of the local 
+    regressions are correlations with fixed kernels over the window (numpy.correlate). If the compiled kernels are 
+    available the sums are updated while the window slides over the data (see kernels.window_sums()).
+
+    Parameters
+    ----------
+    datetimes : array-like of datetime
+        sorted times of the data
+    values : array-like of float
+        concentrations
+    window : int, optional
+        window length in minutes. Default is REBS_window
+    tuning : float, optional
+        robustness tuning constant. Default is REBS_tuning
+    iterations : int, optional
+        max number of iterations. Default is REBS_iterations
+    sigma : float, optional
+        residual scale used for the weights. If None it is estimated at each iteration
+
+    Returns
+    -------
+    baseline : array
+        baseline at each time, NaN for NaN values
+    sigma : float
+        residual scale of the last iteration (or the given one)
+    """
+    window = REBS_window if window is None else window
+    tuning = REBS_tuning if tuning is None else tuning
+    iterations = REBS_iterations if iterations is None else iterations
+    minutes = np.asarray(datetimes, dtype='datetime64[m]').astype('int64')
+    values = np.asarray(values, dtype='float64')
+    valid = ~np.isnan(values)
+    baseline = np.full(len(values), np.nan)
+    if not valid.any():
+        return baseline, np.nan if sigma is None else sigma
+    cells = minutes[valid] - minutes[valid].min() # grid cell of each valid value
+    y = values[valid]
+    reference = np.median(y) # the sums are computed on the deviations from a reference, for numerical accuracy
+    y = y - reference
+    half_window = int(window) // 2
+    offsets = np.arange(-half_window, half_window+1, dtype='float64')
+    n_cells = cells.max() + 1
+
+    if kernels.use_jit:
+        starts = np.searchsorted(cells, cells - half_window, side='left')
+        ends = np.searchsorted(cells, cells + half_window, side='right')
+
+    weights = np.ones(len(y))
+    fit = np.zeros(len(y))
+    fixed_sigma = sigma
+    for iteration in range(iterations):
+        if kernels.use_jit:
+            s0, s1, s2, sy, sty = kernels.window_sums(cells, weights, y, starts, ends)
+        else:
+            grid_w = np.bincount(cells, weights=weights, minlength=n_cells) # weights of each minute (repeated minutes are summed)
+            grid_wy = np.bincount(cells, weights=weights*y, minlength=n_cells)
+            s0 = np.correlate(grid_w, np.ones(len(offsets)), 'same')[cells]
+            s1 = np.correlate(grid_w, offsets, 'same')[cells]
+            s2 = np.correlate(grid_w, offsets**2, 'same')[cells]
+            sy = np.correlate(grid_wy, np.ones(len(offsets)), 'same')[cells]
+            sty = np.correlate(grid_wy, offsets, 'same')[cells]
+        det = s0*s2 - s1**2
+        linear = det > 1e-9 * s0 * s2 # at least two distinct minutes in the window
+        new_fit = np.where(s0 > 0, sy / np.where(s0 > 0, s0, 1), np.nan) # local mean where the linear fit is not defined
+        new_fit[linear] = (s2[linear]*sy[linear] - s1[linear]*sty[linear]) / det[linear]
+        new_fit = np.where(np.isnan(new_fit), fit, new_fit) # windows without weights keep the previous fit
+        residuals = y - new_fit
+        sigma = get_REBS_scale(residuals) if fixed_sigma is None else fixed_sigma
+        converged = np.nanmax(np.abs(new_fit - fit)) < 1e-6 * max(sigma, 1e-12)
+        fit = new_fit
+        if converged or (sigma == 0):
+            break
+        u = np.clip(residuals / (tuning*sigma), 0, 1)
+        weights = np.where(residuals <= 0, 1., (1 - u**2)**2)
+    baseline[valid] = fit + reference
+    return baseline, sigma
+
+def get_REBS_scale(residuals):
+    """ get the robust scale of the REBS residuals from the negative residuals (MAD of a normal distribution from its negative half) """
+    negative = residuals[residuals < 0]
+    return 1.4826 * np.median(-negative) if len(negative) > 0 else 0.
+
+def get_REBS_critical_beta(frame, spec):
+    """
+    get the critical beta of the REBS algorithm for each minute. The baseline is fitted once (see get_REBS_baseline()) 
+    and a minute is a spike if its deviation from the baseline is larger than beta times the residual scale sigma: 
+    c_i - baseline_i > beta * sigma. The critical beta of the minute is (c_i - baseline_i) / sigma, thus the minute is 
+    a spike for all the beta values smaller than the critical one.
+
+    Parameters
+    ----------
+    frame : DataFrame
+        L1 minute data with 'Datetime' and <spec> columns, sorted by Datetime (see fmt.read_L1_ICOS())
+    spec : str
+        chemical specie
+
+    Returns
+    -------
+    critical_beta : array
+        critical beta of each minute, NaN for NaN values
+    """
+    conc = frame[spec.lower()].values.astype('float64')
+    baseline, sigma = get_REBS_baseline(frame['Datetime'].values, conc)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (conc - baseline) / sigma
+
+def detect_REBS_spikes(frame, spec, betas):
+    """
+    detect the spikes of the REBS algorithm for a list of beta values with a single baseline fit, see get_REBS_critical_beta()
+
+    Parameters
+    ----------
+    frame : DataFrame
+        L1 minute data with 'Datetime' and <spec> columns, sorted by Datetime
+    spec : str
+        chemical specie
+    betas : list of str
+        beta values, e.g. ['1', '3', '10']
+
+    Returns
+    -------
+    spikes : dict of array
+        boolean mask of the spikes for each beta value
+    """
+    critical_beta = get_REBS_critical_beta(frame, spec)
+    with np.errstate(invalid='ignore'):
+        return {beta: critical_beta > float(beta) for beta in betas}
+
+def write_REBS_spike_files(stations, betas):
+    """
+    detect the spikes of the REBS algorithm from the L1 data of all the heights and species of the stations and write
+    one spike file for each station, instrument and beta value in ./data-spikes-native/REBS-results/REBS-<beta>/ (fmt.native_spike_files_root). The baseline 
+    of each station, instrument, height and specie is fitted once for all the beta values, see write_spike_files() and 
+    get_REBS_critical_beta().
+    The detection is an approximation of the REBS results of ICOS-ATC, not a reproduction: the window (REBS_window), 
+    the tuning constant (REBS_tuning) and the single residual scale of the whole series of each station, instrument, 
+    height and specie are local choices, thus the spikes are not expected to match the delivered ones.
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    betas : list of str
+        beta values, e.g. ['1', '3', '10']
+    Returns
+    -------
+    None.
+    """
+    write_spike_files(stations, 'REBS', betas, detect_REBS_spikes)
+
+def write_spike_files(stations, method, params, detect_spikes):
+    """
+    detect the spikes from the L1 data of all the heights and species of the stations and write one spike file for 
+    each station, instrument and parameter value (see fmt.write_spike_file()). The L1 data of each instrument, height 
+    and specie are read once and the spikes of all the parameter values are detected at once (see detect_SD_spikes() 
+    and detect_REBS_spikes()).
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    method : str
+        spike detection method ('SD' or 'REBS')
+    params : list of str
+        parameter values, e.g. ['0.1', '1.0', '4.0']
+    detect_spikes : function
+        function of the L1 frame, of the specie and of the parameter values returning the boolean mask of the spikes 
+        of each parameter value, e.g. detect_SD_spikes()
+    Returns
+    -------
+    None.
+    """
+    spike_frames = {} # spikes of each station and instrument, collected over the sections of the ini file
+    config = ConfigParser()
+    for stat in stations:
+        config.read('stations.ini')
+        heights = config.get(stat, 'height' ).split(',')
+        species = config.get(stat, 'species').split(',')
+        ID      = config.get(stat, 'inst_ID').split(',')
+        stat=stat[0:3] # used to read also ini file with KIT_CO that is used to read CO data at KIT
+        for inst_id in ID:
+            for id in inst_id.split('+'): # the spike files are written for each instrument
+                frames = spike_frames.setdefault((stat, id), {param: [] for param in params})
+                for h in heights:
+                    for spec in species:
+                        print(method, stat, id, spec, h)
+                        L1_frame = fmt.read_L1_ICOS(station=stat, height=h, specie=spec, inst_ID=id)
+                        spikes = detect_spikes(L1_frame, spec, params)
+                        for param in params:
+                            frames[param].append(pd.DataFrame({'Datetime': L1_frame['Datetime'].values[spikes[param]],
+                                                               'InstrumentIds': int(id),
+                                                               'SamplingAltitude': float(h),
+                                                               'SpeciesList': spec.lower()}))
+    for (stat, id), frames in spike_frames.items():
+        for param in params:
+            fmt.write_spike_file(pd.concat(frames[param], ignore_index=True), method, param, stat, id)
+
+def stream_spikes(batches, spec, algorithms, max_gap=1):
+    """
+    online spike detection of the SD and REBS algorithms on a feed of minute data: the data are consumed one record 
+    or one small batch at a time and the spike flags of each minute are emitted with a fixed latency. The flags of 
+    the SD algorithm depend on the previous minute only, thus they are emitted with the minute (no latency). The REBS 
+    baseline of a minute needs the data of the following half window, thus with REBS the flags of the minute t are 
+    emitted when the data of the minute t + REBS_window/2 are received. The REBS residual scale is estimated from the 
+    residuals of the last REBS_scale_minutes emitted minutes, or from the buffered data until REBS_scale_min_minutes 
+    minutes are emitted. The state is bounded: one REBS window of data and the residuals used for the scale. When the 
+    feed ends the remaining minutes are emitted with the available data. The flags are those of get_SD_critical_alpha() 
+    and get_REBS_critical_beta(), the REBS flags differ from the batch ones since the residual scale is local, the 
+    batch detector uses the scale of the whole series (on two years of test data the flags agree on 98.3-99.0% of the 
+    minutes with beta = 1, 99.5-99.7% with beta = 3 and more than 99.8% with beta = 10).
+
+    Parameters
+    ----------
+    batches : iterable of DataFrame
+        time sorted L1 minute data with 'Datetime', <spec> and 'Stdev' columns (e.g. fmt.tail_L1_ICOS()), one or 
+        more minutes in each frame
+    spec : str
+        chemical specie
+    algorithms : 2D list
+        list containing algorithms names and parameters values. e.g. [['SD', '0.1', '1.0'], ['REBS', '1', '3']]
+    max_gap : int, optional
+        max distance in minutes from the previous minute of the SD algorithm, see get_SD_critical_alpha()
+
+    Yields
+    ------
+    out_frame : DataFrame
+        emitted minutes with the columns of the feed and one boolean spike column for each algorithm parameter 
+        (see fmt.get_spike_col_name())
+    """
+    use_REBS = any(algo[0] == 'REBS' for algo in algorithms)
+    latency = np.timedelta64(int(REBS_window) // 2 if use_REBS else 0, 'm')
+    half_window = np.timedelta64(int(REBS_window) // 2, 'm')
+    recent_residuals = deque(maxlen=REBS_scale_minutes) # REBS residuals of the last emitted minutes
+    buffer = None # context minutes (already emitted) followed by the minutes to be emitted
+    n_context = 0
+    batches = iter(batches)
+    while True:
+        batch = next(batches, None)
+        if (batch is None) and (buffer is None):
+            return
+        if batch is not None:
+            buffer = batch if buffer is None else pd.concat([buffer, batch], ignore_index=True)
+        times = buffer['Datetime'].values
+        if batch is not None:
+            n_ready = np.searchsorted(times, times[-1] - latency, side='right') # minutes with the data of the latency
+        else:
+            n_ready = len(buffer) # end of the feed
+        if n_ready <= n_context:
+            if batch is None:
+                return
+            continue
+
+        out_frame = buffer.iloc[n_context:n_ready].copy()
+        critical = {}
+        if any(algo[0] == 'SD' for algo in algorithms):
+            critical['SD'] = get_SD_critical_alpha(buffer, spec, max_gap)[n_context:n_ready]
+        if use_REBS:
+            conc = buffer[spec.lower()].values.astype('float64')
+            sigma = get_REBS_scale(np.array(recent_residuals)) if len(recent_residuals) >= REBS_scale_min_minutes else None
+            baseline, sigma = get_REBS_baseline(times, conc, sigma=sigma)
+            residuals = (conc - baseline)[n_context:n_ready]
+            recent_residuals.extend(residuals)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                critical['REBS'] = residuals / sigma
+        for algo in algorithms:
+            for param in algo[1:len(algo)]:
+                with np.errstate(invalid='ignore'):
+                    out_frame[fmt.get_spike_col_name(spec, algo[0], param)] = critical[algo[0]] > float(param)
+        yield out_frame
+        if batch is None:
+            return
+
+        # keep the context of the next minutes: the previous minute (SD) and the first half window (REBS)
+        n_keep = np.searchsorted(times, times[n_ready-1] - half_window, side='right') if use_REBS else n_ready - 1
+        n_keep = min(n_keep, n_ready - 1)
+        buffer = buffer.iloc[n_keep:].reset_index(drop=True)
+        n_context = n_ready - n_keep
+
+def run_online_detection(stat, h, spec, inst_id, algorithms, batches=None, follow=False, poll_interval=60., start_date=None):
+    """
+    online spike detection of one station, height, specie and instrument (see stream_spikes()): the flags of each 
+    algorithm parameter are appended to the '_spiked' files (see storage.append_spiked_frame()), so that the plots and 
+    statistics of the spiked files can be updated while the data are received. The feed is the L1 file read with 
+    fmt.tail_L1_ICOS(), that stands for the live feed.
+
+    Parameters
+    ----------
+    stat, h, spec, inst_id : str
+        station name, sampling height, chemical specie and instrument id (single instrument)
+    algorithms : 2D list
+        list containing algorithms names and parameters values. e.g. [['SD', '0.1', '1.0'], ['REBS', '1', '3']]
+    batches : iterable of DataFrame, optional
+        feed of minute data. If None the L1 file is read with fmt.tail_L1_ICOS()
+    follow : bool, optional
+        wait for new lines of the L1 file, see fmt.tail_L1_ICOS()
+    poll_interval : float, optional
+        seconds between two checks of the L1 file
+    start_date : datetime-like, optional
+        the minutes until start_date are used to initialize the detection but they are not written. If None the 
+        last minute of each existing '_spiked' file is used, so that a stopped detection can be restarted 
+    Returns
+    -------
+    None.
+    """
+    if batches is None:
+        batches = fmt.tail_L1_ICOS(stat, h, spec, inst_id, follow, poll_interval)
+    file_names = {}
+    start_dates = {} # last minute already written in each file
+    for algo in algorithms:
+        for param in algo[1:len(algo)]:
+            file_name = fmt.get_spiked_file_name(stat, h, spec, inst_id, algo[0], param)
+            file_names[algo[0], param] = file_name
+            if start_date is not None:
+                start_dates[file_name] = pd.Timestamp(start_date)
+            elif storage.spiked_file_exists(file_name):
+                start_dates[file_name] = storage.read_spiked_frame(file_name, columns=['Datetime'])['Datetime'].max()
+    for out_frame in stream_spikes(batches, spec, algorithms):
+        columns = [col for col in out_frame.columns if not col.startswith('spike_')]
+        for (alg, param), file_name in file_names.items():
+            spiked_frame = out_frame[columns].copy()
+            spiked_frame['spike_'+spec.lower()] = out_frame[fmt.get_spike_col_name(spec, alg, param)].values
+            if file_name in start_dates:
+                spiked_frame = spiked_frame[spiked_frame['Datetime'] > start_dates[file_name]]
+            if len(spiked_frame) > 0:
+                storage.append_spiked_frame(spiked_frame, file_name)
@@ -9,9 +9,19 @@ Created on Mon Oct 25 17:16:19 2021
 import pandas as pd
 from configparser import ConfigParser
 import spikes_data_selection_functions as sel
+import spikes_storage as storage
 import datetime as dt
 import numpy as np
 from os import path
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import traceback
+import hashlib
+import json
+import time
+import io
+import os
 
 analyzed_months_dict = {'PUI': ['2019-1', '2020-6'], 
                         'JUS':['2019-7','2020-3'], 
@@ -19,6 +29,24 @@ analyzed_months_dict = {'PUI': ['2019-1', '2020-6'],
                         'CMN':['2019-9','2020-8'], 
                         'IPR':['2019-4','2020-7']}
 
+invalid_flags = ['N','K','H'] # flags of the L1 data that are not valid
+L1_dtype = {'Year': 'int16', 'Month': 'int8', 'Day': 'int8', 'Hour': 'int8', 'Minute': 'int8', 'Flag': 'category'} # dtypes of the L1 data columns
+L1_chunksize = 500000 # number of lines read at once from L1 files
+
+spike_files_source = 'delivered' # spike files read by read_spike_file(): 'delivered' (ICOS-ATC results in ./data-spikes/) or 'native' (computed from the L1 data, see native_spike_files_root)
+native_spike_files_root = './data-spikes-native/' # root of the spike files computed from the L1 data (spikes_detection.py), never written in ./data-spikes/. See write_spike_file()
+spike_file_cache = OrderedDict() # partitions of the last parsed spike files. See read_spike_file_partitioned()
+spike_file_cache_size = 8     # max number of spike files kept in memory
+PIQc_cache = OrderedDict() # PIQc data of the analyzed months of the last read station/height/specie/instrument. See get_PIQc_selection()
+PIQc_cache_size = 4 # max number of PIQc selections kept in memory
+baseline_cache = OrderedDict() # baselines of the last station/height/specie/instrument, shared by all the parameters. See get_spike_baseline()
+baseline_cache_size = 4 # max number of baselines kept in memory
+baseline_quantile = None # None for the 30 min running average baseline, or quantile of the robust running baseline (e.g. 0.5 for the running median). See get_spike_baseline()
+
+duplicate_minutes_rule = 'all' # minutes reported by more instruments of '+'-joined ids: 'all', 'priority', 'mean' or 'drop' (see merge_instrument_frames())
+ingestion_manifest_file = './data-minute-spiked/ingestion_manifest.json' # inputs already processed, see ingest_incremental()
+pipeline_manifest_file = './data-minute-spiked/pipeline_manifest.json' # inputs already processed, see run_ingestion_pipeline()
+
 # IPR: APR 2019, JUL 2020, FEB 2020.
 # JFJ: APR 2019, JUL 2020, NOV 2020.
 # KIT: MAR 2019 (Inst: 489), JUL19 (Inst: 458)
@@ -93,7 +121,81 @@ def get_L1_file_name(station, height, specie, inst_ID):
 
     return file_nm
 
-def get_spike_file_path(method, param):
+def get_spiked_file_name(station, height, specie, inst_ID, alg, param, suffix='_spiked'):
+    """
+    get path and name of the minute data file with spikes
+
+    Parameters
+    ----------
+    station : str
+        station name with upper case. e.g. 'CMN', 'SAC'
+    height : str
+        sampling height above ground with one zero after the point: e.g 60.0
+    specie : str
+        chemicas specie with upper case e.g. 'CO', 'CH4'
+    inst_ID: str
+        instrument id
+    alg, param : str
+        spike detection algorithm and parameter value. e.g. alg = SD, param = 2.0
+    suffix: str, optional
+        '_spiked', '_spiked_PIQc' or '_spiked_PIQc_mean'
+    Returns
+    -------
+    file_nm: str
+        path and file name without the format extension (see spikes_storage)
+
+    """
+    file_nm = './data-minute-spiked/' + station[0:3] +'/' + get_L1_file_name(station[0:3], height, specie, inst_ID)+'_'+ alg +'_'+ param + suffix
+    return file_nm
+
+def get_spike_matrix_file_name(station, height, specie, inst_ID, suffix='_spike_matrix'):
+    """
+    get path and name of the spike matrix file, with the minute data and the spikes of all the algorithms and parameters
+
+    Parameters
+    ----------
+    station, height, specie, inst_ID : str
+        see get_L1_file_name()
+    suffix: str, optional
+        '_spike_matrix' or '_spike_matrix_PIQc'
+    Returns
+    -------
+    file_nm: str
+        path and file name without the format extension (see spikes_storage)
+
+    """
+    file_nm = './data-minute-spiked/' + station[0:3] +'/' + get_L1_file_name(station[0:3], height, specie, inst_ID) + suffix
+    return file_nm
+
+def get_minute_grid_dir_name(station, height, specie, inst_ID):
+    """ get the directory of the minute grid files of a station, height, specie and instrument (see write_minute_grid()) """
+    return './data-minute-grid/' + station[0:3] +'/' + get_L1_file_name(station[0:3], height, specie, inst_ID)
+
+def get_spike_col_name(specie, alg, param):
+    """ get name of the spike column of the spike matrix files for a given algorithm and parameter, e.g. 'spike_co2_SD_1.0' """
+    return 'spike_'+specie.lower()+'_'+alg+'_'+param
+
+def get_level_col_name(specie, alg):
+    """ get name of the column with the strictest flagging parameter of an algorithm, e.g. 'spike_co2_SD_level' """
+    return 'spike_'+specie.lower()+'_'+alg+'_level'
+
+def get_nesting_exceptions_file_name(station, height, specie, inst_ID, alg):
+    """ get path and name of the file with the minutes that break the nesting of the parameters of an algorithm (see encode_spike_matrix_levels()) """
+    return get_spike_matrix_file_name(station, height, specie, inst_ID) + '_' + alg + '_nesting_exceptions'
+
+def get_matrix_levels_file_name(station, height, specie, inst_ID):
+    """ get path and name of the file with the parameters encoded in the level columns of a spike matrix (see write_spike_matrix()) """
+    return get_spike_matrix_file_name(station, height, specie, inst_ID) + '_levels.json'
+
+def read_matrix_levels(station, height, specie, inst_ID):
+    """ read the parameters encoded in the level column of each algorithm of a spike matrix. Empty dict if the file does not exist """
+    file_name = get_matrix_levels_file_name(station, height, specie, inst_ID)
+    if not path.exists(file_name):
+        return {}
+    with open(file_name) as file:
+        return json.load(file)
+
+def get_spike_file_path(method, param, source=None):
     """
     get path to data file
 
@@ -101,12 +203,19 @@ def get_spike_file_path(method, param):
     ----------
     method, param : str
         spike detection method and parameter value. e.g. method = SD, param = 2.0
+    source : str, optional
+        'delivered' for the files of ICOS-ATC in ./data-spikes/, 'native' for the files computed from the L1 data in 
+        native_spike_files_root (same tree). If None spike_files_source is used
 
     Returns
     -------
     file path: str
 
     """
+    if source is None:
+        source = spike_files_source
+    if source not in ('delivered', 'native'):
+        raise ValueError("spike files source must be 'delivered' or 'native', not "+str(source))
     if method == 'SD':
         file_path = './data-spikes/SD-results/SD-'+param+'/'
         if param == 'current':
@@ -117,6 +226,8 @@ def get_spike_file_path(method, param):
     if param =='current':
         file_path = './data-spikes/SD-currentParameters/'
 
+    if source == 'native':
+        file_path = native_spike_files_root + file_path[len('./data-spikes/'):]
     return file_path
 
 def get_spike_file_name(station, param, method, inst_ID):
@@ -150,6 +261,146 @@ def get_spike_file_name(station, param, method, inst_ID):
         file_nm = station.upper()+'-'+inst_ID+'-'+param+'.spikes'
     return file_nm
 
+def read_L1_minute_file(file_name, ucols, dtype, converters=None):
+    """
+    read a L1 minute data file. The header and the data are read with a single file opening, the data are read
+    in chunks with compact dtypes and the data flagged as not valid are removed from each chunk before building the Datetime column
+
+    Parameters
+    ----------
+    file_name : str
+        path and name of the file
+    ucols : list of str
+        columns to be read
+    dtype : dict
+        dtype of the read columns
+    converters : dict, optional
+        converters of the read columns (see pandas.read_csv())
+
+    Returns
+    -------
+    out_frame: DataFrame
+        frame with valid data and Datetime column
+    """
+    out_frame = pd.concat(list(iter_L1_chunks(file_name, ucols, dtype, converters)))
+    for col in out_frame.columns: 
+        if dtype.get(col) == 'category': # categories may differ between chunks
+            out_frame[col] = out_frame[col].astype('category')
+    insert_datetime_col(out_frame, pos=1, Y='Year',M='Month',D='Day',h='Hour',m='Minute') # insert datetime
+    return out_frame
+
+def iter_L1_chunks(file_name, ucols, dtype, converters=None):
+    """ read a L1 minute data file L1_chunksize lines at a time and yield the data flagged as valid, see read_L1_minute_file() """
+    with open(file_name, 'r') as file:
+        skip_L1_header(file)
+        reader = pd.read_csv(file, 
+                             sep=';', 
+                             usecols=ucols,
+                             dtype=dtype,
+                             converters=converters,
+                             chunksize=L1_chunksize
+                             )
+        for chunk in reader:
+            yield chunk[~chunk['Flag'].isin(invalid_flags)] # retain only data that are flagged as valid
+
+def skip_L1_header(file):
+    """ skip the header lines of an open L1 minute file, the next line is the line with the column names """
+    for i in range(5): 
+        line = file.readline() # read the 5th line to get the header lines number
+    head_nlines = int(line.split(' ')[3]) # get the number of header lines
+    for i in range(head_nlines-1-5): # skip the remaining header lines before the column names
+        file.readline()
+
+def iter_L1_minute_file(file_name, ucols, dtype, converters=None, period='M'):
+    """
+    read a L1 minute data file in chunks with the data of a single month or day, so that only L1_chunksize lines 
+    and one period are kept in memory. See read_L1_minute_file() and storage.iter_period_chunks()
+
+    Parameters
+    ----------
+    file_name : str
+        path and name of the file
+    ucols : list of str
+        columns to be read
+    dtype : dict
+        dtype of the read columns
+    converters : dict, optional
+        converters of the read columns (see pandas.read_csv())
+    period : str, optional
+        'M' (month) or 'D' (day)
+
+    Yields
+    ------
+    out_frame: DataFrame
+        frame with valid data and Datetime column of one period
+    """
+    def iter_datetime_chunks():
+        for chunk in iter_L1_chunks(file_name, ucols, dtype, converters):
+            chunk = chunk.copy()
+            insert_datetime_col(chunk, pos=1, Y='Year',M='Month',D='Day',h='Hour',m='Minute') # insert datetime
+            yield chunk
+    for out_frame in storage.iter_period_chunks(iter_datetime_chunks(), period):
+        out_frame = out_frame.copy() # the periods are slices of the read chunks
+        for col in out_frame.columns: 
+            if dtype.get(col) == 'category': # categories may differ between chunks
+                out_frame[col] = out_frame[col].astype('category')
+        yield out_frame
+
+def iter_L1_ICOS(station, height, specie, inst_ID, period='M'):
+    """ read L1 ICOS data in chunks with the data of a single month or day, see read_L1_ICOS() and iter_L1_minute_file() """
+    file_path = get_L1_file_path(station)
+    file_name = get_L1_file_name(station, height, specie, inst_ID)
+    ucols = ['Year','Month','Day','Hour','Minute',specie.lower(),'Stdev', 'Flag', 'InstrumentId'] # cols to be read
+    dtype = dict(L1_dtype, **{specie.lower(): 'float64', 'Stdev': 'float64', 'InstrumentId': 'category'})
+    yield from iter_L1_minute_file(file_path+file_name, ucols, dtype, period=period)
+
+def tail_L1_ICOS(station, height, specie, inst_ID, follow=False, poll_interval=60., batch_bytes=65536):
+    """
+    read a L1 ICOS file that is being written (e.g. by a live feed) and yield the valid data in small batches, in the 
+    format of read_L1_ICOS(). The lines already in the file are read first, then if follow is True the file is polled 
+    for new lines (a line is read only when it is complete). 
+
+    Parameters
+    ----------
+    station, height, specie, inst_ID : str
+        see read_L1_ICOS()
+    follow : bool, optional
+        wait for new lines at the end of the file. If False the generator stops at the end of the file
+    poll_interval : float, optional
+        seconds between two checks of the end of the file
+    batch_bytes : int, optional
+        approximate size of the lines of each batch
+
+    Yields
+    ------
+    out_frame : DataFrame
+        frame with valid data and Datetime column
+    """
+    file_name = get_L1_file_path(station) + get_L1_file_name(station, height, specie, inst_ID)
+    ucols = ['Year','Month','Day','Hour','Minute',specie.lower(),'Stdev', 'Flag', 'InstrumentId'] # cols to be read
+    dtype = dict(L1_dtype, **{specie.lower(): 'float64', 'Stdev': 'float64', 'InstrumentId': 'category'})
+    with open(file_name, 'r') as file:
+        skip_L1_header(file)
+        columns_line = file.readline()
+        partial = '' # last line of the file not yet completed by the writer
+        while True:
+            lines = file.readlines(batch_bytes)
+            if len(lines) > 0:
+                lines[0] = partial + lines[0]
+                partial = '' if lines[-1].endswith('\n') else lines.pop()
+            if len(lines) == 0:
+                if follow:
+                    time.sleep(poll_interval)
+                    continue
+                if partial == '':
+                    return
+                lines, partial = [partial], ''
+            out_frame = pd.read_csv(io.StringIO(columns_line + ''.join(lines)), sep=';', usecols=ucols, dtype=dtype)
+            out_frame = out_frame[~out_frame['Flag'].isin(invalid_flags)].copy() # retain only data that are flagged as valid
+            if len(out_frame) > 0:
+                insert_datetime_col(out_frame, pos=1, Y='Year',M='Month',D='Day',h='Hour',m='Minute') # insert datetime
+                yield out_frame
+
 def read_L1_ICOS(station, height, specie, inst_ID):
     """ 
     get file path and file name and read L1 ICOS data returning a dataframe 
@@ -171,25 +422,9 @@ def read_L1_ICOS(station, height, specie, inst_ID):
     """
     file_path = get_L1_file_path(station)
     file_name = get_L1_file_name(station, height, specie, inst_ID)
-    # ####  get header nlines  ####
-    file = open(file_path+file_name, 'r')
-    for i in range(5): 
-        line = file.readline() # read the 5th line to get the header lines number
-    head_nlines = int(line.split(' ')[3]) # get the number of header lines
-    file.close()
-    # #### #### #### #### #### ####
     ucols = ['Year','Month','Day','Hour','Minute',specie.lower(),'Stdev', 'Flag', 'InstrumentId'] # cols to be read
-    out_frame = pd.read_csv(file_path+file_name, 
-                            sep=';', 
-                            skiprows = head_nlines-1,
-                            usecols=ucols
-                            )
-    insert_datetime_col(out_frame, pos=1, Y='Year',M='Month',D='Day',h='Hour',m='Minute') # insert datetime
-
-    out_frame = out_frame[(out_frame['Flag']!='N')&
-                          (out_frame['Flag']!='K')&
-                          (out_frame['Flag']!='H')] # retain only data that are flagged as valid
-
+    dtype = dict(L1_dtype, **{specie.lower(): 'float64', 'Stdev': 'float64', 'InstrumentId': 'category'})
+    out_frame = read_L1_minute_file(file_path+file_name, ucols, dtype)
     return out_frame
 
 def read_L1_ICOS_PIQc(station, height, specie, inst_ID):
@@ -213,41 +448,108 @@ def read_L1_ICOS_PIQc(station, height, specie, inst_ID):
     """
     file_path = './data-minute-spiked-PIQc/'+station + '-MinuteDataAfterPIQc/'
     file_name = get_L1_file_name(station, height, specie, inst_ID)
-    # ####  get header nlines  ####
-    file = open(file_path+file_name, 'r')
-    for i in range(5): 
-        line = file.readline() # read the 5th line to get the header lines number
-    head_nlines = int(line.split(' ')[3]) # get the number of header lines
-    file.close()
-    # #### #### #### #### #### ####
     ucols = ['Year','Month','Day','Hour','Minute','Flag','ManualDescriptiveFlag'] # cols to be read
-    out_frame = pd.read_csv(file_path+file_name, 
-                            sep=';', 
-                            skiprows = head_nlines-1,
-                            usecols=ucols,
-                            converters ={'ManualDescriptiveFlag': str}
-                            )
-    insert_datetime_col(out_frame, pos=1, Y='Year',M='Month',D='Day',h='Hour',m='Minute') # insert datetime
-
-    out_frame = out_frame[(out_frame['Flag']!='N')&
-                          (out_frame['Flag']!='K')&
-                          (out_frame['Flag']!='H')] # retain only data that are flagged as valid
-
+    out_frame = read_L1_minute_file(file_path+file_name, ucols, L1_dtype, converters ={'ManualDescriptiveFlag': str})
     return out_frame
 
-def read_spike_file(method, parameter, station, height, inst_ID):
+def read_spike_file_partitioned(method, parameter, station, inst_ID, source=None):
+    """
+    read a spike file only once and partition it by instrument ID and sampling altitude.
+    The partitions of the last parsed files are kept in memory (see spike_file_cache_size), thus the 
+    following lookups for any height/instrument of the same file do not parse the file again.
 
-    file_path = get_spike_file_path(method, parameter)
+    Parameters
+    ----------
+    method, parameter : str
+        spike detection method and parameter value. e.g. method = SD, param = 2.0
+    station : str
+        station name with upper case. e.g. 'CMN', 'SAC'
+    inst_ID: str
+        instrument id
+    source : str, optional
+        'delivered' or 'native' spike files, see get_spike_file_path(). If None spike_files_source is used
+
+    Returns
+    -------
+    partitions: dict of DataFrame
+        frames with the spikes of each (InstrumentIds, SamplingAltitude) couple
+    """
+    file_path = get_spike_file_path(method, parameter, source)
     file_name = get_spike_file_name(station, parameter, method, inst_ID)
-    ucols = ['Year','Month','Day','Hour','Minute','InstrumentIds','SamplingAltitude','SpeciesList'] # cols to be read
-    out_frame = pd.read_csv(file_path+file_name, 
+    key = file_path+file_name
+    if key in spike_file_cache:
+        spike_file_cache.move_to_end(key) # set as the most recently used file
+    else:
+        ucols = ['Year','Month','Day','Hour','Minute','InstrumentIds','SamplingAltitude','SpeciesList'] # cols to be read
+        frame = pd.read_csv(key, 
                             sep=';', 
                             usecols=ucols
                             )
-    insert_datetime_col(out_frame, pos=1, Y='Year',M='Month',D='Day',h='Hour',m='Minute') # insert datetime
-    out_frame = out_frame[out_frame['InstrumentIds']==int(inst_ID)] # select only rows relative to the instrument ID
-    out_frame = out_frame[out_frame['SamplingAltitude']==float(height)] # select only rows relative to the selected height
-    return out_frame
+        insert_datetime_col(frame, pos=1, Y='Year',M='Month',D='Day',h='Hour',m='Minute') # insert datetime
+        spike_file_cache[key] = dict(tuple(frame.groupby(['InstrumentIds','SamplingAltitude'], sort=False)))
+        if len(spike_file_cache) > spike_file_cache_size: # remove the least recently used file
+            spike_file_cache.popitem(last=False)
+    return spike_file_cache[key]
+
+def read_spike_file(method, parameter, station, height, inst_ID, source=None):
+    """
+    get the spikes of one instrument at one sampling altitude. See read_spike_file_partitioned(). The delivered spike 
+    files or those computed from the L1 data are read according to source (or spike_files_source)
+
+    Parameters
+    ----------
+    method, parameter : str
+        spike detection method and parameter value. e.g. method = SD, param = 2.0
+    station : str
+        station name with upper case. e.g. 'CMN', 'SAC'
+    height : str
+        sampling height above ground with one zero after the point: e.g 60.0
+    inst_ID: str
+        instrument id
+    source : str, optional
+        'delivered' or 'native' spike files, see get_spike_file_path(). If None spike_files_source is used
+
+    Returns
+    -------
+    out_frame: DataFrame
+        frame with the spikes of the selected instrument and height
+    """
+    partitions = read_spike_file_partitioned(method, parameter, station, inst_ID, source)
+    out_frame = partitions.get((int(inst_ID), float(height))) # select only rows relative to the instrument ID and to the selected height
+    if out_frame is None:
+        out_frame = pd.DataFrame(columns=['Datetime','InstrumentIds','SamplingAltitude','SpeciesList'])
+        out_frame['Datetime'] = pd.to_datetime(out_frame['Datetime'])
+    return out_frame.copy() # copy to avoid modifications of the cached partitions
+
+def write_spike_file(frame, method, parameter, station, inst_ID):
+    """
+    write the spikes computed from the L1 data of one instrument with the layout of the spike files of ICOS-ATC, so that 
+    they are read by read_spike_file() with source 'native'. The files are written in native_spike_files_root, the 
+    delivered files are never overwritten. The rows of the same minute, instrument and sampling altitude are joined in 
+    a single row with the ','-joined species list. The cached partitions of an old file with the same name are removed.
+
+    Parameters
+    ----------
+    frame : DataFrame
+        frame with 'Datetime', 'InstrumentIds', 'SamplingAltitude' and 'SpeciesList' columns, one specie in each row
+    method, parameter : str
+        spike detection method and parameter value. e.g. method = SD, param = 2.0
+    station : str
+        station name with upper case. e.g. 'CMN', 'SAC'
+    inst_ID: str
+        instrument id
+    """
+    file_path = get_spike_file_path(method, parameter, 'native')
+    file_name = get_spike_file_name(station, parameter, method, inst_ID)
+    out_frame = frame.groupby(['Datetime', 'InstrumentIds', 'SamplingAltitude'], as_index=False, sort=True)['SpeciesList'].agg(','.join)
+    datetimes = out_frame.pop('Datetime').dt
+    for pos, (col, values) in enumerate([('Year', datetimes.year), ('Month', datetimes.month), ('Day', datetimes.day), 
+                                         ('Hour', datetimes.hour), ('Minute', datetimes.minute)]):
+        out_frame.insert(pos, col, values)
+    out_frame.insert(len(out_frame.columns)-1, 'Site', station)
+    os.makedirs(file_path, exist_ok=True)
+    out_frame.to_csv(file_path+file_name, sep=';', index=False)
+    spike_file_cache.pop(file_path+file_name, None)
 
 def write_spiked_file(stations, alg, param):
     """
@@ -266,32 +568,597 @@ def write_spiked_file(stations, alg, param):
     None.
 
     """
+    for unit in get_spiked_file_units(stations, [[alg, param]]):
+        write_spiked_file_unit(*unit)
+
+def get_spiked_file_units(stations, algorithms):
+    """
+    get the independent units of work of write_spiked_file(): one unit for each algorithm parameter, station and instrument,
+    that writes the spiked files of all the heights and species of the instrument.
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    algorithms : 2D list
+        list containing algorithms names and parameters values. e.g. [['SD', '0.1', '1.0'], ['REBS', '1', '3']]
+    Returns
+    -------
+    units : list of tuple
+        (stat, inst_id, heights, species, alg, param) in the order of the serial processing
+    """
+    units = []
     config = ConfigParser()
-    for stat in stations:
-        config.read('stations.ini')
-        heights = config.get(stat, 'height' ).split(',')
-        species = config.get(stat, 'species').split(',')
-        ID      = config.get(stat, 'inst_ID').split(',')
-        stat=stat[0:3] # check used to read also ini file with KIT_CO that is used to read CO data at KIT. In fact CO data use different instruments and a different station has to be defined in the ini file
-        for inst_id in ID:
-            more_inst_id = inst_id.split('+') # used to read one datafile for each instrument and provide a single output file            
-           
-            for h in heights:
-                for spec in species: 
-                    out_frame=pd.DataFrame()
-                    print(stat, inst_id, alg, param, spec, h)
-                    for id in more_inst_id:  # loop over different instrument. For each instrument merge the respective spike frame, then append all the frames in a single frame
-                        spike_frame = read_spike_file(alg, param, stat.upper(), h, id)
-                        sel.add_spike_cols(spike_frame, [spec.lower()])
-                        ####### to be improved:
-                        #check_id_height(spike_frame, id, h)  
-                        tmp_frame = read_L1_ICOS(station=stat, height=h, specie=spec, inst_ID=id)
-                        tmp_frame = tmp_frame.merge(spike_frame[['Datetime','spike_'+spec.lower()]], how = 'left', on ='Datetime').fillna(False) # add spike column with True values corresponding to spikes
-                        out_frame = out_frame.append(tmp_frame) # append the last instrument frame to the dataframe
+    for algo in algorithms:
+        for param in algo[1:len(algo)]:
+            for stat in stations:
+                config.read('stations.ini')
+                heights = config.get(stat, 'height' ).split(',')
+                species = config.get(stat, 'species').split(',')
+                ID      = config.get(stat, 'inst_ID').split(',')
+                for inst_id in ID:
+                    units.append((stat[0:3], inst_id, heights, species, algo[0], param)) # stat[0:3] used to read also ini file with KIT_CO that is used to read CO data at KIT
+    return units
+
+def write_spiked_file_unit(stat, inst_id, heights, species, alg, param, manifest=None, sink=None):
+    """
+    write the spiked files of one station, instrument ('+'-joined for multiple instruments) and algorithm parameter, see write_spiked_file().
+    If the manifest of the processed inputs is given (see ingest_incremental()), the outputs with unchanged input files are 
+    skipped and only the months whose content changed are written. The digests of the months are computed in the same 
+    pass over the data that writes the output (see iter_digested_frames()), the data are read again only when months 
+    are removed from the inputs and the whole file is rewritten.
+    If a sink is given the spiked data are passed to it instead of being written on the '_spiked' files: the sink is called
+    as sink(out_filename, frames, stat, inst_id, h, spec), with frames the whole spiked data in a list or one frame for each 
+    period if storage.chunk_period is set, and returns the name of the file it writes (None if nothing is written). 
+    With the manifest, the sink output is recorded as 'output' and is computed again when the input files changed 
+    (see run_ingestion_pipeline()).
+
+    Returns
+    -------
+    entries : dict
+        manifest entries of the outputs with the 'changed' months ('YYYY-MM'). None if manifest is None
+    """
+    more_inst_id = inst_id.split('+') # used to read one datafile for each instrument and provide a single output file            
+    entries = {}
+    file_infos = {} # size and checksum of the input files, evaluated once
+   
+    for h in heights:
+        spike_frames = {}
+        for spec in species: 
+            out_filename = get_spiked_file_name(stat, h, spec, inst_id, alg, param)
+            if manifest is not None:
+                input_files = [get_spike_file_path(alg, param)+get_spike_file_name(stat.upper(), param, alg, id) for id in more_inst_id]
+                input_files+= [get_L1_file_path(stat)+get_L1_file_name(stat, h, spec, id) for id in more_inst_id]
+                inputs = {}
+                for file_name in input_files:
+                    if file_name not in file_infos:
+                        file_infos[file_name] = get_file_info(file_name)
+                    inputs[file_name] = file_infos[file_name]
+                entry = manifest.get(out_filename)
+                output = out_filename if entry is None else entry.get('output', out_filename) # file written by the unit or the sink
+                if (entry is not None) and (entry['inputs'] == inputs) and ((output is None) or storage.spiked_file_exists(output)):
+                    print(stat, inst_id, alg, param, spec, h, 'inputs not changed')
+                    entries[out_filename] = dict(entry, changed=[])
+                    continue
+
+            if len(spike_frames) == 0:
+                for id in more_inst_id: # read the spike frame of each instrument only once and add the spike columns of all the species
+                    spike_frames[id] = read_spike_file(alg, param, stat.upper(), h, id)
+                    sel.add_spike_cols(spike_frames[id], [spec.lower() for spec in species])
+            print(stat, inst_id, alg, param, spec, h)
+            if storage.chunk_period is None:
+                L1_frames = {}
+                for id in more_inst_id:  # loop over different instrument. For each instrument merge the respective spike frame, then merge all the frames in a single frame
+                    ####### to be improved:
+                    #check_id_height(spike_frame, id, h)  
+                    L1_frames[id] = read_L1_ICOS(station=stat, height=h, specie=spec, inst_ID=id)
+                out_frame = get_spiked_frame(L1_frames, spike_frames, spec)
+                iter_out_frames = lambda: [out_frame]
+                write_out_frames = lambda frames: [storage.write_spiked_frame(frame, out_filename) for frame in frames] # write "spiked" dataframe on file
+            else: # read and write one period at a time
+                iter_out_frames = lambda: iter_spiked_unit_frames(stat, more_inst_id, h, spec, spike_frames, storage.chunk_period)
+                write_out_frames = lambda frames: storage.write_spiked_chunks(frames, out_filename)
+            if sink is not None:
+                write_out_frames = lambda frames: sink(out_filename, frames, stat, inst_id, h, spec)
+
+            if manifest is None:
+                write_out_frames(iter_out_frames())
+                continue
+
+            md5s, bounds = {}, [None, None]
+            old_digests = manifest[out_filename]['months'] if out_filename in manifest else {}
+            rewrite = (sink is not None) or (len(old_digests) == 0) or (not storage.spiked_file_exists(out_filename))
+            if rewrite: # the whole output is written while the digests are computed
+                output = write_out_frames(iter_digested_frames(iter_out_frames(), md5s, bounds))
+            else: # only the rows of the changed months are kept
+                changed_frames = []
+                for frame in iter_digested_frames(iter_out_frames(), md5s, bounds, old_digests, changed_frames):
+                    pass
+            digests = {month: md5s[month].hexdigest() for month in md5s}
+            changed = [month for month in digests if old_digests.get(month) != digests[month]]
+            removed = [month for month in old_digests if month not in digests]
+            if sink is not None:
+                changed = sorted(set(changed) | set(removed))
+            elif rewrite:
+                changed = sorted(set(digests) | set(old_digests))
+            elif len(removed) > 0:
+                write_out_frames(iter_out_frames()) # months removed: the data are read again to rewrite the whole file
+                changed = sorted(set(digests) | set(old_digests))
+            elif len(changed_frames) > 0:
+                storage.update_spiked_frame(pd.concat(changed_frames), out_filename)
+            print(stat, inst_id, alg, param, spec, h, 'changed months:', changed)
+            entries[out_filename] = {'inputs': inputs, 'months': digests, 'changed': changed,
+                                     'start': str(bounds[0]), 'end': str(bounds[1])}
+            if sink is not None:
+                entries[out_filename]['output'] = output
+    if manifest is None:
+        return None
+    return entries
+
+def get_spiked_frame(L1_frames, spike_frames, spec):
+    """ 
+    get the spiked data of one height and specie: the L1 data of each instrument (dict of frames in the order of the 
+    '+'-joined id) merged with the spike column of the instrument, then merged in a single frame, see write_spiked_file_unit() 
+    """
+    return merge_instrument_frames([merge_spike_col(L1_frames[id], spike_frames[id], spec) for id in L1_frames])
+
+def merge_spike_col(L1_frame, spike_frame, spec):
+    """ add to the L1 data of one instrument the spike column with True values corresponding to spikes, see write_spiked_file() """
+    out_frame = L1_frame.merge(spike_frame[['Datetime','spike_'+spec.lower()]], how = 'left', on ='Datetime') 
+    out_frame['spike_'+spec.lower()] = out_frame['spike_'+spec.lower()].fillna(False).astype(bool)
+    return out_frame
+
+def merge_instrument_frames(frames, rule=None):
+    """
+    k-way merge of the time-sorted frames of the instruments of a '+'-joined instrument id. The output position of each 
+    row is computed from the Datetimes of the other frames (numpy.searchsorted) and each column is written directly 
+    in the output array, without concatenating and sorting the frames (columns with pandas extension dtypes, e.g. the 
+    strings of pandas >= 3, are concatenated and taken in the output order). Minutes with the same Datetime in more frames
+    are resolved with the rule:
+        'all': all the rows are kept, ordered as the frames (same result of a stable sort of the concatenated frames)
+        'priority': only the row of the first frame reporting the minute is kept (frames are in priority order)
+        'mean': one row for each minute with the mean of the float columns over the frames reporting the minute 
+                (NaN excluded) and the other columns of the first frame reporting it
+        'drop': the minutes reported by more frames are removed
+    Repeated Datetimes within one frame are not modified.
+
+    Parameters
+    ----------
+    frames : list of DataFrame
+        frames with 'Datetime' column and the same columns, in priority order. Unsorted frames are sorted first
+    rule : str, optional
+        'all', 'priority', 'mean' or 'drop'. If None duplicate_minutes_rule is used
+    Returns
+    -------
+    out_frame : DataFrame
+        merged frame sorted by Datetime, with RangeIndex
+    """
+    if rule is None:
+        rule = duplicate_minutes_rule
+    if rule not in ('all', 'priority', 'mean', 'drop'):
+        raise ValueError('unknown duplicate minutes rule '+str(rule))
+    frames = [frame if frame['Datetime'].is_monotonic_increasing else frame.sort_values(by='Datetime', kind='stable') for frame in frames]
+    times = [frame['Datetime'].values for frame in frames]
+
+    keep = [np.ones(len(t), dtype=bool) for t in times]
+    matches = {} # (i, k): rows of frame i with a minute of frame k and row of frame k with the first match
+    if rule != 'all':
+        for i in range(len(frames)):
+            for k in range(len(frames)):
+                if (k != i) and (len(times[k]) > 0):
+                    pos = np.searchsorted(times[k], times[i])
+                    found = times[k][np.minimum(pos, len(times[k])-1)] == times[i]
+                    matches[i, k] = (np.flatnonzero(found), pos[found])
+                    if (rule == 'drop') or (k < i): # minute already reported by a frame with higher priority
+                        keep[i][found] = False
+    kept_times = [t[mask] for t, mask in zip(times, keep)]
+
+    positions = [] # position of the kept rows in the output
+    for i, t in enumerate(kept_times):
+        pos = np.arange(len(t))
+        for k, other in enumerate(kept_times):
+            if k != i: # rows of the frames with higher priority are placed before the equal minutes
+                pos += np.searchsorted(other, t, side='right' if k < i else 'left')
+        positions.append(pos)
+    n_out = sum(len(t) for t in kept_times)
+
+    out_frame = pd.DataFrame(index=pd.RangeIndex(n_out))
+    for col in frames[0].columns:
+        values = [frame[col].values[mask] for frame, mask in zip(frames, keep)]
+        if any(isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames):
+            categories = pd.Index(sorted(set().union(*[frame[col].dropna().unique() for frame in frames])))
+            codes = np.empty(n_out, dtype=np.int32)
+            for pos, val in zip(positions, values):
+                codes[pos] = pd.Categorical(val, categories=categories).codes
+            out_frame[col] = pd.Categorical.from_codes(codes, categories)
+            continue
+        if any(not isinstance(frame[col].dtype, np.dtype) for frame in frames): # pandas extension dtypes (e.g. strings) are gathered by pandas
+            order = np.empty(n_out, dtype=np.int64)
+            order[np.concatenate(positions)] = np.arange(n_out) # row of the concatenated kept rows at each output position
+            kept_values = pd.concat([frame[col][mask] for frame, mask in zip(frames, keep)], ignore_index=True)
+            out_frame[col] = kept_values.take(order).values
+            continue
+        out_values = np.empty(n_out, dtype=np.result_type(*[frame[col].dtype for frame in frames]))
+        for pos, val in zip(positions, values):
+            out_values[pos] = val
+        if (rule == 'mean') and (out_values.dtype.kind == 'f'):
+            total = np.zeros(n_out)
+            count = np.zeros(n_out)
+            for i, frame in enumerate(frames):
+                col_values = frame[col].values
+                own = np.flatnonzero(keep[i]) # rows of frame i in the output
+                valid = ~np.isnan(col_values[own])
+                np.add.at(total, positions[i][valid], col_values[own][valid])
+                np.add.at(count, positions[i][valid], 1)
+                for k in range(i+1, len(frames)): # values of the lower priority frames reporting the same minutes
+                    if (i, k) in matches:
+                        rows_i, rows_k = matches[i, k]
+                        rows_i_out = np.searchsorted(own, rows_i) # rows_i are kept rows of frame i
+                        other_values = frames[k][col].values[rows_k]
+                        valid = ~np.isnan(other_values) & keep[i][rows_i]
+                        np.add.at(total, positions[i][rows_i_out[valid]], other_values[valid])
+                        np.add.at(count, positions[i][rows_i_out[valid]], 1)
+            with np.errstate(invalid='ignore'):
+                out_values = (total / count).astype(out_values.dtype)
+        out_frame[col] = out_values
+    return out_frame
+
+def iter_spiked_unit_frames(stat, more_inst_id, h, spec, spike_frames, period='M'):
+    """
+    chunked version of the spiked data of write_spiked_file_unit(): the L1 data of the instruments are read one month 
+    or day at a time (see iter_L1_ICOS()), merged with the spike columns and sorted, thus the memory used is bounded by 
+    one period of data of each instrument.
+
+    Parameters
+    ----------
+    stat : str
+        station name
+    more_inst_id : list of str
+        instruments ids
+    h, spec : str
+        sampling height and specie
+    spike_frames : dict of DataFrame
+        spike frames of the instruments with the spike columns (see sel.add_spike_cols())
+    period : str, optional
+        'M' (month) or 'D' (day)
+
+    Yields
+    ------
+    out_frame : DataFrame
+        spiked data of one period sorted by Datetime
+    """
+    readers = [iter_L1_ICOS(stat, h, spec, id, period) for id in more_inst_id]
+    heads = [next(reader, None) for reader in readers] # current period of each instrument
+    get_period = lambda frame: frame['Datetime'].values[0].astype('datetime64['+period+']')
+    while any(head is not None for head in heads):
+        current = min(get_period(head) for head in heads if head is not None)
+        frames = []
+        for i, id in enumerate(more_inst_id):
+            if (heads[i] is not None) and (get_period(heads[i]) == current):
+                frames.append(merge_spike_col(heads[i], spike_frames[id], spec))
+                heads[i] = next(readers[i], None)
+        yield merge_instrument_frames(frames)
+
+def get_file_info(file_name):
+    """ get size and md5 checksum of a file, used to detect changed input files """
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            md5.update(block)
+    return {'size': os.path.getsize(file_name), 'checksum': md5.hexdigest()}
+
+def update_monthly_digests(md5s, frame):
+    """ 
+    update the digest of the content of each month ('YYYY-MM') with the rows of a frame with 'Datetime' column, used to detect 
+    changed months. The digests of consecutive chunks of a frame are the same of the whole frame.
+
+    Parameters
+    ----------
+    md5s : dict
+        hashlib md5 objects of the months, updated in place
+    frame : DataFrame
+        frame with 'Datetime' column
+    """
+    row_hashes = pd.util.hash_pandas_object(frame, index=False).values
+    months = frame['Datetime'].dt.strftime('%Y-%m').values
+    for month in np.unique(months):
+        md5s.setdefault(month, hashlib.md5()).update(row_hashes[months == month].tobytes())
+
+def iter_digested_frames(frames, md5s, bounds, old_digests=None, changed_frames=None):
+    """
+    yield the frames of an output of write_spiked_file_unit() updating the digests of the months (see update_monthly_digests())
+    and the first and last Datetime, so that the digests are computed in the same pass that writes the output.
+
+    Parameters
+    ----------
+    frames : iterable of DataFrame
+        time sorted frames with 'Datetime' column
+    md5s : dict
+        hashlib md5 objects of the months, updated in place
+    bounds : list
+        first and last Datetime of the frames ([None, None] before the first frame), updated in place
+    old_digests : dict, optional
+        digests of the months of the previous run, used with changed_frames
+    changed_frames : list, optional
+        the rows of each month are appended when the month is complete, if its digest differs from old_digests
+    """
+    pending = {} # rows of the months that are not complete
+    def collect(month):
+        rows = pending.pop(month)
+        if old_digests.get(month) != md5s[month].hexdigest():
+            changed_frames.extend(rows)
+    for frame in frames:
+        if len(frame) > 0:
+            update_monthly_digests(md5s, frame)
+            bounds[0] = frame['Datetime'].min() if bounds[0] is None else min(bounds[0], frame['Datetime'].min())
+            bounds[1] = frame['Datetime'].max() if bounds[1] is None else max(bounds[1], frame['Datetime'].max())
+            if changed_frames is not None:
+                months = frame['Datetime'].dt.strftime('%Y-%m').values
+                for month in np.unique(months):
+                    pending.setdefault(month, []).append(frame[months == month])
+                for month in [month for month in pending if month < months[0]]: # the previous months are complete
+                    collect(month)
+        yield frame
+    for month in list(pending):
+        collect(month)
+
+def read_ingestion_manifest(manifest_file=None):
+    """ read the manifest of the processed inputs (see ingest_incremental()). Empty manifest if the file does not exist """
+    if manifest_file is None:
+        manifest_file = ingestion_manifest_file
+    if not path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as file:
+        return json.load(file)
+
+def write_ingestion_manifest(manifest, manifest_file=None):
+    """ write the manifest of the processed inputs. The file is replaced only when completely written """
+    if manifest_file is None:
+        manifest_file = ingestion_manifest_file
+    os.makedirs(path.dirname(manifest_file), exist_ok=True)
+    with open(manifest_file+'.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(manifest_file+'.tmp', manifest_file)
+
+def init_ingestion_worker(file_format, partitioned_layout, chunk_period=None, minutes_rule='all', quantile=None, spikes_source='delivered'):
+    """ set in the worker processes the storage and processing options of the main process """
+    global duplicate_minutes_rule, baseline_quantile, spike_files_source
+    storage.spiked_file_format = file_format
+    storage.partitioned_layout = partitioned_layout
+    storage.chunk_period = chunk_period
+    duplicate_minutes_rule = minutes_rule
+    baseline_quantile = quantile
+    spike_files_source = spikes_source
+
+def run_ingestion_unit(unit, manifest=None, sink=None):
+    """ run one unit of write_spiked_file() and return (result, error traceback) instead of raising errors (error is None if no errors) """
+    try:
+        return write_spiked_file_unit(*unit, manifest=manifest, sink=sink), None
+    except Exception:
+        return None, traceback.format_exc()
+
+def run_ingestion_units(units, workers=None, manifest=None, sink=None):
+    """
+    run units of write_spiked_file() over a pool of processes, see write_spiked_files_parallel(). 
+    The sink (see write_spiked_file_unit()) has to be a module level function to be sent to the worker processes
+
+    Returns
+    -------
+    results : list of tuple
+        (result, error traceback) of each unit, in the order of units
+    """
+    if workers == 1:
+        return [run_ingestion_unit(unit, manifest, sink) for unit in units]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_ingestion_worker, 
+                             initargs=(storage.spiked_file_format, storage.partitioned_layout, storage.chunk_period,
+                                       duplicate_minutes_rule, baseline_quantile, spike_files_source)) as executor:
+        futures = [executor.submit(run_ingestion_unit, unit, manifest, sink) for unit in units]
+        for future in futures: # collected in submission order
+            try:
+                results.append(future.result())
+            except Exception: # the worker process died (e.g. out of memory)
+                results.append((None, traceback.format_exc()))
+    return results
+
+def report_ingestion_failures(units, results):
+    """ print the summary of the ingestion and return the (unit, error traceback) of the failed units """
+    failures = [(unit, error) for unit, (result, error) in zip(units, results) if error is not None]
+    print('ingestion:', len(units)-len(failures), 'units done,', len(failures), 'failed')
+    for unit, error in failures:
+        print('FAILED', unit[0], unit[1], unit[4], unit[5], '\n', error)
+    return failures
+
+def write_spiked_files_parallel(stations, algorithms, workers=None):
+    """
+    write the spiked files of all the stations and algorithm parameters (see write_spiked_file()) fanning out the independent 
+    units (see get_spiked_file_units()) over a pool of processes. Each unit writes its own files, thus the results do not 
+    depend on the number of workers nor on the execution order. A unit that fails is reported and does not stop the other units.
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    algorithms : 2D list
+        list containing algorithms names and parameters values. e.g. [['SD', '0.1', '1.0'], ['REBS', '1', '3']]
+    workers : int, optional
+        number of worker processes. If None the number of CPUs is used, if 1 the units are processed serially in this process
+    Returns
+    -------
+    failures : list of tuple
+        (unit, error traceback) of the failed units, in the order of get_spiked_file_units()
+    """
+    units = get_spiked_file_units(stations, algorithms)
+    results = run_ingestion_units(units, workers)
+    return report_ingestion_failures(units, results)
+
+def ingest_incremental(stations, algorithms, years, workers=1, manifest_file=None):
+    """
+    incremental version of write_spiked_file(), add_PIQc_column() and add_PIQc_high_spikes_column(). A manifest records for each 
+    output the size and checksum of its input files (L1 minute data and .spikes files) and a digest of each month of data.
+    Outputs with unchanged inputs are skipped, for the other outputs only the months whose content changed are replaced.
+    The PIQc files are rewritten when analyzed months or PIQc input files changed and the existing monthly tables are 
+    recomputed only for the changed months (see sel.update_monthly_tables()).
 
-                    out_frame.sort_values(by='Datetime', inplace=True)
-                    out_filename = './data-minute-spiked/' + stat +'/' + get_L1_file_name(stat, h, spec, inst_id)+'_'+ alg +'_'+ param + '_spiked' # write "spiked" dataframe on file
-                    out_frame.to_csv(out_filename, sep=';', index=False)
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    algorithms : 2D list
+        list containing algorithms names and parameters values. e.g. [['SD', '0.1', '1.0'], ['REBS', '1', '3']]
+    years : list of int
+        years of the monthly tables
+    workers : int, optional
+        number of worker processes, see write_spiked_files_parallel()
+    manifest_file : str, optional
+        path of the manifest. If None ingestion_manifest_file is used
+    Returns
+    -------
+    failures : list of tuple
+        (unit, error traceback) of the failed units. Failed units are not recorded in the manifest and are processed again at the next run
+    """
+    manifest = read_ingestion_manifest(manifest_file)
+    units = get_spiked_file_units(stations, algorithms)
+    results = run_ingestion_units(units, workers, manifest)
+    changed_tables = {}
+    for (stat, inst_id, heights, species, alg, param), (entries, error) in zip(units, results):
+        if error is not None:
+            continue
+        for h in heights:
+            for spec in species:
+                out_filename = get_spiked_file_name(stat, h, spec, inst_id, alg, param)
+                entry = entries[out_filename]
+                changed = entry.pop('changed')
+                manifest[out_filename] = entry
+                if len(changed) > 0:
+                    changed_tables.setdefault((stat, inst_id, alg, spec, h), set()).update(changed)
+                if stat in analyzed_months_dict: # PIQc data are available only for the analyzed months
+                    update_PIQc_files(manifest, stat, inst_id, h, spec, alg, param, changed)
+    write_ingestion_manifest(manifest, manifest_file)
+
+    for (stat, inst_id, alg, spec, h), months in changed_tables.items():
+        year_months = [(int(month[0:4]), int(month[5:7])) for month in sorted(months) if int(month[0:4]) in years]
+        if len(year_months) > 0:
+            print('updating monthly tables', stat, inst_id, alg, spec, h, sorted(months))
+            sel.update_monthly_tables(stat, inst_id, alg, spec, h, year_months)
+    return report_ingestion_failures(units, results)
+
+def update_PIQc_files(manifest, stat, inst_id, h, spec, alg, param, changed):
+    """
+    rewrite the '_spiked_PIQc' and '_spiked_PIQc_mean' files of one output of ingest_incremental() if the analyzed months changed, 
+    if the PIQc input files changed or if the files do not exist. The manifest entry of the PIQc file is updated.
+    """
+    out_filename = get_spiked_file_name(stat, h, spec, inst_id, alg, param, '_spiked_PIQc')
+    file_path = './data-minute-spiked-PIQc/'+stat + '-MinuteDataAfterPIQc/'
+    inputs = {file_path+get_L1_file_name(stat, h, spec, id): get_file_info(file_path+get_L1_file_name(stat, h, spec, id)) for id in inst_id.split('+')}
+    analyzed_months = [interval.left.strftime('%Y-%m') for interval in get_analyzed_months_index(stat)]
+    entry = manifest.get(out_filename)
+    if ((entry is None) or (entry['inputs'] != inputs) or (len(set(changed) & set(analyzed_months)) > 0) 
+        or (not storage.spiked_file_exists(out_filename)) or (not storage.spiked_file_exists(out_filename+'_mean'))):
+        write_PIQc_file(stat, inst_id, h, spec, alg, param)
+        if storage.spiked_file_exists(out_filename):
+            write_PIQc_mean_file(stat, inst_id, h, spec, alg, param)
+        manifest[out_filename] = {'inputs': inputs}
+
+def get_analyzed_months_index(stat):
+    """
+    get the analyzed months of a station (see analyzed_months_dict) as an interval index. The PUI 06/2020 interval is 
+    limited to the first 14 days.
+
+    Parameters
+    ----------
+    stat : str
+        station name
+    Returns
+    -------
+    intervals : IntervalIndex
+        sorted [month start, month end) intervals of the analyzed months
+    """
+    bounds = []
+    for month_str in analyzed_months_dict[stat]:
+        start = pd.Timestamp(dt.datetime.strptime(month_str, '%Y-%m'))
+        end = start + pd.offsets.MonthBegin(1)
+        if (stat=='PUI') & (start.year==2020) & (start.month==6):
+            end = start + pd.Timedelta(days=14) # reducing PUI 06/2020 days
+        bounds.append((start, end))
+    return pd.IntervalIndex.from_tuples(sorted(bounds), closed='left')
+
+def in_intervals(datetimes, intervals):
+    """ get the mask of the datetimes inside sorted and not overlapping intervals, with a binary search of the interval of each datetime """
+    datetimes = np.asarray(datetimes, dtype='datetime64[ns]')
+    pos = np.searchsorted(intervals.left.values, datetimes, side='right') - 1 # last interval starting before each datetime
+    inside = pos >= 0
+    inside[inside] = datetimes[inside] < intervals.right.values[pos[inside]]
+    return inside
+
+def get_PIQc_selection(stat, h, spec, inst_id):
+    """
+    read the minute data after PIQc of the analyzed months (see get_analyzed_months_index()) and add the column with the 
+    spikes detected by PIs. The data are read and decoded once: the selections of the last PIQc_cache_size 
+    station/height/specie/instrument are kept in memory and are returned to the following calls.
+
+    Parameters
+    ----------
+    stat, spec, inst_id: str
+        details for station name, chemical specie and instrument id ('+'-joined for multiple instruments) from the ini file
+    h: str
+        sampling height
+    Returns
+    -------
+    frame_PIQc_sel: DataFrame
+        frame with 'spike_<spec>_PIQc' column, not to be modified. Empty frame if no data are found in the analyzed months
+    """
+    file_path = './data-minute-spiked-PIQc/'+stat + '-MinuteDataAfterPIQc/'
+    file_names = [file_path+get_L1_file_name(stat, h, spec, id) for id in inst_id.split('+')]
+    key = (stat, h, spec, inst_id, duplicate_minutes_rule) + tuple(os.path.getmtime(file_name) for file_name in file_names)
+    if key in PIQc_cache:
+        PIQc_cache.move_to_end(key) # set as the most recently used selection
+        return PIQc_cache[key]
+
+    intervals = get_analyzed_months_index(stat)
+    inst_frames = []
+    for id in inst_id.split('+'):  # read from multiple instrument stations
+        inst_frame = read_L1_ICOS_PIQc(station=stat, height=h, specie=spec, inst_ID=id)
+        inst_frames.append(inst_frame[in_intervals(inst_frame['Datetime'], intervals)]) # select only analyzed months
+    frame_PIQc_sel = merge_instrument_frames(inst_frames)
+
+    if len(frame_PIQc_sel) > 0: 
+        sel.add_spike_cols_PIQc(frame_PIQc_sel, spec)
+    PIQc_cache[key] = frame_PIQc_sel
+    if len(PIQc_cache) > PIQc_cache_size: # remove the least recently used selection
+        PIQc_cache.popitem(last=False)
+    return frame_PIQc_sel
+
+def join_on_minutes(left, right, columns):
+    """
+    inner join of the columns of right to left on the minute of 'Datetime', same result of 
+    left.merge(right[['Datetime']+columns], on='Datetime', how='inner') for minute data. The Datetimes are converted 
+    to integer minute keys (see sel.get_minute_keys()) and the rows of right are found with a binary search.
+
+    Parameters
+    ----------
+    left, right : DataFrame
+        frames with 'Datetime' column
+    columns : list of str
+        columns of right to be added
+    Returns
+    -------
+    out_frame : DataFrame
+        rows of left (in the order of left) with a matching minute in right, repeated for each matching row of right
+    """
+    left_keys = sel.get_minute_keys(left['Datetime'])
+    right_keys = sel.get_minute_keys(right['Datetime'])
+    order = np.argsort(right_keys, kind='stable')
+    sorted_keys = right_keys[order]
+    lo = np.searchsorted(sorted_keys, left_keys, side='left')
+    counts = np.searchsorted(sorted_keys, left_keys, side='right') - lo # matching rows of each row of left
+    left_idx = np.repeat(np.arange(len(left)), counts)
+    offsets = np.arange(len(left_idx)) - np.repeat(np.cumsum(counts) - counts, counts) # position among the matches
+    right_idx = order[np.repeat(lo, counts) + offsets]
+    out_frame = left.iloc[left_idx].reset_index(drop=True)
+    for col in columns:
+        out_frame[col] = right[col].values[right_idx]
+    return out_frame
 
 def add_PIQc_column(stations, alg, param):
     """
@@ -321,42 +1188,65 @@ def add_PIQc_column(stations, alg, param):
             for h in heights:
                 for spec in species: 
                     print(stat, inst_id, alg, param, spec, h)
-                    frame_spiked=pd.DataFrame()
-                    #for id in more_inst_id:
-                    infile_spiked = './data-minute-spiked/' + stat +'/' + get_L1_file_name(stat, h, spec, inst_id)+'_'+ alg +'_'+ param + '_spiked' # write "spiked" dataframe on file
-                    frame_spiked = frame_spiked.append(pd.read_csv(infile_spiked, sep=';'))
-
-                    frame_spiked['Datetime'] = pd.to_datetime(frame_spiked['Datetime'])
-                    frame_PIQc_sel = pd.DataFrame()
-                    if not path.exists(infile_spiked + '_PIQc'): # avoid reprocessing already processed data
-                        analyzed_months = analyzed_months_dict[stat]
-
-                        frame_PIQc = pd.DataFrame() 
-
-                        for id in more_inst_id:  # read from multiple instrument stations
-                            frame_PIQc = frame_PIQc.append(read_L1_ICOS_PIQc(station=stat, height=h, specie=spec, inst_ID=id))
-                        frame_PIQc.sort_values(by='Datetime', inplace=True)
-
-                        for month_str in analyzed_months: # select only analyzed months
-                            year  = int(month_str.split('-')[0])
-                            month = int(month_str.split('-')[1])
-                            month_frame = frame_PIQc[(frame_PIQc['Datetime'].dt.year == year) & 
-                                                     (frame_PIQc['Datetime'].dt.month == month)]
-                            if (stat=='PUI') & (year==2020) & (month==6):
-                               print('reducing PUI 06/2020 days')
-                               month_frame = month_frame[month_frame['Datetime'].dt.day < 15]
-                            frame_PIQc_sel=frame_PIQc_sel.append(month_frame, ignore_index=True)
-
-                        if len(frame_PIQc_sel) > 0: 
-                            sel.add_spike_cols_PIQc(frame_PIQc_sel, spec)
-                            frame_double_spiked = frame_spiked.merge(frame_PIQc_sel[['Datetime', 'spike_'+spec.lower()+'_PIQc']], on='Datetime', how ='inner')
-                            out_filename = infile_spiked + '_PIQc'
-                            frame_double_spiked.to_csv(out_filename, sep=';', index=False)
-                        else:
-                            print('no data found')
+                    infile_spiked = get_spiked_file_name(stat, h, spec, inst_id, alg, param)
+                    if not storage.spiked_file_exists(infile_spiked + '_PIQc'): # avoid reprocessing already processed data
+                        write_PIQc_file(stat, inst_id, h, spec, alg, param)
                     else:
                         print('data already processed')
 
+def add_PIQc_columns(stations, algorithms):
+    """
+    add the column with the results of spike detection by PIs to the spiked data of all the algorithms parameters,
+    see add_PIQc_column(). The PIQc data of each station, height and specie are decoded once for all the parameters.
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    algorithms : 2D list
+        list containing algorithms names and parameters values. e.g. [['SD', '0.1', '1.0'], ['REBS', '1', '3']]
+    Returns
+    -------
+    None.
+    """
+    config = ConfigParser()
+    for stat in stations:
+        config.read('stations.ini')
+        heights = config.get(stat, 'height' ).split(',')
+        species = config.get(stat, 'species').split(',')
+        ID      = config.get(stat, 'inst_ID').split(',')
+        stat=stat[0:3] # used to read also ini file with KIT_CO that is used to read CO data at KIT. In fact CO data use different instruments and a different station has to be defined in the ini file
+        for inst_id in ID:
+            for h in heights:
+                for spec in species: 
+                    for algo in algorithms:
+                        for param in algo[1:len(algo)]:
+                            print(stat, inst_id, algo[0], param, spec, h)
+                            infile_spiked = get_spiked_file_name(stat, h, spec, inst_id, algo[0], param)
+                            if not storage.spiked_file_exists(infile_spiked + '_PIQc'): # avoid reprocessing already processed data
+                                write_PIQc_file(stat, inst_id, h, spec, algo[0], param)
+                            else:
+                                print('data already processed')
+
+def write_PIQc_file(stat, inst_id, h, spec, alg, param):
+    """ write the '_spiked_PIQc' file of one station, instrument, height, specie and algorithm parameter, see add_PIQc_column() """
+    infile_spiked = get_spiked_file_name(stat, h, spec, inst_id, alg, param)
+    frame_spiked = storage.read_spiked_frame(infile_spiked)
+    frame_double_spiked = get_PIQc_frame(frame_spiked, stat, inst_id, h, spec)
+
+    if frame_double_spiked is not None: 
+        out_filename = infile_spiked + '_PIQc'
+        storage.write_spiked_frame(frame_double_spiked, out_filename)
+    else:
+        print('no data found')
+
+def get_PIQc_frame(frame_spiked, stat, inst_id, h, spec):
+    """ get the spiked data of the analyzed months with the column of the spikes detected by PIs, None if no PIQc data are found. See add_PIQc_column() """
+    frame_PIQc_sel = get_PIQc_selection(stat, h, spec, inst_id)
+    if len(frame_PIQc_sel) == 0:
+        return None
+    return join_on_minutes(frame_spiked, frame_PIQc_sel, ['spike_'+spec.lower()+'_PIQc'])
+
 def add_PIQc_high_spikes_column(stations, alg, param):
     """
     add the column with the "high" spikes detected by PIs. high spikes are defined according to the difference respect to the baseline
@@ -386,17 +1276,439 @@ def add_PIQc_high_spikes_column(stations, alg, param):
             for h in heights:
                 for spec in species: 
                     print(stat, inst_id, alg, param, spec, h)
-                    #for id in more_inst_id:
-                    infile_spiked = './data-minute-spiked/' + stat +'/' + get_L1_file_name(stat, h, spec, inst_id)+'_'+ alg +'_'+ param + '_spiked_PIQc'
-                    frame_spiked = pd.read_csv(infile_spiked, sep=';')
-                    frame_spiked['Datetime'] = pd.to_datetime(frame_spiked['Datetime'])
-                    frame_spiked = frame_spiked.set_index('Datetime')
-                    frame_spiked.insert(len(frame_spiked.columns),spec.lower()+'_rolling_mean', round(frame_spiked[spec.lower()].rolling('30min', center=True).mean(),3) )
-                    frame_spiked.insert(len(frame_spiked.columns),'spike_amplitude_'+spec.lower()+'_PIQc', np.nan)
-                    frame_spiked['spike_amplitude_'+spec.lower()+'_PIQc'] = frame_spiked[spec.lower()] - frame_spiked[spec.lower()+'_rolling_mean']
-                    frame_spiked.loc[ frame_spiked['spike_'+spec.lower()+'_PIQc']==False, 'spike_amplitude_'+spec.lower()+'_PIQc'] = 0
-
-                    frame_spiked.to_csv(infile_spiked+'_mean',sep=';')
+                    write_PIQc_mean_file(stat, inst_id, h, spec, alg, param)
+
+def add_PIQc_high_spikes_columns(stations, algorithms):
+    """
+    add the column with the "high" spikes detected by PIs to the data of all the algorithms parameters, see 
+    add_PIQc_high_spikes_column(). The baseline of each station, height and specie is computed once for all the parameters.
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    algorithms : 2D list
+        list containing algorithms names and parameters values. e.g. [['SD', '0.1', '1.0'], ['REBS', '1', '3']]
+    Returns
+    -------
+    None.
+    """
+    config = ConfigParser()
+    for stat in stations:
+        config.read('stations.ini')
+        heights = config.get(stat, 'height' ).split(',')
+        species = config.get(stat, 'species').split(',')
+        ID      = config.get(stat, 'inst_ID').split(',')
+        stat=stat[0:3] # used to read also ini file with KIT_CO that is used to read CO data at KIT. In fact CO data use different instruments and a different station has to be defined in the ini file
+        for inst_id in ID:
+            for h in heights:
+                for spec in species: 
+                    for algo in algorithms:
+                        for param in algo[1:len(algo)]:
+                            print(stat, inst_id, algo[0], param, spec, h)
+                            write_PIQc_mean_file(stat, inst_id, h, spec, algo[0], param)
+
+def write_PIQc_mean_file(stat, inst_id, h, spec, alg, param):
+    """ write the '_spiked_PIQc_mean' file (and its spike index) of one station, instrument, height, specie and algorithm parameter, see add_PIQc_high_spikes_column() """
+    infile_spiked = get_spiked_file_name(stat, h, spec, inst_id, alg, param, '_spiked_PIQc')
+    frame_spiked = storage.read_spiked_frame(infile_spiked)
+    frame_spiked = get_PIQc_mean_frame(frame_spiked, spec, key=(stat, h, spec, inst_id))
+
+    storage.write_spiked_frame(frame_spiked, infile_spiked+'_mean', index=True)
+    write_PIQc_spike_index(frame_spiked, infile_spiked+'_mean', spec)
+
+def write_PIQc_spike_index(frame_spiked, file_name, spec):
+    """
+    write next to a '_spiked_PIQc_mean' file the sparse spike indexes of the automatic and PIQc spikes (see sel.get_spike_indexes()),
+    used to count the contingency table without reading the file (see stats.get_contingency_counts_index())
+
+    Parameters
+    ----------
+    frame_spiked : DataFrame
+        PIQc spiked data with Datetime index, see get_PIQc_mean_frame()
+    file_name : str
+        name of the '_spiked_PIQc_mean' file
+    spec : str
+        chemical specie
+    """
+    spike_cols = ['spike_'+spec.lower(), 'spike_'+spec.lower()+'_PIQc']
+    spike_indexes = sel.get_spike_indexes(frame_spiked.index.values, {col: frame_spiked[col].values for col in spike_cols})
+    storage.write_spike_index(spike_indexes, len(frame_spiked), file_name)
+
+def get_PIQc_mean_frame(frame_spiked, spec, key=None):
+    """ get the PIQc spiked data with Datetime index, baseline and spike amplitude columns, see add_spike_amplitude_col() """
+    frame_spiked = frame_spiked.set_index('Datetime')
+    add_spike_amplitude_col(frame_spiked, spec, key)
+    return frame_spiked
+
+def add_spike_amplitude_col(frame_spiked, spec, key=None):
+    """
+    add the baseline (30 min centered running average or running quantile, see get_spike_baseline()) and the amplitude of the spikes detected by PIs respect to the baseline.
+    The amplitude is set to 0 for data that are not flagged as spikes by PIs
+
+    Parameters
+    ----------
+    frame_spiked : DataFrame
+        frame with Datetime index and 'spike_<spec>_PIQc' column
+    spec : str
+        chemical specie
+    key : tuple, optional
+        key of the baseline cache (e.g. station, height, specie, instrument), see get_spike_baseline()
+    """
+    frame_spiked.insert(len(frame_spiked.columns),spec.lower()+'_rolling_mean', get_spike_baseline(frame_spiked, spec, key))
+    frame_spiked.insert(len(frame_spiked.columns),'spike_amplitude_'+spec.lower()+'_PIQc', np.nan)
+    frame_spiked['spike_amplitude_'+spec.lower()+'_PIQc'] = frame_spiked[spec.lower()] - frame_spiked[spec.lower()+'_rolling_mean']
+    frame_spiked.loc[ frame_spiked['spike_'+spec.lower()+'_PIQc']==False, 'spike_amplitude_'+spec.lower()+'_PIQc'] = 0
+
+def get_spike_baseline(frame_spiked, spec, key=None):
+    """
+    get the baseline of the concentration (30 min centered running average rounded to 3 decimals) of a frame with Datetime index.
+    If baseline_quantile is set the running quantile is used instead (e.g. the running median, which is not pulled upward 
+    by the spikes themselves), see sel.get_centered_rolling_quantile(). The concentrations are the same in the files of all the algorithm parameters, thus if key is given the baseline is kept 
+    in memory and reused for the following frames with the same Datetimes and concentrations.
+
+    Parameters
+    ----------
+    frame_spiked : DataFrame
+        frame with Datetime index and <spec> column
+    spec : str
+        chemical specie
+    key : tuple, optional
+        key of the baseline cache. If None the baseline is not cached
+    Returns
+    -------
+    baseline : array
+        baseline of each row of the frame
+    """
+    times = frame_spiked.index.values
+    values = frame_spiked[spec.lower()].values
+    if key is not None:
+        key = key + (baseline_quantile,)
+    if key in baseline_cache:
+        cached_times, cached_values, baseline = baseline_cache[key]
+        if np.array_equal(cached_times, times) and np.array_equal(cached_values, values, equal_nan=True):
+            baseline_cache.move_to_end(key) # set as the most recently used baseline
+            return baseline
+    if baseline_quantile is None:
+        baseline = round(frame_spiked[spec.lower()].rolling('30min', center=True).mean(),3).values
+    else:
+        baseline = np.round(sel.get_centered_rolling_quantile(times, values, '30min', baseline_quantile), 3)
+    if key is not None:
+        baseline_cache[key] = (times, values, baseline)
+        if len(baseline_cache) > baseline_cache_size: # remove the least recently used baseline
+            baseline_cache.popitem(last=False)
+    return baseline
+
+def write_pipeline_files(out_filename, frames, stat, inst_id, h, spec, intermediates=False):
+    """
+    sink of write_spiked_file_unit() used by run_ingestion_pipeline(): get in memory the PIQc spikes (see get_PIQc_frame()) 
+    and the spike amplitudes (see get_PIQc_mean_frame()) of the spiked data and write the '_spiked_PIQc_mean' file and
+    its spike index (see write_PIQc_spike_index()).
+    Only the rows of the analyzed months of each frame are kept in memory.
+
+    Parameters
+    ----------
+    out_filename : str
+        name of the '_spiked' file, see get_spiked_file_name()
+    frames : iterable of DataFrame
+        spiked data, whole or one frame for each period (see storage.chunk_period)
+    stat, inst_id, h, spec : str
+        station, instrument id ('+'-joined for multiple instruments), height and specie of the spiked data
+    intermediates : bool, optional
+        write also the '_spiked' and '_spiked_PIQc' files
+    Returns
+    -------
+    file_name : str
+        name of the written '_spiked_PIQc_mean' file, None if no PIQc data are found
+    """
+    intervals = get_analyzed_months_index(stat)
+    analyzed_frames = []
+    def keep_analyzed(frames): # yield the frames keeping the rows of the analyzed months
+        for frame in frames:
+            analyzed_frames.append(frame[in_intervals(frame['Datetime'], intervals)])
+            yield frame
+    if not intermediates:
+        analyzed_frames = [frame[in_intervals(frame['Datetime'], intervals)] for frame in frames]
+    elif storage.chunk_period is None:
+        for frame in keep_analyzed(frames):
+            storage.write_spiked_frame(frame, out_filename)
+    else:
+        storage.write_spiked_chunks(keep_analyzed(frames), out_filename)
+
+    frame = get_PIQc_frame(pd.concat(analyzed_frames, ignore_index=True), stat, inst_id, h, spec)
+    if frame is None:
+        print('no data found')
+        return None
+    if intermediates:
+        storage.write_spiked_frame(frame, out_filename+'_PIQc')
+    frame = get_PIQc_mean_frame(frame, spec, key=(stat, h, spec, inst_id))
+    storage.write_spiked_frame(frame, out_filename+'_PIQc_mean', index=True)
+    write_PIQc_spike_index(frame, out_filename+'_PIQc_mean', spec)
+    return out_filename+'_PIQc_mean'
+
+def run_ingestion_pipeline(stations, algorithms, intermediates=False, compare=False, workers=1, incremental=False, manifest_file=None):
+    """
+    write the '_spiked_PIQc_mean' files chaining in memory the three ingestion stages: spiked data (write_spiked_file()), 
+    PIQc spikes (add_PIQc_column()) and spike amplitudes (add_PIQc_high_spikes_column()), without writing the '_spiked' 
+    and '_spiked_PIQc' files and reading them back. The units of write_spiked_file_unit() are run with write_pipeline_files() 
+    as sink, thus storage.chunk_period, the pool of processes and the manifest of the processed inputs are used as in 
+    write_spiked_files_parallel() and ingest_incremental(). The outputs are the same of the three stages.
+    The time of each station is printed and returned. With compare=True the three stages are run before the pipeline 
+    and the difference of the two times is reported.
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    algorithms : 2D list
+        list containing algorithms names and parameters values. e.g. [['SD', '0.1', '1.0'], ['REBS', '1', '3']]
+    intermediates : bool, optional
+        write also the '_spiked' and '_spiked_PIQc' files
+    compare : bool, optional
+        run also the three stages and measure the time saved
+    workers : int, optional
+        number of worker processes, see write_spiked_files_parallel()
+    incremental : bool, optional
+        skip the outputs with unchanged inputs and record the processed inputs in the manifest (see ingest_incremental())
+    manifest_file : str, optional
+        path of the manifest. If None pipeline_manifest_file is used
+    Returns
+    -------
+    report : DataFrame
+        'pipeline' time, 'staged' time and time 'saved' by the pipeline for each station, in seconds ('staged' and 'saved' are NaN if not compare)
+    """
+    if manifest_file is None:
+        manifest_file = pipeline_manifest_file
+    manifest = read_ingestion_manifest(manifest_file) if incremental else None
+    sink = partial(write_pipeline_files, intermediates=intermediates)
+    report = []
+    for stat in stations:
+        units = get_spiked_file_units([stat], algorithms)
+        staged_time = np.nan
+        if compare:
+            start = time.perf_counter()
+            report_ingestion_failures(units, run_ingestion_units(units, workers))
+            add_PIQc_columns([stat], algorithms)
+            add_PIQc_high_spikes_columns([stat], algorithms)
+            staged_time = time.perf_counter() - start
+        start = time.perf_counter()
+        results = run_ingestion_units(units, workers, manifest, sink)
+        pipeline_time = time.perf_counter() - start
+        if incremental:
+            for entries, error in results:
+                if error is None:
+                    for out_filename, entry in entries.items():
+                        entry.pop('changed')
+                        manifest[out_filename] = entry
+            write_ingestion_manifest(manifest, manifest_file)
+        report_ingestion_failures(units, results)
+        print(stat[0:3], 'pipeline time: %.1f s' % pipeline_time + ('' if not compare else ', staged time: %.1f s, time saved: %.1f s' % (staged_time, staged_time - pipeline_time)))
+        report.append([stat[0:3], pipeline_time, staged_time, staged_time - pipeline_time])
+    return pd.DataFrame(report, columns=['station', 'pipeline', 'staged', 'saved']).set_index('station')
+
+def write_spike_matrix(stations, algorithms, nested=False):
+    """
+    write one "spike matrix" file for each station, height and specie. The minute data are written only once, 
+    followed by one bool column for each algorithm and parameter (see get_spike_col_name()).
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    algorithms : 2D list
+        list containing algorithms names and parameters values. e.g. [['SD', '0.1', '1.0'], ['REBS', '1', '3']]
+    nested : bool, optional
+        replace the bool columns of each algorithm with a single level column (see encode_spike_matrix_levels())
+    Returns
+    -------
+    None.
+    """
+    config = ConfigParser()
+    for stat in stations:
+        config.read('stations.ini')
+        heights = config.get(stat, 'height' ).split(',')
+        species = config.get(stat, 'species').split(',')
+        ID      = config.get(stat, 'inst_ID').split(',')
+        stat=stat[0:3] # used to read also ini file with KIT_CO that is used to read CO data at KIT. In fact CO data use different instruments and a different station has to be defined in the ini file
+        for inst_id in ID:
+            more_inst_id = inst_id.split('+') # used to read one datafile for each instrument and provide a single output file            
+            for h in heights:
+                spike_frames = {} # spike frames of each instrument, algorithm and parameter
+                for id in more_inst_id:
+                    for algo in algorithms:
+                        for param in algo[1:len(algo)]:
+                            spike_frames[id, algo[0], param] = read_spike_file(algo[0], param, stat.upper(), h, id)
+                            sel.add_spike_cols(spike_frames[id, algo[0], param], [spec.lower() for spec in species])
+                for spec in species: 
+                    print(stat, inst_id, 'spike matrix', spec, h)
+                    inst_frames = []
+                    for id in more_inst_id: # the minute data of each instrument are read only once
+                        tmp_frame = read_L1_ICOS(station=stat, height=h, specie=spec, inst_ID=id)
+                        for algo in algorithms:
+                            for param in algo[1:len(algo)]:
+                                spike_frame = spike_frames[id, algo[0], param]
+                                spike_times = spike_frame.loc[spike_frame['spike_'+spec.lower()], 'Datetime']
+                                tmp_frame[get_spike_col_name(spec, algo[0], param)] = tmp_frame['Datetime'].isin(spike_times)
+                        inst_frames.append(tmp_frame)
+                    out_frame = merge_instrument_frames(inst_frames)
+                    if nested:
+                        exceptions = encode_spike_matrix_levels(out_frame, spec, algorithms)
+                        for alg in exceptions:
+                            print(alg, 'minutes breaking the nesting:', len(exceptions[alg]))
+                            storage.write_spiked_frame(exceptions[alg], get_nesting_exceptions_file_name(stat, h, spec, inst_id, alg))
+                        with open(get_matrix_levels_file_name(stat, h, spec, inst_id), 'w') as file: # parameters that can be decoded
+                            json.dump({algo[0]: algo[1:len(algo)] for algo in algorithms}, file)
+                    storage.write_spiked_frame(out_frame, get_spike_matrix_file_name(stat, h, spec, inst_id))
+
+def encode_spike_matrix_levels(frame, spec, algorithms):
+    """
+    replace the spike columns of each algorithm in a spike matrix frame with a single level column, with the 
+    strictest parameter that flags each minute (see storage.encode_nested_flags()).
+
+    Parameters
+    ----------
+    frame : DataFrame
+        spike matrix frame, modified in place
+    spec : str
+        chemical specie
+    algorithms : 2D list
+        list containing algorithms names and parameters values
+    Returns
+    -------
+    exceptions : dict of DataFrame
+        for each algorithm, frame with 'Datetime', 'InstrumentId' and 'param' of the minutes that break the nesting
+    """
+    exceptions = {}
+    for algo in algorithms:
+        alg, params = algo[0], algo[1:len(algo)]
+        param_cols = [get_spike_col_name(spec, alg, param) for param in params]
+        level, exc_rows, exc_params = storage.encode_nested_flags(frame[param_cols].values, params)
+        frame.drop(columns=param_cols, inplace=True)
+        frame[get_level_col_name(spec, alg)] = level
+        exceptions[alg] = pd.DataFrame({'Datetime': frame['Datetime'].values[exc_rows], 
+                                        'InstrumentId': np.asarray(frame['InstrumentId'])[exc_rows], 
+                                        'param': exc_params})
+    return exceptions
+
+def write_minute_grid(stations, algorithms):
+    """
+    write the minute data and the spikes of all the algorithms and parameters on a fixed 1-minute grid for each station, 
+    height and specie (see storage.write_minute_grid()). The spikes are read from the spike matrix or spiked files.
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    algorithms : 2D list
+        list containing algorithms names and parameters values. e.g. [['SD', '0.1', '1.0'], ['REBS', '1', '3']]
+    Returns
+    -------
+    None.
+    """
+    config = ConfigParser()
+    for stat in stations:
+        config.read('stations.ini')
+        heights = config.get(stat, 'height' ).split(',')
+        species = config.get(stat, 'species').split(',')
+        ID      = config.get(stat, 'inst_ID').split(',')
+        stat=stat[0:3]
+        for inst_id in ID:
+            for h in heights:
+                for spec in species:
+                    print(stat, inst_id, 'minute grid', spec, h)
+                    grid_frame = None
+                    for algo in algorithms:
+                        for param, frame in sel.iter_spiked_data(stat, inst_id, algo[0], algo[1:len(algo)], spec, h, 
+                                                                 columns=['Datetime', spec.lower(), 'Stdev', 'spike_'+spec.lower()]):
+                            if grid_frame is None:
+                                grid_frame = frame[['Datetime', spec.lower(), 'Stdev']].reset_index(drop=True)
+                            elif not np.array_equal(grid_frame['Datetime'].values, frame['Datetime'].values):
+                                raise ValueError('different minutes in the spiked data of '+stat+' '+spec+' '+algo[0]+' '+param)
+                            grid_frame[get_spike_col_name(spec, algo[0], param)] = frame['spike_'+spec.lower()].values.astype(bool)
+                    storage.write_minute_grid(grid_frame, get_minute_grid_dir_name(stat, h, spec, inst_id), 
+                                              [col for col in grid_frame.columns if col != 'Datetime'])
+
+def read_height_profile(stat, heights, spec, inst_id, alg, param, columns=None, PIQc=False):
+    """
+    read the spiked data of all the sampling heights of a station and specie and align them on one 1-minute grid as 
+    2D arrays (time x height), so that the selections (e.g. sel.select_event_grid()) and the statistics of all the 
+    heights (e.g. sel.get_profile_stats()) are single numpy operations. The grid index is the number of minutes from
+    the grid epoch, as in storage.write_minute_grid(): missing minutes are NaN for float columns and False for bool 
+    columns, and when more rows of a height have the same minute the first one is kept.
+
+    Parameters
+    ----------
+    stat, spec, inst_id: str
+        details for station name, chemical specie and instrument id from the ini file
+    heights: list of str
+        sampling heights, in the order of the columns of the arrays
+    alg, param: str
+        algorithm ('SD' or 'REBS') and parameter value of the spikes
+    columns: list of str, optional
+        numeric or bool columns to be read. Default: concentration, Stdev and spikes ('spike_<spec>')
+    PIQc: bool, optional
+        read the data with PIQc spikes and amplitudes (see sel.iter_spiked_data())
+
+    Returns
+    -------
+    profile : dict
+        2D array of each column with column names as keys, the grid 'epoch' (datetime64[m]) and the 'heights'
+    """
+    if columns is None:
+        columns = [spec.lower(), 'Stdev', 'spike_'+spec.lower()]
+    columns = [col for col in columns if col != 'Datetime']
+    frames = [next(sel.iter_spiked_data(stat, inst_id, alg, [param], spec, h, ['Datetime']+columns, PIQc=PIQc))[1] for h in heights]
+    minutes = [frame['Datetime'].values.astype('datetime64[m]') for frame in frames]
+    if all(len(m)==0 for m in minutes):
+        raise ValueError('no data for '+stat+' '+spec+' '+alg+' '+param+' at heights '+','.join(heights))
+    epoch = storage.get_grid_epoch([m.min() for m in minutes if len(m)>0])
+    rows = [storage.get_grid_rows(m, epoch) for m in minutes]
+    length = max(int(offsets[-1]) + 1 for offsets, _ in rows if len(offsets)>0)
+
+    profile = {'epoch': epoch, 'heights': list(heights)}
+    for col in columns:
+        if all(frame[col].dtype == bool for frame in frames):
+            values = np.zeros((length, len(heights)), dtype=bool)
+        else:
+            values = np.full((length, len(heights)), np.nan)
+        for i, (frame, (offsets, first_rows)) in enumerate(zip(frames, rows)):
+            values[offsets, i] = frame[col].values[first_rows]
+        profile[col] = values
+    return profile
+
+def add_PIQc_spike_matrix(stations):
+    """
+    add the columns with the spikes detected by PIs and with their amplitude to the spike matrix files (see write_spike_matrix())
+    and write them on the '_spike_matrix_PIQc' files. 
+
+    Parameters
+    ----------
+    stations : list
+        list of string containing the stations names in upper case.
+    Returns
+    -------
+    None.
+    """
+    config = ConfigParser()
+    for stat in stations:
+        config.read('stations.ini')
+        heights = config.get(stat, 'height' ).split(',')
+        species = config.get(stat, 'species').split(',')
+        ID      = config.get(stat, 'inst_ID').split(',')
+        stat=stat[0:3] # used to read also ini file with KIT_CO that is used to read CO data at KIT. In fact CO data use different instruments and a different station has to be defined in the ini file
+        for inst_id in ID:
+            for h in heights:
+                for spec in species: 
+                    print(stat, inst_id, 'spike matrix PIQc', spec, h)
+                    frame_PIQc_sel = get_PIQc_selection(stat, h, spec, inst_id)
+                    if len(frame_PIQc_sel) > 0: 
+                        frame_matrix = storage.read_spiked_frame(get_spike_matrix_file_name(stat, h, spec, inst_id))
+                        frame_matrix = frame_matrix.merge(frame_PIQc_sel[['Datetime', 'spike_'+spec.lower()+'_PIQc']], on='Datetime', how ='inner')
+                        frame_matrix = frame_matrix.set_index('Datetime')
+                        add_spike_amplitude_col(frame_matrix, spec)
+                        storage.write_spiked_frame(frame_matrix, get_spike_matrix_file_name(stat, h, spec, inst_id, '_spike_matrix_PIQc'), index=True)
+                    else:
+                        print('no data found')
 
 def check_id_height(df, id, height):
     
@@ -409,6 +1721,24 @@ def check_id_height(df, id, height):
             print(line[0], 'ID error')   
     print('end check')
         
+def get_datetime(Y,M,D,h,m):
+    """
+    build datetime values by integer arithmetic on the year, month, day, hour and minute values
+
+    Parameters
+    ----------
+    Y,M,D,h,m: array-like of int
+        year, month, day, hour and minute values
+
+    Returns
+    -------
+    datetime: array of datetime64[ns]
+    """
+    Y,M,D,h,m = [np.asarray(x, dtype='int64') for x in (Y,M,D,h,m)]
+    months  = ((Y-1970)*12 + M-1).astype('datetime64[M]')  # months since epoch
+    minutes = months.astype('datetime64[m]') + ((D-1)*1440 + h*60 + m).astype('timedelta64[m]')
+    return minutes.astype('datetime64[ns]')
+
 def insert_datetime_col(df, pos,Y,M,D,h,m):
     """ 
     Insert a datetime column in a dataframe and removes the old year, month, day, hour and min columns 
@@ -425,7 +1755,7 @@ def insert_datetime_col(df, pos,Y,M,D,h,m):
     Returns
     ---------
     """
-    df.insert(pos, 'Datetime', pd.to_datetime(df[[Y,M,D,h,m]]) )
+    df.insert(pos, 'Datetime', get_datetime(df[Y], df[M], df[D], df[h], df[m]) )
     del(df[Y], df[M], df[D], df[h], df[m] )
 
 def format_file_plot_names(stat, specie, id):
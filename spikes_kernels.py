@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compiled kernels of the loops that are not efficiently expressed with pandas/numpy operations: running quantile
+baselines (see sel.get_centered_rolling_quantile()) and weighted window sums of the REBS baseline fit (see
+detect.get_REBS_baseline()). The kernels are compiled with numba when it is installed, the callers use their
+numpy (or heapq) implementations when numba is not available or use_jit is False.
+The compiled functions are cached on disk, thus they are compiled only at the first call.
+numba is an optional dependency (pip install numba), it is not needed by the rest of the scripts.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError: # the numpy implementations are used
+    numba = None
+
+use_jit = numba is not None # use the compiled kernels, set to False to use the numpy implementations
+
+def jit(func):
+    """ compile a function with numba (nopython mode, cached on disk) if numba is available, otherwise return it unchanged """
+    if numba is None:
+        return func
+    return numba.njit(cache=True)(func)
+
+@jit
+def rolling_quantile(starts, ends, values, valid, quantile):
+    """
+    running quantile of the windows [starts[i], ends[i]) of values, NaN for windows without valid values. The values
+    of the window are kept sorted: the entering and leaving values are found with a binary search, the quantile is
+    linearly interpolated between the order statistics (same results of sel.get_centered_rolling_quantile())
+
+    Parameters
+    ----------
+    starts, ends : array of int
+        first and last + 1 index of the window of each value, not decreasing
+    values : array of float
+        values of the time series
+    valid : array of bool
+        values to be used (not NaN)
+    quantile : float
+        quantile between 0 and 1
+
+    Returns
+    -------
+    out : array
+        running quantile of each value
+    """
+    n = len(values)
+    out = np.full(n, np.nan)
+    size = 1
+    for i in range(n):
+        size = max(size, ends[i] - starts[i])
+    window = np.empty(size) # sorted values of the current window
+    count = 0
+    lo, hi = 0, 0
+    for i in range(n):
+        while lo < starts[i]: # remove the values leaving the window
+            if valid[lo]:
+                pos = np.searchsorted(window[:count], values[lo])
+                for k in range(pos, count-1):
+                    window[k] = window[k+1]
+                count -= 1
+            lo += 1
+        while hi < ends[i]: # add the values entering the window
+            if valid[hi]:
+                pos = np.searchsorted(window[:count], values[hi])
+                for k in range(count, pos, -1):
+                    window[k] = window[k-1]
+                window[pos] = values[hi]
+                count += 1
+            hi += 1
+        if count == 0:
+            continue
+        position = quantile * (count - 1)
+        k = int(position)
+        lower = window[k]
+        fraction = position - k
+        if fraction > 0: # interpolate with the next order statistic
+            lower += fraction * (window[k+1] - lower)
+        out[i] = lower
+    return out
+
+@jit
+def window_sums(minutes, weights, y, starts, ends, exact_every=1024):
+    """
+    weighted sums of the local linear regressions of the REBS baseline: for each point i the sums over the window
+    [starts[i], ends[i]) of w, w*d, w*d^2, w*y and w*d*y, with d the distance in minutes from the point i.
+    The sums are updated while the window slides: they are moved to the distance from the new point, then the
+    leaving points are subtracted and the entering points added, thus the cost does not depend on the window length.
+    The sums are computed again from the window every exact_every points, so that the rounding errors do not accumulate.
+
+    Parameters
+    ----------
+    minutes : array of int
+        sorted times in minutes
+    weights, y : array of float
+        weights and values of the points
+    starts, ends : array of int
+        first and last + 1 index of the window of each point, not decreasing
+    exact_every : int, optional
+        number of points between two exact computations of the sums
+
+    Returns
+    -------
+    s0, s1, s2, sy, sty : array
+        weighted sums of each point
+    """
+    n = len(minutes)
+    s0 = np.zeros(n)
+    s1 = np.zeros(n)
+    s2 = np.zeros(n)
+    sy = np.zeros(n)
+    sty = np.zeros(n)
+    a0, a1, a2, ay, aty = 0., 0., 0., 0., 0.
+    for i in range(n):
+        if i % exact_every == 0: # sums of the window computed again
+            a0, a1, a2, ay, aty = 0., 0., 0., 0., 0.
+            for j in range(starts[i], ends[i]):
+                w = weights[j]
+                d = float(minutes[j] - minutes[i])
+                a0 += w
+                a1 += w * d
+                a2 += w * d * d
+                ay += w * y[j]
+                aty += w * d * y[j]
+        else:
+            shift = float(minutes[i] - minutes[i-1]) # distances from the new point
+            a2 += shift * (shift * a0 - 2 * a1)
+            a1 -= shift * a0
+            aty -= shift * ay
+            for j in range(starts[i-1], starts[i]): # leaving points
+                w = weights[j]
+                d = float(minutes[j] - minutes[i])
+                a0 -= w
+                a1 -= w * d
+                a2 -= w * d * d
+                ay -= w * y[j]
+                aty -= w * d * y[j]
+            for j in range(ends[i-1], ends[i]): # entering points
+                w = weights[j]
+                d = float(minutes[j] - minutes[i])
+                a0 += w
+                a1 += w * d
+                a2 += w * d * d
+                ay += w * y[j]
+                aty += w * d * y[j]
+        s0[i], s1[i], s2[i], sy[i], sty[i] = a0, a1, a2, ay, aty
+    return s0, s1, s2, sy, sty
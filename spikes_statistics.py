@@ -11,11 +11,117 @@ import numbers
 import numpy as np
 import matplotlib.pyplot as plt
 import spikes_formatting_functions as fmt
+import spikes_data_selection_functions as sel
+import spikes_storage as storage
 import pandas as pd 
 from configparser import ConfigParser
 
 min_ampl_dict = {'CO2': 0.5, 'CO':2, 'CH4': 2}
 
+def get_BFOR_columns(spec):
+    """ columns of the '_spiked_PIQc_mean' files needed to compute the contingency table """
+    return ['Datetime', 'spike_'+spec.lower(), 'spike_'+spec.lower()+'_PIQc', 'spike_amplitude_'+spec.lower()+'_PIQc']
+
+def get_contingency_counts(frame, forecast, observed):
+    """
+    get the contingency table of forecasted (automatic) and observed (PIQc) spikes
+
+    Parameters
+    ----------
+    frame : DataFrame
+        frame with the forecast and observed spike columns
+    forecast : str
+        name of the column with forecasted spikes
+    observed : str
+        name of the column with observed spikes
+
+    Returns
+    -------
+    a, b, c, d : int
+        number of minutes with forecasted and observed spikes (a), forecasted only (b), observed only (c) and without spikes (d)
+    """
+    forecast_true, forecast_false = (frame[forecast]==True).values, (frame[forecast]==False).values
+    observed_true, observed_false = (frame[observed]==True).values, (frame[observed]==False).values
+    a = int((forecast_true  & observed_true ).sum())
+    b = int((forecast_true  & observed_false).sum())
+    c = int((forecast_false & observed_true ).sum())
+    d = int((forecast_false & observed_false).sum())
+    return a, b, c, d
+
+def get_contingency_counts_index(spike_indexes, rows, forecast, observed):
+    """
+    get the contingency table of forecasted (automatic) and observed (PIQc) spikes by set operations on the sparse 
+    spike indexes of a '_spiked_PIQc_mean' file (see storage.read_spike_index()), same result of get_contingency_counts()
+
+    Parameters
+    ----------
+    spike_indexes : dict
+        spike index of each spike column, see sel.get_spike_indexes()
+    rows : int
+        number of rows of the file
+    forecast, observed : str
+        names of the columns with forecasted and observed spikes
+
+    Returns
+    -------
+    a, b, c, d : int
+        see get_contingency_counts()
+    """
+    forecast_index, observed_index = spike_indexes[forecast], spike_indexes[observed]
+    a = sel.count_spike_index_intersection(forecast_index, observed_index)
+    b = sel.count_spike_index_difference(forecast_index, observed_index)
+    c = sel.count_spike_index_difference(observed_index, forecast_index)
+    d = rows - sel.count_spike_index_union(forecast_index, observed_index)
+    return a, b, c, d
+
+def iter_contingency_counts(stat, inst_id, alg, params, spec, height, high_spikes, high_spikes_mode, quant, window=None, baseline_quantile=None):
+    """
+    iterate over the contingency tables of the algorithm parameters. For all the spikes the counts are computed from 
+    the spike indexes written at ingestion next to the '_spiked_PIQc_mean' files (see get_contingency_counts_index()), 
+    without reading the minute data. The high spikes, and the parameters without an up to date spike index, are 
+    counted on the data read by sel.iter_spiked_data() (see get_contingency_counts())
+
+    Parameters
+    ----------
+    stat, inst_id, alg, params, spec, height :
+        see sel.iter_spiked_data()
+    high_spikes, high_spikes_mode, quant, window, baseline_quantile :
+        see get_BFOR_parameters()
+
+    Yields
+    ------
+    param : str
+        parameter value, in the order of params
+    a, b, c, d : int
+        see get_contingency_counts()
+    """
+    forecast = 'spike_'+spec.lower() # forecasted spikes
+    if high_spikes:
+        observed = 'high_spike_'+spec.lower()+'_PIQc' # observed spikes
+    else:
+        observed = 'spike_'+spec.lower()+'_PIQc'
+    indexes = {}
+    if not high_spikes:
+        for param in params:
+            spike_indexes, rows = storage.read_spike_index(fmt.get_spiked_file_name(stat, height, spec, inst_id, alg, param, '_spiked_PIQc_mean'))
+            if spike_indexes is not None:
+                indexes[param] = (spike_indexes, rows)
+    counts = {}
+    dense_params = [param for param in params if param not in indexes]
+    if len(dense_params) > 0:
+        columns = get_BFOR_columns(spec)
+        if high_spikes and ((window is not None) or (baseline_quantile is not None)): # the concentration is needed to recompute the baseline
+            columns = columns + [spec.lower()]
+        for param, frame in sel.iter_spiked_data(stat, inst_id, alg, dense_params, spec, height, columns=columns, PIQc=True):
+            if high_spikes:
+                frame = add_high_spikes_col(frame, spec, high_spikes_mode, quant, window, baseline_quantile)
+            counts[param] = get_contingency_counts(frame, forecast, observed)
+    for param in params:
+        if param in indexes:
+            yield (param,) + get_contingency_counts_index(*indexes[param], forecast, observed)
+        else:
+            yield (param,) + counts[param]
+
 def plot_BFOR_parameters(stat, inst_id, algorithms, spec, height, high_spikes, high_spikes_mode, quant):
     """
     plot results from statistical analysis of PIQc and automatic flagging
@@ -51,25 +157,15 @@ def plot_BFOR_parameters(stat, inst_id, algorithms, spec, height, high_spikes, h
         ORSS = np.empty(0)
         stdev_logOR = np.empty(0)
         min_a, min_b, min_c, min_d = 1E10,1E10,1E10,1E10
-        for param in params:
-            infile_spiked = './data-minute-spiked/' + stat +'/' + fmt.get_L1_file_name(stat, height, spec, inst_id)+'_'+ alg +'_'+ param + '_spiked_PIQc_mean'
-            frame = pd.read_csv(infile_spiked, sep=';')
+        for param, a, b, c, d in iter_contingency_counts(stat, inst_id, alg, params, spec, height, high_spikes, high_spikes_mode, quant):
 
             if high_spikes:
-               frame = add_high_spikes_col(frame, spec, high_spikes_mode, quant)
-               observed = 'high_spike_'+spec.lower()+'_PIQc' # observed spikes
                high_spikes_str  = ' - high spikes (>'+str(min_ampl_dict[spec])+' '+fmt.get_meas_unit(spec)+')'
                high_spikes_suff = '_high'
             else:
                high_spikes_str  = ''
                high_spikes_suff = ''
-               observed = 'spike_'+spec.lower()+'_PIQc' # observed spikes
-            forecast = 'spike_'+spec.lower() # forecasted spikes
 
-            a = len(frame[ (frame[forecast]==True ) & (frame[observed]==True ) ])
-            b = len(frame[ (frame[forecast]==True ) & (frame[observed]==False) ])
-            c = len(frame[ (frame[forecast]==False) & (frame[observed]==True ) ])
-            d = len(frame[ (frame[forecast]==False) & (frame[observed]==False) ])
             B  = np.append( B, (a+b)/(a+c))
             H  = np.append( H, a/(a+c))
             F  = np.append( F, b/(b+d))
@@ -185,7 +281,7 @@ def get_standard_parameter_index(alg, params, spec):
                 
         return i_std
  
-def get_BFOR_parameters(algorithms, stat, height, spec, inst_id, high_spikes, high_spikes_mode, quant, all_std):
+def get_BFOR_parameters(algorithms, stat, height, spec, inst_id, high_spikes, high_spikes_mode, quant, all_std, window=None, baseline_quantile=None):
     """
     Parameters
     ----------
@@ -208,6 +304,10 @@ def get_BFOR_parameters(algorithms, stat, height, spec, inst_id, high_spikes, hi
     all_std : str
         wether to return all the parameters or only the standard ones, or one given parameter. Select 'std' to get results for the standard parameters, 
         'all' to get results for all the parameters, one single parameter (e.g. '5' for REBS 5) to get results for that parameter
+    window : str or int, optional
+        baseline window length of the high spikes amplitudes, see add_high_spikes_col() documentation
+    baseline_quantile : float, optional
+        quantile of the running baseline of the high spikes amplitudes (e.g. 0.5 for the running median), see add_high_spikes_col() documentation
     Returns
     -------
     H,F,B,ORSS :
@@ -239,22 +339,8 @@ def get_BFOR_parameters(algorithms, stat, height, spec, inst_id, high_spikes, hi
     else: # single parameter case
         params = [all_std]
         
-    for param in params:
-        infile_spiked = './data-minute-spiked/' + stat +'/' + fmt.get_L1_file_name(stat, height, spec, inst_id)+'_'+ alg +'_'+ param + '_spiked_PIQc_mean'
-        frame = pd.read_csv(infile_spiked, sep=';')     
-
-        if high_spikes:
-           frame = add_high_spikes_col(frame, spec, high_spikes_mode, quant)
-           observed = 'high_spike_'+spec.lower()+'_PIQc' # observed spikes
-        else:
-           observed = 'spike_'+spec.lower()+'_PIQc' # observed spikes
-        
-        forecast = 'spike_'+spec.lower() # forecasted spikes
+    for param, a, b, c, d in iter_contingency_counts(stat, inst_id, alg, params, spec, height, high_spikes, high_spikes_mode, quant, window, baseline_quantile):
 
-        a = len(frame[ (frame[forecast]==True ) & (frame[observed]==True ) ])
-        b = len(frame[ (frame[forecast]==True ) & (frame[observed]==False) ])
-        c = len(frame[ (frame[forecast]==False) & (frame[observed]==True ) ])
-        d = len(frame[ (frame[forecast]==False) & (frame[observed]==False) ])
         B  = np.append( B, (a+b)/(a+c))
         H  = np.append( H, a/(a+c))
         F  = np.append( F, b/(b+d))
@@ -587,20 +673,123 @@ def plot_BFOR_parameters_lowhigh(stat, inst_id, algorithms, spec, height,  high_
 
 
     
-def get_threshold(df, spec, mode, quant):
+def get_threshold(df, spec, mode, quant, amplitude=None, window=None, baseline_quantile=None):
+    if amplitude is None:
+        amplitude = get_spike_amplitude(df, spec, window, baseline_quantile)
     if mode =='single':
         min_diff = min_ampl_dict[spec.upper()] 
     elif mode =='distr':
-        min_diff = df[df['spike_'+spec.lower()+'_PIQc']]['spike_amplitude_'+spec.lower()+'_PIQc'].quantile(q=quant) # set the quantile as min difference
+        min_diff = amplitude[df['spike_'+spec.lower()+'_PIQc']].quantile(q=quant) # set the quantile as min difference
     else:
         print('unknown high_spikes_mode')        
     return min_diff
 
-def add_high_spikes_col(df, spec, mode, quant):
+def add_high_spikes_col(df, spec, mode, quant, window=None, baseline_quantile=None):
+    """
+    add the column with the "high" spikes detected by PIs, i.e. PIQc spikes with amplitude respect to the baseline larger
+    than a threshold (see get_threshold()). If window (e.g. '60min' or 60 minutes) or baseline_quantile (e.g. 0.5 for a 
+    running median baseline) are given the amplitudes are recomputed in memory from the concentration (see 
+    get_spike_amplitude()), otherwise the amplitudes of the files are used.
+    """
+    amplitude = get_spike_amplitude(df, spec, window, baseline_quantile)
     df.insert(len(df.columns),'high_spike_'+spec.lower()+'_PIQc',False)
-    min_diff = get_threshold(df, spec, mode, quant)
-    df.loc[df['spike_amplitude_'+spec.lower()+'_PIQc'] > min_diff, 'high_spike_'+spec.lower()+'_PIQc'] = True
+    min_diff = get_threshold(df, spec, mode, quant, amplitude)
+    df.loc[amplitude > min_diff, 'high_spike_'+spec.lower()+'_PIQc'] = True
     return df
+
+def get_spike_amplitude(df, spec, window=None, baseline_quantile=None):
+    """ 
+    get the amplitude of the spikes detected by PIs as Series. If window and baseline_quantile are None the amplitude of the 
+    'spike_amplitude_<spec>_PIQc' column is returned, otherwise it is computed with get_spike_amplitudes() (30 min window 
+    if not given) 
+    """
+    if (window is None) and (baseline_quantile is None):
+        return df['spike_amplitude_'+spec.lower()+'_PIQc']
+    if window is None:
+        window = '30min'
+    return pd.Series(get_spike_amplitudes(df, spec, [window], baseline_quantile)[window], index=df.index)
+
+def get_spike_amplitudes(df, spec, windows, baseline_quantile=None):
+    """
+    get the amplitudes of the spikes detected by PIs respect to baselines with different window lengths. Running average 
+    baselines are computed with a single pass over the data (see sel.get_centered_rolling_means()), running quantile 
+    baselines with a sliding order statistic for each window (see sel.get_centered_rolling_quantile()). The amplitude is defined as in 
+    fmt.add_spike_amplitude_col(): difference between the concentration and the baseline rounded to 3 decimals, 
+    0 for data that are not flagged as spikes by PIs.
+
+    Parameters
+    ----------
+    df : DataFrame
+        frame with 'Datetime', <spec> and 'spike_<spec>_PIQc' columns, sorted by Datetime
+    spec : str
+        chemical specie
+    windows : list
+        baseline window lengths as pandas offsets (e.g. '30min') or number of minutes
+    baseline_quantile : float, optional
+        quantile of the running baseline (e.g. 0.5 for the running median). If None the running average is used
+
+    Returns
+    -------
+    amplitudes : dict of array
+        amplitudes for each window length
+    """
+    baselines = get_baselines(df['Datetime'].values, df[spec.lower()].values, windows, baseline_quantile)
+    flagged = df['spike_'+spec.lower()+'_PIQc'].values.astype(bool)
+    conc = df[spec.lower()].values
+    return {window: np.where(flagged, conc - np.round(baselines[window], 3), 0.) for window in windows}
+
+def get_baselines(times, values, windows, baseline_quantile=None):
+    """ get the running average (baseline_quantile=None) or running quantile baselines for each window length """
+    if baseline_quantile is None:
+        return sel.get_centered_rolling_means(times, values, windows)
+    return {window: sel.get_centered_rolling_quantile(times, values, window, baseline_quantile) for window in windows}
+
+def get_high_spikes_window_sensitivity(algorithms, stat, height, spec, inst_id, windows, high_spikes_mode='single', quant=None, baseline_quantile=None):
+    """
+    evaluate the contingency table of automatic and "high" PIQc spikes for different lengths of the baseline window.
+    The data of each parameter are read once and the baselines of all the windows are computed with a single pass 
+    (see get_spike_amplitudes()). The baselines do not depend on the parameter, thus they are computed only once if 
+    the concentrations of all the parameters files are the same.
+
+    Parameters
+    ----------
+    algorithms : list
+        list with algorithm name ('SD' or 'REBS') as first element and parameters values after
+    stat, height, spec, inst_id : str
+        station name, sampling altitude, chemical specie and instrument ID
+    windows : list
+        baseline window lengths as pandas offsets (e.g. '30min') or number of minutes
+    high_spikes_mode, quant : str
+        see add_high_spikes_col() documentation
+    baseline_quantile : float, optional
+        quantile of the running baseline (e.g. 0.5 for the running median). If None the running average is used
+
+    Returns
+    -------
+    sensitivity : DataFrame
+        a, b, c, d counts and H, F, B values with (param, window) index
+    """
+    alg = algorithms[0]
+    params = algorithms[1:len(algorithms)]
+    columns = get_BFOR_columns(spec) + [spec.lower()]
+    forecast = 'spike_'+spec.lower() # forecasted spikes
+    observed = 'high_spike_'+spec.lower()+'_PIQc' # observed spikes
+    rows = []
+    means = None
+    for param, frame in sel.iter_spiked_data(stat, inst_id, alg, params, spec, height, columns=columns, PIQc=True):
+        times, values = frame['Datetime'].values, frame[spec.lower()].values
+        if (means is None) or not (np.array_equal(times, means_times) and np.array_equal(values, means_values, equal_nan=True)):
+            means = get_baselines(times, values, windows, baseline_quantile)
+            means_times, means_values = times, values
+        flagged = frame['spike_'+spec.lower()+'_PIQc'].values.astype(bool)
+        for window in windows:
+            amplitude = pd.Series(np.where(flagged, values - np.round(means[window], 3), 0.), index=frame.index)
+            min_diff = get_threshold(frame, spec, high_spikes_mode, quant, amplitude)
+            frame[observed] = (amplitude > min_diff).values
+            a, b, c, d = get_contingency_counts(frame, forecast, observed)
+            rows.append([param, window, a, b, c, d, a/(a+c), b/(b+d), (a+b)/(a+c)])
+    sensitivity = pd.DataFrame(rows, columns=['param', 'window', 'a', 'b', 'c', 'd', 'H', 'F', 'B'])
+    return sensitivity.set_index(['param', 'window'])
     
 def qqplot(x, y, height,    quantiles=None, interpolation='nearest', ax=None, rug=False, rug_length=0.05, rug_kwargs=None,  **kwargs):
     """Draw a quantile-quantile plot for `x` versus `y`.
@@ -0,0 +1,760 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Read and write the minute data files with spikes ('_spiked', '_spiked_PIQc', '_spiked_PIQc_mean' and spike matrix files).
+The files can be stored as ';'-separated csv (default) or with a columnar binary format (parquet or feather),
+that allows to read only the needed columns and stores datetime and bool columns without text parsing.
+Parquet and feather formats require the pyarrow package.
+Spiked files can be written as year/month partitions (a directory with one file for each month), so that readers open
+only the months of the analyzed period and new months can be added without rewriting the old ones.
+Minute data can also be stored on a fixed 1-minute grid opened as numpy.memmap, where the selection of a month,
+event or season is a slice of the arrays.
+The spikes of a spiked file can also be saved as a sparse spike index (the sorted minute keys of the flagged rows),
+so that the spike counts are computed with set operations without reading the minute data.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+spiked_file_format = 'csv' # format used to write spiked files: 'csv', 'parquet' or 'feather'
+file_extensions = {'csv': '', 'parquet': '.parquet', 'feather': '.feather'}
+spiked_suffixes = ('_spiked', '_spiked_PIQc', '_spiked_PIQc_mean', '_spike_matrix', '_spike_matrix_PIQc', '_nesting_exceptions')
+partitioned_layout = False # write spiked files as year/month partitions (see write_partitioned_frame())
+partitions_extension = '.partitions' # extension of the directory with the partitions of a spiked file
+chunk_period = None # None: whole files are read. 'M' or 'D': ingestion and monthly aggregation read month/day aligned chunks (see iter_spiked_frame())
+spiked_chunksize = 200000 # number of rows read at once by the chunked readers
+spike_index_extension = '.spike_index.npz' # extension of the sparse spike index of a spiked file (see write_spike_index())
+grid_metadata = ('epoch', 'heights') # keys of a minute grid that are not columns (see open_minute_grid() and fmt.read_height_profile())
+
+def get_file_format(file_name):
+    """
+    get the format of an existing spiked file. The format selected by spiked_file_format (or the partitioned layout if
+    partitioned_layout is True) is checked first.
+
+    Parameters
+    ----------
+    file_name : str
+        path and name of the file without the format extension
+
+    Returns
+    -------
+    file_format : str
+        'csv', 'parquet', 'feather' or 'partitioned'. None if the file does not exist in any format
+    """
+    if partitioned_layout and os.path.isdir(file_name + partitions_extension):
+        return 'partitioned'
+    formats = [spiked_file_format] + [f for f in file_extensions if f != spiked_file_format]
+    for file_format in formats:
+        if os.path.isfile(file_name + file_extensions[file_format]):
+            return file_format
+    if os.path.isdir(file_name + partitions_extension):
+        return 'partitioned'
+    return None
+
+def remove_spiked_file(file_name):
+    """ remove a spiked file in all the formats (partitions excluded) """
+    for file_format in file_extensions:
+        if os.path.isfile(file_name + file_extensions[file_format]):
+            os.remove(file_name + file_extensions[file_format])
+
+def spiked_file_exists(file_name):
+    """ check if a spiked file exists in any format """
+    return get_file_format(file_name) is not None
+
+def write_spiked_frame(frame, file_name, file_format=None, index=False, partitioned=None):
+    """
+    write a spiked frame
+
+    Parameters
+    ----------
+    frame : DataFrame
+        frame to be written
+    file_name : str
+        path and name of the file without the format extension
+    file_format : str, optional
+        'csv', 'parquet' or 'feather'. If None spiked_file_format is used
+    index : bool, optional
+        write the index of the frame as first column (e.g. Datetime index)
+    partitioned : bool, optional
+        write the frame as year/month partitions (see write_partitioned_frame()). If None partitioned_layout is used
+    """
+    if partitioned is None:
+        partitioned = partitioned_layout
+    if partitioned:
+        write_partitioned_frame(frame, file_name, file_format, index, remove_old=True)
+        return
+    if file_format is None:
+        file_format = spiked_file_format
+    if file_format == 'csv':
+        frame.to_csv(file_name, sep=';', index=index)
+    else:
+        if index:
+            frame = frame.reset_index()
+        else:
+            frame = frame.reset_index(drop=True)
+        if file_format == 'parquet':
+            frame.to_parquet(file_name + file_extensions['parquet'], index=False)
+        elif file_format == 'feather':
+            frame.to_feather(file_name + file_extensions['feather'])
+        else:
+            raise ValueError('unknown file format '+str(file_format))
+
+def read_spiked_frame(file_name, columns=None, years=None, start_date=None, end_date=None):
+    """
+    read a spiked frame. The format is detected from the existing files (see get_file_format()).
+    For partitioned files only the partitions that overlap the selected years and dates are read (see select_partitions()), 
+    the selection has no effect on the other formats.
+
+    Parameters
+    ----------
+    file_name : str
+        path and name of the file without the format extension
+    columns : list of str, optional
+        columns to be read. If None all the columns are read
+    years : list of int, optional
+        years to be read from partitioned files
+    start_date, end_date : datetime-like, optional
+        dates to be read from partitioned files
+
+    Returns
+    -------
+    frame : DataFrame
+        frame with Datetime column converted to datetime
+    """
+    file_format = get_file_format(file_name)
+    if file_format is None:
+        raise FileNotFoundError(file_name)
+    if file_format == 'partitioned':
+        partitions = get_partitions(file_name)
+        if len(partitions) == 0: # no partition written yet
+            raise FileNotFoundError('no partitions in '+file_name+partitions_extension)
+        selected = select_partitions(partitions, years, start_date, end_date)
+        if len(selected) == 0: # empty frame with the columns of the file
+            return read_spiked_frame(get_partition_file_name(file_name, partitions[0]), columns).iloc[0:0]
+        return pd.concat([read_spiked_frame(get_partition_file_name(file_name, part), columns) for part in selected], ignore_index=True)
+    if file_format == 'csv':
+        if (columns is None) or ('Datetime' in columns):
+            parse_dates = ['Datetime']
+        else:
+            parse_dates = False
+        frame = pd.read_csv(file_name, sep=';', usecols=columns, parse_dates=parse_dates)
+    elif file_format == 'parquet':
+        frame = pd.read_parquet(file_name + file_extensions['parquet'], columns=columns)
+    else:
+        frame = pd.read_feather(file_name + file_extensions['feather'], columns=columns)
+    if columns is not None:
+        frame = frame[columns] # same column order for all the formats
+    return frame
+
+def get_partition_file_name(file_name, partition):
+    """ get path and name of a partition (e.g. '2019-04') of a spiked file, without the format extension """
+    return os.path.join(file_name + partitions_extension, partition)
+
+def get_partitions(file_name):
+    """ get the sorted list of the year/month partitions (e.g. '2019-04') of a partitioned spiked file """
+    partitions = set()
+    for part_file in os.listdir(file_name + partitions_extension):
+        partitions.add(part_file.split('.')[0])
+    return sorted(partitions)
+
+def select_partitions(partitions, years=None, start_date=None, end_date=None):
+    """
+    select the partitions that overlap the given years and dates (partition pruning)
+
+    Parameters
+    ----------
+    partitions : list of str
+        partitions names (e.g. '2019-04')
+    years : list of int, optional
+        selected years. If None all the years are selected
+    start_date, end_date : datetime-like, optional
+        selected dates. If None the selection is not limited
+
+    Returns
+    -------
+    selected : list of str
+    """
+    selected = []
+    for part in partitions:
+        month_start = np.datetime64(part, 'M')
+        if (years is not None) and (int(part[0:4]) not in years):
+            continue
+        if (start_date is not None) and (month_start + 1 <= np.datetime64(start_date, 'M')):
+            continue
+        if (end_date is not None) and (month_start > np.datetime64(end_date, 'M')):
+            continue
+        selected.append(part)
+    return selected
+
+def write_partitioned_frame(frame, file_name, file_format=None, index=False, remove_old=False):
+    """
+    write a spiked frame as year/month partitions: one file for each month in the directory file_name+partitions_extension.
+    Only the partitions of the months in the frame are written, thus new months can be added without rewriting the old ones.
+
+    Parameters
+    ----------
+    frame : DataFrame
+        frame with 'Datetime' column (or index if index is True)
+    file_name : str
+        path and name of the spiked file without the format extension
+    file_format : str, optional
+        format of the partition files, see write_spiked_frame()
+    index : bool, optional
+        the Datetime is the index of the frame
+    remove_old : bool, optional
+        remove the partitions of the months that are not in the frame
+    """
+    if index:
+        frame = frame.reset_index()
+    dir_name = file_name + partitions_extension
+    os.makedirs(dir_name, exist_ok=True)
+    months = frame['Datetime'].values.astype('datetime64[M]')
+    new_partitions = [str(month) for month in np.unique(months)]
+    old_partitions = get_partitions(file_name)
+    for part in new_partitions:
+        part_name = get_partition_file_name(file_name, part)
+        remove_spiked_file(part_name) # avoid old files in other formats
+        write_spiked_frame(frame[months == np.datetime64(part, 'M')], part_name, file_format, partitioned=False)
+    if remove_old:
+        for part in old_partitions:
+            if part not in new_partitions:
+                remove_spiked_file(get_partition_file_name(file_name, part))
+
+def update_spiked_frame(frame, file_name, index=False):
+    """
+    add new months to a spiked file or replace the months that are in the frame, the other months are not modified.
+    Partitioned files are updated writing only the partitions of the frame months.
+
+    Parameters
+    ----------
+    frame : DataFrame
+        frame with 'Datetime' column (or index if index is True)
+    file_name : str
+        path and name of the spiked file without the format extension
+    index : bool, optional
+        the Datetime is the index of the frame
+    """
+    file_format = get_file_format(file_name)
+    if (file_format is None) and (not partitioned_layout):
+        write_spiked_frame(frame, file_name, index=index)
+    elif (file_format == 'partitioned') or ((file_format is None) and partitioned_layout):
+        write_partitioned_frame(frame, file_name, index=index)
+    else:
+        if index:
+            frame = frame.reset_index()
+        old_frame = read_spiked_frame(file_name)
+        new_months = np.unique(frame['Datetime'].values.astype('datetime64[M]'))
+        old_frame = old_frame[~np.isin(old_frame['Datetime'].values.astype('datetime64[M]'), new_months)]
+        out_frame = pd.concat([old_frame, frame], ignore_index=True).sort_values(by='Datetime', kind='stable')
+        write_spiked_frame(out_frame, file_name, file_format, partitioned=False)
+
+def append_spiked_frame(frame, file_name, index=False):
+    """
+    append to a spiked file rows that are more recent than the rows of the file (e.g. the minutes of a live feed). 
+    csv files are extended without reading them, partitioned files are updated rewriting only the partitions of the 
+    frame months, parquet and feather files are read and rewritten (csv or partitioned layout are preferable for 
+    frequent appends). A new file is written if the file does not exist. The columns of the frame are put in the 
+    order of the file columns (see get_columns()), a ValueError is raised if the columns are not the same.
+
+    Parameters
+    ----------
+    frame : DataFrame
+        frame with 'Datetime' column (or index if index is True) and the columns of the file
+    file_name : str
+        path and name of the spiked file without the format extension
+    index : bool, optional
+        the Datetime is the index of the frame
+    """
+    if index:
+        frame = frame.reset_index()
+    file_format = get_file_format(file_name)
+    if file_format is None:
+        write_spiked_frame(frame, file_name)
+        return
+    columns = get_columns(file_name)
+    if sorted(columns) != sorted(frame.columns):
+        raise ValueError('columns '+str(list(frame.columns))+' cannot be appended to '+file_name+' with columns '+str(columns))
+    frame = frame[columns]
+    if file_format == 'csv':
+        frame.to_csv(file_name, sep=';', index=False, mode='a', header=False)
+    elif len(frame) > 0:
+        start_date = frame['Datetime'].values.min().astype('datetime64[M]') # the appended months are rewritten
+        old_frame = read_spiked_frame(file_name, start_date=start_date)
+        old_frame = old_frame[old_frame['Datetime'].values >= start_date]
+        update_spiked_frame(pd.concat([old_frame, frame], ignore_index=True), file_name)
+
+def iter_period_chunks(chunks, period='M', datetime_col='Datetime'):
+    """
+    split a sequence of frames sorted by datetime in frames with the data of a single month or day. 
+    Only the rows of the last period of each chunk are kept in memory until the next chunk is read.
+
+    Parameters
+    ----------
+    chunks : iterable of DataFrame
+        consecutive frames sorted by datetime_col
+    period : str, optional
+        'M' (month) or 'D' (day)
+    datetime_col : str, optional
+        name of the datetime column
+
+    Yields
+    ------
+    frame : DataFrame
+        data of one period
+    """
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if len(chunk) == 0:
+            continue
+        keys = chunk[datetime_col].values.astype('datetime64['+period+']')
+        bounds = [0] + list(np.flatnonzero(keys[1:] != keys[:-1]) + 1) + [len(chunk)]
+        for start, end in zip(bounds[:-2], bounds[1:-1]):
+            yield chunk.iloc[start:end]
+        carry = chunk.iloc[bounds[-2]:].copy() # the last period can continue in the next chunk
+    if carry is not None:
+        yield carry
+
+def iter_spiked_frame(file_name, columns=None, period='M', years=None, start_date=None, end_date=None):
+    """
+    read a spiked frame in chunks with the data of a single month or day, so that the memory used does not depend 
+    on the length of the file. Partitioned files are read one partition at a time, csv files chunksize rows at a 
+    time and parquet/feather files one record batch at a time. See read_spiked_frame()
+
+    Parameters
+    ----------
+    file_name : str
+        path and name of the file without the format extension
+    columns : list of str, optional
+        columns to be read, 'Datetime' is needed to align the chunks. If None all the columns are read
+    period : str, optional
+        'M' (month) or 'D' (day)
+    years, start_date, end_date : optional
+        period to be read from partitioned files, see read_spiked_frame()
+
+    Yields
+    ------
+    frame : DataFrame
+        data of one month or day, sorted as in the file
+    """
+    file_format = get_file_format(file_name)
+    if file_format is None:
+        raise FileNotFoundError(file_name)
+    if file_format == 'partitioned':
+        for part in select_partitions(get_partitions(file_name), years, start_date, end_date):
+            yield from iter_period_chunks([read_spiked_frame(get_partition_file_name(file_name, part), columns)], period)
+        return
+    if file_format == 'csv':
+        chunks = pd.read_csv(file_name, sep=';', usecols=columns, parse_dates=['Datetime'], chunksize=spiked_chunksize)
+    else:
+        chunks = iter_arrow_batches(file_name, file_format, columns)
+    if columns is not None:
+        chunks = (chunk[columns] for chunk in chunks) # same column order for all the formats
+    yield from iter_period_chunks(chunks, period)
+
+def iter_arrow_batches(file_name, file_format, columns=None):
+    """ read a parquet or feather file one record batch at a time, see iter_spiked_frame() """
+    import pyarrow as pa
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(file_name + file_extensions['parquet'])
+        for batch in parquet_file.iter_batches(batch_size=spiked_chunksize, columns=columns):
+            yield pa.Table.from_batches([batch]).to_pandas()
+    else:
+        import pyarrow.ipc as ipc
+        with pa.memory_map(file_name + file_extensions['feather']) as source:
+            reader = ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                table = pa.Table.from_batches([reader.get_batch(i)])
+                if columns is not None:
+                    table = table.select(columns)
+                yield table.to_pandas()
+
+def write_spiked_chunks(chunks, file_name, file_format=None, index=False, partitioned=None):
+    """
+    write a spiked frame given as a sequence of chunks, keeping in memory only one chunk at a time 
+    (one month for partitioned files). The written file is the same written by write_spiked_frame() with the 
+    concatenated chunks, except for category columns of feather files that are stored as plain values as in csv files.
+
+    Parameters
+    ----------
+    chunks : iterable of DataFrame
+        consecutive chunks of the frame (sorted by Datetime for partitioned files, see iter_period_chunks())
+    file_name : str
+        path and name of the file without the format extension
+    file_format : str, optional
+        'csv', 'parquet' or 'feather'. If None spiked_file_format is used
+    index : bool, optional
+        write the index of the frame as first column (e.g. Datetime index)
+    partitioned : bool, optional
+        write the frame as year/month partitions. If None partitioned_layout is used
+    """
+    if partitioned is None:
+        partitioned = partitioned_layout
+    if file_format is None:
+        file_format = spiked_file_format
+    if partitioned:
+        os.makedirs(file_name + partitions_extension, exist_ok=True)
+        old_partitions = get_partitions(file_name)
+        new_partitions = []
+        for frame in iter_period_chunks((chunk.reset_index() if index else chunk for chunk in chunks), 'M'): # chunks of days are joined in months
+            part = str(frame['Datetime'].values[0].astype('datetime64[M]'))
+            new_partitions.append(part)
+            remove_spiked_file(get_partition_file_name(file_name, part)) # avoid old files in other formats
+            write_spiked_frame(frame, get_partition_file_name(file_name, part), file_format, partitioned=False)
+        for part in old_partitions:
+            if part not in new_partitions:
+                remove_spiked_file(get_partition_file_name(file_name, part))
+        return
+    if file_format == 'csv':
+        with open(file_name, 'w') as file:
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(file, sep=';', index=index, header=(i == 0))
+        return
+    import pyarrow as pa
+    writer = None
+    try:
+        for chunk in chunks:
+            chunk = chunk.reset_index() if index else chunk.reset_index(drop=True)
+            if file_format == 'feather': # dictionaries cannot change between the batches of a feather file
+                for col in chunk.columns[(chunk.dtypes == 'category').values]:
+                    chunk[col] = chunk[col].astype(chunk[col].cat.categories.dtype)
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                if file_format == 'parquet':
+                    import pyarrow.parquet as pq
+                    writer = pq.ParquetWriter(file_name + file_extensions['parquet'], schema)
+                elif file_format == 'feather':
+                    writer = pa.ipc.new_file(file_name + file_extensions['feather'], schema)
+                else:
+                    raise ValueError('unknown file format '+str(file_format))
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+def get_columns(file_name):
+    """ get the column names of an existing spiked file without reading the data """
+    file_format = get_file_format(file_name)
+    if file_format is None:
+        raise FileNotFoundError(file_name)
+    if file_format == 'partitioned':
+        partitions = get_partitions(file_name)
+        if len(partitions) == 0:
+            raise FileNotFoundError('no partitions in '+file_name+partitions_extension)
+        columns = get_columns(get_partition_file_name(file_name, partitions[0]))
+    elif file_format == 'csv':
+        columns = pd.read_csv(file_name, sep=';', nrows=0).columns.tolist()
+    else:
+        import pyarrow.parquet as pq
+        import pyarrow.ipc as ipc
+        if file_format == 'parquet':
+            columns = pq.read_schema(file_name + file_extensions['parquet']).names
+        else:
+            columns = ipc.open_file(file_name + file_extensions['feather']).schema.names
+    return columns
+
+def get_modification_time(file_name):
+    """ get the time of the last modification of an existing spiked file (of its last modified partition for partitioned files) """
+    file_format = get_file_format(file_name)
+    if file_format is None:
+        raise FileNotFoundError(file_name)
+    if file_format == 'partitioned':
+        dir_name = file_name + partitions_extension
+        return max([os.path.getmtime(dir_name)] + [os.path.getmtime(os.path.join(dir_name, f)) for f in os.listdir(dir_name)])
+    return os.path.getmtime(file_name + file_extensions[file_format])
+
+def write_spike_index(spike_indexes, rows, file_name):
+    """
+    write the sparse spike indexes of the spike columns of a spiked file (see sel.get_spike_indexes()) in a .npz file 
+    next to the spiked file, with one int32 array of minute keys for each column and occurrence number
+
+    Parameters
+    ----------
+    spike_indexes : dict
+        spike index of each column, with column names as keys
+    rows : int
+        number of rows of the spiked file
+    file_name : str
+        path and name of the spiked file without the format extension
+    """
+    arrays = {'rows': np.array(rows, dtype='int64'), 'columns': np.array(list(spike_indexes), dtype=str)}
+    for col, spike_index in spike_indexes.items():
+        for occ, keys in spike_index.items():
+            arrays[col+':'+str(occ)] = keys.astype('int32')
+    np.savez(file_name + spike_index_extension, **arrays)
+
+def read_spike_index(file_name):
+    """
+    read the sparse spike indexes of a spiked file (see write_spike_index())
+
+    Parameters
+    ----------
+    file_name : str
+        path and name of the spiked file without the format extension
+
+    Returns
+    -------
+    spike_indexes : dict
+        spike index of each column (dict of sorted int32 arrays of minute keys with occurrence numbers as keys), 
+        with column names as keys. None if the index does not exist or is older than the spiked file
+    rows : int
+        number of rows of the spiked file
+    """
+    index_file = file_name + spike_index_extension
+    if (not os.path.isfile(index_file)) or (not spiked_file_exists(file_name)):
+        return None, 0
+    if os.path.getmtime(index_file) < get_modification_time(file_name): # spiked file rewritten without its index
+        return None, 0
+    with np.load(index_file) as arrays:
+        rows = int(arrays['rows'])
+        spike_indexes = {str(col): {} for col in arrays['columns']} # columns without spikes have no arrays
+        for key in arrays.files:
+            if key in ('rows', 'columns'):
+                continue
+            col, occ = key.rsplit(':', 1)
+            spike_indexes[col][int(occ)] = arrays[key]
+    return spike_indexes, rows
+
+def encode_nested_flags(flags, params):
+    """
+    encode the spikes of an ordered sweep of parameters (e.g. SD alpha or REBS beta values) in a single column.
+    Stricter parameters usually flag a subset of the spikes of looser ones, thus each minute is described by the
+    strictest parameter that flags it: the spike flag for parameter p is recovered as level >= p.
+    Minutes that break the nesting are returned as exceptions, i.e. (minute, parameter) couples where the flag 
+    recovered from the level has to be inverted.
+
+    Parameters
+    ----------
+    flags : 2D array-like of bool
+        spike flags with one row for each minute and one column for each parameter
+    params : list of str
+        parameter values of the columns of flags. Larger values are stricter
+
+    Returns
+    -------
+    level : Categorical
+        ordered categorical with the strictest parameter that flags each minute (NaN if the minute is never flagged).
+        The categories are the parameters sorted by value and the codes are int8
+    exc_rows, exc_params : arrays
+        row index and parameter value of the exceptions
+    """
+    order = np.argsort([float(p) for p in params], kind='stable')
+    sorted_params = [params[i] for i in order]
+    flags = np.asarray(flags, dtype=bool)[:, order]
+    nparams = flags.shape[1]
+    codes = np.where(flags.any(axis=1), nparams-1-np.argmax(flags[:, ::-1], axis=1), -1).astype('int8') # index of the last flagged parameter
+    exc_rows, exc_cols = np.nonzero((codes[:, None] >= np.arange(nparams)) != flags)
+    level = pd.Categorical.from_codes(codes, categories=sorted_params, ordered=True)
+    exc_params = np.array([float(p) for p in sorted_params])[exc_cols]
+    return level, exc_rows, exc_params
+
+def decode_nested_flag(level, param, keys=None, exceptions=None):
+    """
+    get the spike flags for one parameter from the level column (see encode_nested_flags())
+
+    Parameters
+    ----------
+    level : Series
+        level column. Categorical when read from parquet/feather files, parameter values when read from csv files
+    param : str
+        parameter value
+    keys : DataFrame, optional
+        columns of the frame that identify each minute (e.g. 'Datetime' and 'InstrumentId'), used to match the exceptions
+    exceptions : DataFrame, optional
+        frame with the keys columns and the 'param' column of the minutes that break the nesting
+
+    Returns
+    -------
+    flag : array of bool
+    """
+    if isinstance(level.dtype, pd.CategoricalDtype):
+        level_values = np.append(np.array([float(p) for p in level.cat.categories]), np.nan)[level.cat.codes.values] # code -1 selects NaN
+    else:
+        level_values = pd.to_numeric(level).values
+    flag = level_values >= float(param) # NaN (never flagged) gives False
+    if exceptions is not None:
+        exc_keys = exceptions.loc[exceptions['param'] == float(param), keys.columns]
+        keys_index = pd.MultiIndex.from_arrays([np.asarray(keys[col]) for col in keys.columns])
+        exc_index = pd.MultiIndex.from_arrays([np.asarray(exc_keys[col]) for col in keys.columns])
+        flag = flag ^ keys_index.isin(exc_index)
+    return flag
+
+def get_grid_epoch(datetimes):
+    """ get the epoch of a minute grid: the first minute of the first year of data """
+    return np.datetime64(str(pd.Timestamp(np.min(datetimes)).year)+'-01-01T00:00', 'm')
+
+def get_grid_rows(datetimes, epoch):
+    """
+    get the grid index (minutes from the epoch) of the distinct minutes of sorted datetimes and the first row of each 
+    minute, used to place the rows of a frame on a minute grid (when more rows have the same minute the first one is kept)
+    """
+    offsets = (np.asarray(datetimes).astype('datetime64[m]') - epoch).astype('int64')
+    return np.unique(offsets, return_index=True)
+
+def write_minute_grid(frame, dir_name, columns):
+    """
+    write columns of a minute data frame on a fixed 1-minute grid, with one .npy file for each column that can be
+    opened as numpy.memmap (see open_minute_grid()). The grid index is the number of minutes from the grid epoch 
+    (see get_grid_epoch()). Missing minutes are NaN for float columns and False for bool columns. When more rows
+    have the same minute (e.g. overlapping instruments) the first one is kept.
+
+    Parameters
+    ----------
+    frame : DataFrame
+        frame with 'Datetime' column
+    dir_name : str
+        directory of the grid files
+    columns : list of str
+        columns to be written. Float columns are stored as float64, the dtype of the L1 concentrations
+    """
+    os.makedirs(dir_name, exist_ok=True)
+    minutes = frame['Datetime'].values.astype('datetime64[m]')
+    epoch = get_grid_epoch(minutes)
+    offsets, first_rows = get_grid_rows(minutes, epoch)
+    length = int(offsets.max()) + 1
+    for col in columns:
+        values = frame[col].values[first_rows]
+        if values.dtype == bool:
+            grid = np.lib.format.open_memmap(os.path.join(dir_name, col+'.npy'), mode='w+', dtype=bool, shape=(length,))
+            grid[:] = False
+        else:
+            grid = np.lib.format.open_memmap(os.path.join(dir_name, col+'.npy'), mode='w+', dtype='float64', shape=(length,))
+            grid[:] = np.nan
+        grid[offsets] = values
+        grid.flush()
+        del grid
+    with open(os.path.join(dir_name, 'grid.json'), 'w') as file:
+        json.dump({'epoch': str(epoch), 'length': length, 'columns': list(columns)}, file)
+
+def open_minute_grid(dir_name, columns=None):
+    """
+    open the files of a minute grid (see write_minute_grid()) as read only numpy.memmap: data are read from disk
+    only when they are accessed.
+
+    Parameters
+    ----------
+    dir_name : str
+        directory of the grid files
+    columns : list of str, optional
+        columns to be opened. If None all the columns are opened
+
+    Returns
+    -------
+    grid : dict
+        numpy.memmap of each column, with column names as keys, and the grid 'epoch' (datetime64[m])
+    """
+    with open(os.path.join(dir_name, 'grid.json')) as file:
+        info = json.load(file)
+    if columns is None:
+        columns = info['columns']
+    grid = {col: np.load(os.path.join(dir_name, col+'.npy'), mmap_mode='r') for col in columns}
+    grid['epoch'] = np.datetime64(info['epoch'], 'm')
+    return grid
+
+def get_grid_slice(grid, start_date, end_date):
+    """
+    get the slice of a minute grid between two dates (start included, end excluded), clipped to the grid limits
+
+    Parameters
+    ----------
+    grid : dict
+        minute grid (see open_minute_grid())
+    start_date, end_date : datetime-like
+        limits of the selection
+
+    Returns
+    -------
+    grid_slice : slice
+    """
+    length = len(next(values for key, values in grid.items() if key not in grid_metadata))
+    start = int((np.datetime64(start_date, 'm') - grid['epoch']).astype('int64'))
+    end   = int((np.datetime64(end_date,   'm') - grid['epoch']).astype('int64'))
+    return slice(min(max(start, 0), length), min(max(end, 0), length))
+
+def select_grid(grid, start_date, end_date):
+    """
+    select the minutes of a grid between two dates (start included, end excluded). The selected arrays are views
+    of the memmap files, thus no data are copied. The 2D arrays of a height profile are selected along the time axis
+
+    Parameters
+    ----------
+    grid : dict
+        minute grid (see open_minute_grid()) or height profile (see fmt.read_height_profile())
+    start_date, end_date : datetime-like
+        limits of the selection
+
+    Returns
+    -------
+    selection : dict
+        selected arrays with column names as keys and the 'Datetime' values of the selected minutes
+    """
+    grid_slice = get_grid_slice(grid, start_date, end_date)
+    selection = {col: values[grid_slice] for col, values in grid.items() if col not in grid_metadata}
+    if 'heights' in grid: # height profile (see fmt.read_height_profile())
+        selection['heights'] = grid['heights']
+    selection['Datetime'] = grid['epoch'] + np.arange(grid_slice.start, grid_slice.stop).astype('timedelta64[m]')
+    return selection
+
+def grid_to_frame(selection, valid_col):
+    """ convert a grid selection (see select_grid()) to a frame with the minutes where valid_col is not NaN """
+    valid = ~np.isnan(selection[valid_col])
+    frame = pd.DataFrame({col: np.asarray(values)[valid] for col, values in selection.items()})
+    frame['Datetime'] = frame['Datetime'].astype('datetime64[ns]')
+    return frame[['Datetime'] + [col for col in frame.columns if col != 'Datetime']]
+
+def partition_spiked_tree(root='./data-minute-spiked/', remove_old=False):
+    """
+    write the spiked files of a directory tree as year/month partitions (see write_partitioned_frame())
+
+    Parameters
+    ----------
+    root : str, optional
+        root directory of the spiked files
+    remove_old : bool, optional
+        remove the not partitioned files after the conversion
+    """
+    done = set()
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = [d for d in dir_names if not d.endswith(partitions_extension)] # skip the partitions
+        for file_nm in sorted(file_names):
+            for file_format in file_extensions:
+                if file_extensions[file_format] != '' and file_nm.endswith(file_extensions[file_format]):
+                    file_nm = file_nm[:-len(file_extensions[file_format])]
+            if not file_nm.endswith(spiked_suffixes):
+                continue
+            file_name = os.path.join(dir_path, file_nm)
+            if (file_name in done) or (get_file_format(file_name) == 'partitioned'): # files in more formats are read once
+                continue
+            done.add(file_name)
+            print('partitioning', file_name)
+            write_partitioned_frame(read_spiked_frame(file_name), file_name, remove_old=True)
+            if remove_old:
+                remove_spiked_file(file_name)
+
+def convert_spiked_tree(root='./data-minute-spiked/', file_format='parquet', remove_csv=False):
+    """
+    convert the csv spiked files of a directory tree to another format
+
+    Parameters
+    ----------
+    root : str, optional
+        root directory of the spiked files
+    file_format : str, optional
+        'parquet' or 'feather'
+    remove_csv : bool, optional
+        remove the csv files after the conversion
+    """
+    for dir_path, dir_names, file_names in os.walk(root):
+        for file_nm in sorted(file_names):
+            if not file_nm.endswith(spiked_suffixes): # csv spiked files have no extension
+                continue
+            file_name = os.path.join(dir_path, file_nm)
+            print('converting', file_name)
+            frame = pd.read_csv(file_name, sep=';', parse_dates=['Datetime'])
+            write_spiked_frame(frame, file_name, file_format=file_format)
+            if remove_csv:
+                os.remove(file_name)